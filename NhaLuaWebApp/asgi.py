@@ -3,6 +3,10 @@ ASGI config for NhaLuaWebApp project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+The web process is served through ASGI (see Procfile) so that the async
+Server-Sent Events view ``api_integration:sync_events`` can hold many open
+progress streams without tying up a worker thread per client.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -3,6 +3,8 @@ import os
 from celery import Celery
 from celery.schedules import crontab
 
+from api_integration.task_routing import BULK_QUEUE, HOT_QUEUE
+
 # Set Django settings module
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'NhaLuaWebApp.settings')
 
@@ -12,46 +14,33 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 # Auto-discover tasks
 app.autodiscover_tasks(['api_integration'])
 app.conf.beat_schedule = {
-    # Sync shops - mỗi ngày 1 lần (3:00 AM)
-    'sync-shops-daily': {
-        'task': 'api_integration.tasks.sync_shops_task',
-        'schedule': crontab(hour=3, minute=0), 
-    },
-    
-    # Sync categories - mỗi ngày 1 lần (3:30 AM)
-    'sync-categories-daily': {
-        'task': 'api_integration.tasks.sync_categories_task', 
-        'schedule': crontab(hour=3, minute=30),  
-    },
-    
-    # Sync products - mỗi ngày 1 lần (4:00 AM)
-    'sync-products-daily': {
-        'task': 'api_integration.tasks.sync_all_products',
-        'schedule': crontab(hour=4, minute=0),  
-    },
-    
-    # Sync customers - giảm xuống mỗi 3 giờ
+    # Sync customers incremental (theo watermark) - mỗi 3 giờ
     'sync-customers-30-days': {
         'task': 'api_integration.tasks.sync_all_customers_30_days',
         'schedule': crontab(minute=0, hour='*/3'),  # Mỗi 3 giờ
+        'options': {'queue': HOT_QUEUE},
     },
     
-    # Sync orders - giảm xuống mỗi 1 giờ
+    # Sync orders incremental (theo watermark) - mỗi 1 giờ
     'sync-orders-hourly': {
         'task': 'api_integration.tasks.sync_orders_daily',
         'schedule': crontab(minute=0),  # Mỗi giờ
+        'options': {'queue': HOT_QUEUE},
     },
     
-    # Sync all data - mỗi ngày (2:00 AM)
+    # Pipeline toàn bộ - mỗi ngày (2:00 AM): shops -> (categories -> products || customers reconcile)
+    # -> orders repair, mỗi stage chạy ngay khi stage phụ thuộc xong (xem _build_sync_pipeline)
     'sync-all-data-daily': {
         'task': 'api_integration.tasks.sync_all_data_task',
         'schedule': crontab(hour=2, minute=0),
+        'options': {'queue': BULK_QUEUE},
     },
     
     # Cleanup - giảm xuống mỗi 2 giờ
     'cleanup-customer-sync-histories': {
         'task': 'api_integration.tasks.cleanup_old_customer_sync_histories',
         'schedule': crontab(minute=0, hour='*/2'),  # Mỗi 2 giờ
+        'options': {'queue': BULK_QUEUE},
     },
 }
 
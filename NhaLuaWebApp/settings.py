@@ -4,6 +4,7 @@ Django settings for NhaLuaWebApp project.
 import pymysql
 from pathlib import Path
 import os
+from kombu import Queue
 pymysql.install_as_MySQLdb()
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -62,6 +63,23 @@ LOGGING = {
 # API Configuration - move to environment variables in production
 PANCAKE_API_KEY = os.environ.get('PANCAKE_API_KEY', '8a8623bad3a74f5aae5204894053e86b')
 PANCAKE_API_BASE_URL = os.environ.get('PANCAKE_API_BASE_URL', 'https://pos.pages.fm/api/v1')
+PANCAKE_API_POOL_SIZE = int(os.environ.get('PANCAKE_API_POOL_SIZE', 10))
+PANCAKE_API_MAX_RETRIES = int(os.environ.get('PANCAKE_API_MAX_RETRIES', 3))
+PANCAKE_API_BACKOFF_FACTOR = float(os.environ.get('PANCAKE_API_BACKOFF_FACTOR', 1.0))
+# Token bucket dùng chung (Redis) cho mọi request tới Pancake, theo API key
+PANCAKE_API_RATE_LIMIT = float(os.environ.get('PANCAKE_API_RATE_LIMIT', 5.0))  # requests/giây tối đa
+PANCAKE_API_RATE_BURST = int(os.environ.get('PANCAKE_API_RATE_BURST', 10))
+PANCAKE_API_MIN_RATE = float(os.environ.get('PANCAKE_API_MIN_RATE', 0.5))
+PANCAKE_API_RATE_PENALTY = float(os.environ.get('PANCAKE_API_RATE_PENALTY', 5.0))  # giây nghỉ khi bị 429/5xx
+PANCAKE_SYNC_PREFETCH_PAGES = int(os.environ.get('PANCAKE_SYNC_PREFETCH_PAGES', 2))
+PANCAKE_SYNC_FETCH_WORKERS = int(os.environ.get('PANCAKE_SYNC_FETCH_WORKERS', 4))
+PANCAKE_SYNC_REF_CACHE_SIZE = int(os.environ.get('PANCAKE_SYNC_REF_CACHE_SIZE', 50000))  # Số entry tối đa của cache pancake_id -> pk mỗi lần sync shop
+PANCAKE_SYNC_CONTINUATION_MARGIN = int(os.environ.get('PANCAKE_SYNC_CONTINUATION_MARGIN', 5 * 60))  # Dừng và enqueue task tiếp nối khi còn 5 phút tới soft limit
+PANCAKE_SYNC_EVENTS_CHANNEL = os.environ.get('PANCAKE_SYNC_EVENTS_CHANNEL', 'pancake:sync:events')  # Redis pub/sub channel của SSE tiến độ sync
+PANCAKE_SYNC_LOCK_TTL = int(os.environ.get('PANCAKE_SYNC_LOCK_TTL', 10 * 60))  # Lease của lock (shop, entity), heartbeat gia hạn mỗi TTL/3
+PANCAKE_SYNC_LOCK_POLICY = os.environ.get('PANCAKE_SYNC_LOCK_POLICY', 'queue')  # Shop đang bị run khác khoá: skip / queue / coalesce
+PANCAKE_SYNC_LOCK_RETRY_DELAY = int(os.environ.get('PANCAKE_SYNC_LOCK_RETRY_DELAY', 60))  # Policy queue: retry subtask sau N giây
+PANCAKE_SYNC_LOCK_MAX_RETRIES = int(os.environ.get('PANCAKE_SYNC_LOCK_MAX_RETRIES', 12))  # Policy queue: hết lượt retry thì skip shop
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
@@ -134,6 +152,13 @@ CELERY_TASK_SOFT_TIME_LIMIT = 25 * 60  # 25 minutes
 CELERY_TASK_ACKS_LATE = True
 CELERY_WORKER_PREFETCH_MULTIPLIER = 1
 
+# Queue riêng: sync_hot (orders/customers incremental) và sync_bulk (catalog, full/repair, backfill, cleanup),
+# mỗi queue chạy worker riêng (Procfile); route theo api_integration/task_routing.py
+CELERY_TASK_DEFAULT_QUEUE = 'celery'
+CELERY_TASK_QUEUES = (Queue('sync_hot'), Queue('sync_bulk'), Queue('celery'))
+CELERY_TASK_ROUTES = ('api_integration.task_routing.sync_task_route',)
+CELERY_BROKER_TRANSPORT_OPTIONS = {'queue_order_strategy': 'priority'}  # Worker nghe nhiều queue luôn lấy queue đứng trước trong -Q trước
+
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
@@ -0,0 +1,183 @@
+"""
+Upsert một câu lệnh cho các bulk helper trong tasks.py.
+
+Thay cho SELECT + bulk_create(ignore_conflicts) + bulk_update (CASE WHEN rất lớn),
+mỗi batch là một câu INSERT ... ON DUPLICATE KEY UPDATE trên MySQL
+(ON CONFLICT ... DO UPDATE trên SQLite/PostgreSQL), sinh bởi InsertQuery của Django.
+
+Đếm created/updated từ affected rows. Django mở kết nối MySQL với CLIENT_FOUND_ROWS nên
+mỗi row insert tính 1, row update có thay đổi tính 2, row trùng không đổi tính 1.
+Các cột auto_now (updated_at) luôn được đưa vào update_fields nên row đã tồn tại luôn
+thay đổi, suy ra:
+    updated = rowcount - n, created = n - updated
+Model không có cột auto_now, hoặc backend khác MySQL: đếm row đã tồn tại bằng một
+SELECT COUNT theo unique key trước khi ghi.
+
+Với hash_field (cột sync_hash), fingerprint của các cột sẽ ghi được so với giá trị
+trong DB; row không đổi bị loại trước khi ghi và được đếm riêng là unchanged.
+"""
+import logging
+from dataclasses import dataclass
+from functools import reduce
+from operator import or_
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from django.db import connections, router, transaction
+from django.db.models import AutoField, Q
+from django.db.models.constants import OnConflict
+from django.db.models.sql import InsertQuery
+
+from .fingerprints import compute_fingerprint
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 500
+
+# Cột đổi mỗi lần sync nhưng không phải thay đổi dữ liệu upstream
+DEFAULT_HASH_EXCLUDE = ('last_sync',)
+
+
+@dataclass
+class UpsertResult:
+    created: int = 0
+    updated: int = 0
+    unchanged: int = 0
+
+
+def _unique_key(obj, unique_fields) -> tuple:
+    return tuple(getattr(obj, field.attname) for field in unique_fields)
+
+
+def _normalize_key(key: tuple) -> tuple:
+    """So khớp key giữa dữ liệu API và DB (vd pancake_id int vs varchar)"""
+    return tuple(str(value) for value in key)
+
+
+def _filter_by_keys(model, unique_fields, keys: List[tuple], using: str):
+    """Queryset các row đã có trong DB theo unique key"""
+    if len(unique_fields) == 1:
+        return model._base_manager.using(using).filter(
+            **{f"{unique_fields[0].attname}__in": [key[0] for key in keys]}
+        )
+    condition = reduce(or_, (
+        Q(**{field.attname: value for field, value in zip(unique_fields, key)}) for key in keys
+    ))
+    return model._base_manager.using(using).filter(condition)
+
+
+def _existing_hashes(model, unique_fields, keys: List[tuple], hash_field: str, using: str) -> Dict[tuple, str]:
+    rows = _filter_by_keys(model, unique_fields, keys, using).values_list(
+        *[field.attname for field in unique_fields], hash_field
+    )
+    return {_normalize_key(row[:-1]): row[-1] for row in rows}
+
+
+def _row_fingerprint(obj, fields) -> str:
+    return compute_fingerprint({field.attname: getattr(obj, field.attname) for field in fields})
+
+
+def bulk_upsert(model, objs: Sequence, unique_fields: Sequence[str], update_fields: Sequence[str],
+                batch_size: int = DEFAULT_BATCH_SIZE, hash_field: Optional[str] = None,
+                hash_exclude: Iterable[str] = DEFAULT_HASH_EXCLUDE) -> UpsertResult:
+    """
+    Insert hoặc update objs theo unique_fields, trả về số row created/updated/unchanged.
+
+    - unique_fields phải khớp một unique constraint của model (vd ['shop', 'pancake_id'])
+    - update_fields: các cột ghi đè khi trùng key; cột auto_now được thêm tự động
+    - hash_field: cột lưu fingerprint của update_fields (trừ hash_exclude); row có fingerprint
+      bằng giá trị trong DB không được ghi
+    - Row trùng key trong cùng objs: giữ row cuối cùng
+    """
+    result = UpsertResult()
+    if not objs:
+        return result
+
+    opts = model._meta
+    using = router.db_for_write(model)
+    connection = connections[using]
+
+    unique_fields = [opts.get_field(name) for name in unique_fields]
+    update_fields = [opts.get_field(name) for name in update_fields]
+    if hash_field:
+        excluded = set(hash_exclude)
+        hashed_fields = [f for f in update_fields if f.name not in excluded]
+        update_fields.append(opts.get_field(hash_field))
+    auto_now_fields = [f for f in opts.concrete_fields if getattr(f, 'auto_now', False)]
+    update_fields += [f for f in auto_now_fields if f not in update_fields]
+
+    # Bỏ trùng key trong batch, nếu không affected rows không còn đúng công thức
+    deduped: Dict[tuple, object] = {}
+    for obj in objs:
+        deduped[_unique_key(obj, unique_fields)] = obj
+    objs = list(deduped.values())
+    for obj in objs:
+        obj._prepare_related_fields_for_save(operation_name='bulk_upsert')
+        if hash_field:
+            setattr(obj, hash_field, _row_fingerprint(obj, hashed_fields))
+
+    fields = [f for f in opts.concrete_fields if not isinstance(f, AutoField)]
+    batch_size = max(1, min(batch_size, connection.ops.bulk_batch_size(fields, objs) or batch_size))
+    count_from_rowcount = connection.vendor == 'mysql' and bool(auto_now_fields)
+    conflict_target = unique_fields if connection.features.supports_update_conflicts_with_target else None
+
+    with transaction.atomic(using=using, savepoint=False):
+        for start in range(0, len(objs), batch_size):
+            batch = objs[start:start + batch_size]
+            keys = [_unique_key(obj, unique_fields) for obj in batch]
+            existing = None
+            if hash_field:
+                # Bỏ row không đổi trước khi ghi
+                stored = _existing_hashes(model, unique_fields, keys, hash_field, using)
+                changed = [
+                    (obj, key) for obj, key in zip(batch, keys)
+                    if stored.get(_normalize_key(key)) != getattr(obj, hash_field)
+                ]
+                result.unchanged += len(batch) - len(changed)
+                existing = sum(1 for _, key in changed if _normalize_key(key) in stored)
+                batch = [obj for obj, _ in changed]
+                if not batch:
+                    continue
+            elif not count_from_rowcount:
+                existing = _filter_by_keys(model, unique_fields, keys, using).count()
+
+            query = InsertQuery(model, on_conflict=OnConflict.UPDATE,
+                                update_fields=update_fields, unique_fields=conflict_target)
+            query.insert_values(fields, batch, raw=False)
+            rowcount = 0
+            with connection.cursor() as cursor:
+                for sql, params in query.get_compiler(using=using).as_sql():
+                    cursor.execute(sql, params)
+                    rowcount += cursor.rowcount
+
+            if existing is None:
+                existing = max(0, min(len(batch), rowcount - len(batch)))
+            result.created += len(batch) - existing
+            result.updated += existing
+
+    logger.debug(f"Upserted {opts.db_table}: {result.created} created, {result.updated} updated, "
+                 f"{result.unchanged} unchanged")
+    return result
+
+
+def delete_stale_children(model, parent_field: str, keep: Dict[int, Iterable], key_field: str = 'pancake_id') -> int:
+    """
+    Xoá các row con không còn trong response: keep = {parent_pk: các key còn tồn tại}.
+
+    Một SELECT các row hiện có của các parent, diff trong bộ nhớ, một DELETE theo pk.
+    Parent không có trong keep không bị động tới.
+    """
+    if not keep:
+        return 0
+    parent_attname = model._meta.get_field(parent_field).attname
+    keep = {parent_pk: {str(key) for key in keys} for parent_pk, keys in keep.items()}
+    stale_ids = [
+        pk for pk, parent_pk, key in model._base_manager.filter(
+            **{f"{parent_attname}__in": list(keep)}
+        ).values_list('pk', parent_attname, key_field)
+        if str(key) not in keep[parent_pk]
+    ]
+    if not stale_ids:
+        return 0
+    model._base_manager.filter(pk__in=stale_ids).delete()
+    logger.debug(f"Deleted {len(stale_ids)} stale rows from {model._meta.db_table}")
+    return len(stale_ids)
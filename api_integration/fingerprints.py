@@ -0,0 +1,41 @@
+"""
+Content fingerprint cho các bản ghi sync từ Pancake.
+
+Fingerprint được tính từ dữ liệu đã extract (trước khi ghi DB) và lưu vào cột
+`sync_hash`; lần sync sau chỉ ghi những bản ghi có fingerprint thay đổi.
+"""
+import hashlib
+import json
+from typing import Dict, Iterable
+
+
+def compute_fingerprint(data: Dict, exclude: Iterable[str] = ()) -> str:
+    """SHA1 của dữ liệu (sort key, bỏ các field trong exclude)"""
+    excluded = set(exclude)
+    payload = {key: value for key, value in data.items() if key not in excluded}
+    serialized = json.dumps(payload, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+
+
+# ===== NATURAL KEY CHO LỊCH SỬ ĐƠN HÀNG =====
+# Lịch sử từ API không có id; key được tính từ nội dung để ghi append-only (insert-ignore).
+# updated_at dùng epoch giây để không phụ thuộc timezone khi đọc lại từ DB.
+# updated_at thiếu (None) luôn ra epoch 0, không được thay bằng thời điểm sync.
+
+def _epoch(dt) -> int:
+    return int(dt.timestamp()) if dt else 0
+
+
+def status_history_key(updated_at, status, old_status=None, editor_fb=None) -> str:
+    """Key của một OrderStatusHistory trong một đơn"""
+    return compute_fingerprint({
+        'updated_at': _epoch(updated_at),
+        'status': status,
+        'old_status': old_status,
+        'editor_fb': editor_fb,
+    })
+
+
+def order_history_key(updated_at, changes: Dict) -> str:
+    """Key của một OrderHistory trong một đơn"""
+    return compute_fingerprint({'updated_at': _epoch(updated_at), 'changes': changes})
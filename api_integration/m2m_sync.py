@@ -0,0 +1,62 @@
+"""
+Đồng bộ quan hệ M2M theo tập (set-based) qua through model.
+
+Thay cho `.set()` từng object (mỗi lần vài query), cả trang được xử lý bằng:
+một SELECT các row through hiện có, tính diff trong bộ nhớ, một bulk_create
+cho row thiếu và một DELETE cho row thừa.
+"""
+import logging
+from dataclasses import dataclass
+from typing import Dict, Iterable, Set
+
+from django.db import router, transaction
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class M2MSyncResult:
+    added: int = 0
+    removed: int = 0
+
+
+def sync_m2m(m2m_field, desired: Dict[int, Iterable[int]], batch_size: int = 1000) -> M2MSyncResult:
+    """
+    Đặt quan hệ M2M cho nhiều source object một lần.
+
+    - m2m_field: field M2M của model nguồn, vd Product._meta.get_field('categories')
+    - desired: {source_pk: target_pks}; source không có trong dict không bị động tới
+    """
+    result = M2MSyncResult()
+    if not desired:
+        return result
+
+    through = m2m_field.remote_field.through
+    source_attname = f"{m2m_field.m2m_field_name()}_id"
+    target_attname = f"{m2m_field.m2m_reverse_field_name()}_id"
+    desired_pairs: Set[tuple] = {
+        (source_pk, target_pk) for source_pk, target_pks in desired.items() for target_pk in target_pks
+    }
+
+    existing = {
+        (source_pk, target_pk): row_id for row_id, source_pk, target_pk in through.objects.filter(
+            **{f"{source_attname}__in": list(desired)}
+        ).values_list('pk', source_attname, target_attname)
+    }
+
+    to_add = [
+        through(**{source_attname: source_pk, target_attname: target_pk})
+        for source_pk, target_pk in desired_pairs - existing.keys()
+    ]
+    to_remove = [row_id for pair, row_id in existing.items() if pair not in desired_pairs]
+
+    with transaction.atomic(using=router.db_for_write(through), savepoint=False):
+        if to_add:
+            through.objects.bulk_create(to_add, batch_size=batch_size, ignore_conflicts=True)
+        if to_remove:
+            through.objects.filter(pk__in=to_remove).delete()
+
+    result.added, result.removed = len(to_add), len(to_remove)
+    logger.debug(f"Synced {through._meta.db_table}: {result.added} added, {result.removed} removed "
+                 f"for {len(desired)} objects")
+    return result
@@ -0,0 +1,94 @@
+"""
+Chia lịch sử đơn hàng của một shop thành các window thời gian cho backfill.
+
+Mỗi window (start_timestamp, end_timestamp) chạy như một subtask độc lập với
+checkpoint riêng, nên backfill nhiều năm đơn hàng dùng được nhiều worker và
+resume được theo từng window.
+
+- Mặc định chia theo tháng (giờ Việt Nam)
+- Adaptive (target_pages): probe trang đầu của từng window để biết total_pages,
+  chia đôi window quá lớn, gộp các window liền kề nhỏ, bỏ window không có đơn
+"""
+import logging
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+Window = Tuple[int, int]
+
+# Window nhỏ nhất khi chia adaptive: 1 ngày
+MIN_WINDOW_SECONDS = 24 * 60 * 60
+
+# Backfill mặc định 3 năm khi không truyền start_date
+DEFAULT_BACKFILL_DAYS = 3 * 365
+
+
+def _next_month_start(moment: datetime) -> datetime:
+    """0h ngày 1 tháng sau theo giờ địa phương của moment (đúng offset kể cả khi qua DST)"""
+    naive = moment.replace(tzinfo=None, day=1, hour=0, minute=0, second=0, microsecond=0)
+    naive = (naive + timedelta(days=32)).replace(day=1)
+    tz = moment.tzinfo
+    if tz is None:
+        return naive
+    # pytz cần localize để lấy offset của ngày đó; zoneinfo/UTC gắn tzinfo trực tiếp
+    return tz.localize(naive) if hasattr(tz, 'localize') else naive.replace(tzinfo=tz)
+
+
+def month_windows(start: datetime, end: datetime) -> List[Window]:
+    """Chia [start, end] thành các window theo tháng, window đầu/cuối bị cắt theo start/end"""
+    windows = []
+    cursor = start
+    while cursor <= end:
+        next_month = _next_month_start(cursor)
+        window_end = min(next_month - timedelta(seconds=1), end)
+        windows.append((int(cursor.timestamp()), int(window_end.timestamp())))
+        cursor = next_month
+    return windows
+
+
+def adaptive_windows(windows: List[Window], target_pages: int,
+                     probe_pages: Callable[[int, int], int],
+                     min_window_seconds: int = MIN_WINDOW_SECONDS) -> List[Window]:
+    """
+    Điều chỉnh windows để mỗi window khoảng target_pages trang.
+
+    probe_pages(start_ts, end_ts) trả về total_pages của window (0 nếu không có đơn).
+    """
+    sized: List[Tuple[Window, int]] = []
+    pending = list(reversed(windows))
+    while pending:
+        start_ts, end_ts = pending.pop()
+        pages = probe_pages(start_ts, end_ts)
+        if pages > target_pages and end_ts - start_ts > min_window_seconds:
+            middle = start_ts + (end_ts - start_ts) // 2
+            # Xử lý nửa đầu trước để giữ thứ tự thời gian
+            pending.append((middle + 1, end_ts))
+            pending.append((start_ts, middle))
+            continue
+        if pages > 0:
+            sized.append(((start_ts, end_ts), pages))
+
+    # Gộp các window liền kề khi tổng số trang vẫn trong target
+    merged: List[Window] = []
+    merged_pages = 0
+    for (start_ts, end_ts), pages in sized:
+        if merged and merged_pages + pages <= target_pages and merged[-1][1] + 1 == start_ts:
+            merged[-1] = (merged[-1][0], end_ts)
+            merged_pages += pages
+        else:
+            merged.append((start_ts, end_ts))
+            merged_pages = pages
+
+    logger.info(f"Adaptive windows: {len(windows)} initial -> {len(merged)} windows of ~{target_pages} pages")
+    return merged
+
+
+def probe_total_pages(fetch_page: Callable[..., Dict], shop_id: int) -> Callable[[int, int], int]:
+    """Tạo probe_pages từ hàm fetch trang đơn hàng theo date range (chỉ fetch trang 1)"""
+    def _probe(start_ts: int, end_ts: int) -> int:
+        data = fetch_page(shop_id, start_ts, end_ts, page=1)
+        if not data.get('success', False) or not data.get('data'):
+            return 0
+        return data.get('total_pages', 1)
+    return _probe
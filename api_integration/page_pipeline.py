@@ -0,0 +1,152 @@
+"""
+Pipeline fetch/upsert cho các API phân trang của Pancake.
+
+Một thread nền fetch trước 1-2 trang vào một queue có giới hạn trong khi
+thread chính ghi trang hiện tại vào DB, nên network và MySQL chạy song song.
+Khi đã biết total_pages (sau trang đầu), các trang còn lại được fetch song song
+bằng một thread pool nhỏ nhưng vẫn được yield ra đúng thứ tự trang.
+Thread fetch chỉ gọi HTTP, không đụng tới Django ORM.
+"""
+import logging
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, Optional
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_SENTINEL = object()
+
+
+@dataclass
+class PageFetch:
+    """Kết quả fetch một trang: data hoặc error (không bao giờ cả hai)"""
+    page: int
+    data: Optional[Dict] = None
+    error: Optional[Exception] = None
+    total_pages: Optional[int] = None
+
+
+def iter_prefetched_pages(fetch_page: Callable[[int], Dict], start_page: int = 1,
+                          prefetch: int = None, workers: int = None,
+                          on_page_done: Callable[[PageFetch], None] = None) -> Iterator[PageFetch]:
+    """
+    Yield PageFetch theo thứ tự trang, với một thread nền fetch trước tối đa `prefetch` trang.
+
+    - Nếu `workers` > 1, sau khi trang đầu trả về total_pages thì các trang còn lại được fetch
+      song song bởi `workers` thread; số trang đang giữ trong bộ nhớ
+      tối đa là prefetch + workers
+    - total_pages được đọc từ mỗi response thành công (`total_pages`, mặc định 1)
+    - Lỗi của một trang được yield ra dưới dạng PageFetch.error để caller ghi nhận theo trang;
+      lỗi ở trang đầu tiên (chưa biết total_pages) sẽ dừng pipeline
+    - Response `success=false` được yield ra rồi dừng fetch
+    - Khi caller break/return, thread fetch được báo dừng
+    - `on_page_done(page_fetch)` được gọi sau khi caller xử lý xong một trang (caller lấy trang
+      kế tiếp hoặc hết vòng lặp), không gọi cho trang mà caller break ra; được gọi cả cho trang
+      fetch lỗi, caller tự xác định trang đã commit hay chưa trước khi ghi checkpoint
+    - Không có sleep cố định giữa các trang: throttling do rate limiter của PancakeClient đảm nhận
+    """
+    if prefetch is None:
+        prefetch = getattr(settings, 'PANCAKE_SYNC_PREFETCH_PAGES', 2)
+    prefetch = max(1, prefetch)
+    if workers is None:
+        workers = getattr(settings, 'PANCAKE_SYNC_FETCH_WORKERS', 4)
+    workers = max(1, workers)
+
+    buffer = queue.Queue(maxsize=prefetch)
+    stop_event = threading.Event()
+
+    def _put(item) -> bool:
+        while not stop_event.is_set():
+            try:
+                buffer.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fetch_concurrently(first_page: int, total_pages: int):
+        """Fetch first_page..total_pages song song, put vào queue theo thứ tự trang"""
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pancake-page-fetch')
+        pending = deque()
+        next_page = first_page
+        try:
+            while not stop_event.is_set() and (pending or next_page <= total_pages):
+                while next_page <= total_pages and len(pending) < workers:
+                    pending.append((next_page, pool.submit(fetch_page, next_page)))
+                    next_page += 1
+
+                page, future = pending.popleft()
+                try:
+                    data = future.result()
+                except Exception as e:
+                    if not _put(PageFetch(page=page, error=e, total_pages=total_pages)):
+                        return
+                    continue
+
+                if not data.get('success', False):
+                    _put(PageFetch(page=page, data=data, total_pages=total_pages))
+                    return
+
+                if not _put(PageFetch(page=page, data=data, total_pages=total_pages)):
+                    return
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _fetcher():
+        page = start_page
+        total_pages = None
+        try:
+            while not stop_event.is_set() and (total_pages is None or page <= total_pages):
+                if total_pages is not None and workers > 1:
+                    _fetch_concurrently(page, total_pages)
+                    return
+
+                try:
+                    data = fetch_page(page)
+                except Exception as e:
+                    if not _put(PageFetch(page=page, error=e, total_pages=total_pages)):
+                        return
+                    if total_pages is None:
+                        return
+                    page += 1
+                    continue
+
+                if not data.get('success', False):
+                    _put(PageFetch(page=page, data=data, total_pages=total_pages))
+                    return
+
+                total_pages = data.get('total_pages', 1)
+                if not _put(PageFetch(page=page, data=data, total_pages=total_pages)):
+                    return
+
+                page += 1
+        finally:
+            _put(_SENTINEL)
+
+    fetcher = threading.Thread(target=_fetcher, name='pancake-page-prefetch', daemon=True)
+    fetcher.start()
+
+    try:
+        while True:
+            item = buffer.get()
+            if item is _SENTINEL:
+                break
+            yield item
+            if on_page_done:
+                try:
+                    on_page_done(item)
+                except Exception as e:
+                    logger.warning(f"on_page_done callback failed for page {item.page}: {e}")
+    finally:
+        stop_event.set()
+        # Giải phóng chỗ trong queue để thread fetch không bị block khi put
+        while True:
+            try:
+                buffer.get_nowait()
+            except queue.Empty:
+                break
@@ -0,0 +1,142 @@
+"""
+Pancake POS API client dùng chung cho tất cả các luồng sync (views + tasks).
+
+Một Session có connection pool + keep-alive để các trang liên tiếp không phải
+mở lại kết nối TCP/TLS, tự động retry/backoff cho lỗi mạng và 429/5xx.
+Mọi request đi qua PancakeRateLimiter (token bucket trên Redis) nên nhiều worker
+sync song song vẫn chia sẻ chung một giới hạn theo API key.
+"""
+import logging
+import os
+import threading
+from typing import Dict, Optional
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .rate_limiter import PancakeRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# (connect timeout, read timeout) theo từng endpoint
+ENDPOINT_TIMEOUTS = {
+    'shops': (10, 30),
+    'categories': (10, 30),
+    'variations': (10, 540),
+    'customers': (10, 60),
+    'orders': (10, 300),
+}
+DEFAULT_TIMEOUT = (10, 60)
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class PancakeClient:
+    """HTTP client cho Pancake API với pooled session, gzip và retry/backoff"""
+
+    def __init__(self, base_url: str = None, api_key: str = None,
+                 pool_size: int = None, max_retries: int = None, backoff_factor: float = None):
+        self.base_url = (base_url or settings.PANCAKE_API_BASE_URL).rstrip('/')
+        self.api_key = api_key or settings.PANCAKE_API_KEY
+        self.pool_size = pool_size or getattr(settings, 'PANCAKE_API_POOL_SIZE', 10)
+        self.max_retries = max_retries if max_retries is not None else getattr(settings, 'PANCAKE_API_MAX_RETRIES', 3)
+        self.backoff_factor = backoff_factor if backoff_factor is not None else getattr(settings, 'PANCAKE_API_BACKOFF_FACTOR', 1.0)
+        self.session = self._build_session()
+        self.rate_limiter = PancakeRateLimiter(self.api_key)
+
+    def _build_session(self) -> requests.Session:
+        # urllib3 chỉ retry lỗi kết nối; 429/5xx được xử lý trong get() để báo cho rate limiter.
+        # Không retry read timeout: với read timeout 300-540s, mỗi lần retry có thể vượt
+        # CELERY_TASK_TIME_LIMIT, để lỗi lên task (checkpoint/continuation) xử lý
+        retry = Retry(
+            total=self.max_retries,
+            connect=self.max_retries,
+            read=0,
+            status=0,
+            backoff_factor=self.backoff_factor,
+            allowed_methods=frozenset(['GET']),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_size,
+            pool_maxsize=self.pool_size,
+            max_retries=retry,
+        )
+
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive',
+        })
+        return session
+
+    def get(self, path: str, params: Optional[Dict] = None, endpoint: str = None) -> requests.Response:
+        """GET một path của Pancake API, tự thêm api_key và timeout theo endpoint"""
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        query = {'api_key': self.api_key}
+        if params:
+            query.update(params)
+
+        timeout = ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            try:
+                response = self.session.get(url, params=query, timeout=timeout)
+            except (requests.Timeout, requests.ConnectionError):
+                self.rate_limiter.penalize()
+                raise
+
+            if response.status_code not in RETRY_STATUS_CODES:
+                self.rate_limiter.reward()
+                break
+
+            self.rate_limiter.penalize(_parse_retry_after(response))
+            logger.warning(f"Pancake API {path} returned {response.status_code} "
+                           f"(attempt {attempt + 1}/{self.max_retries + 1})")
+
+        response.raise_for_status()
+        return response
+
+    def get_json(self, path: str, params: Optional[Dict] = None, endpoint: str = None) -> Dict:
+        """GET và parse JSON response"""
+        return self.get(path, params=params, endpoint=endpoint).json()
+
+    def close(self):
+        self.session.close()
+
+
+def _parse_retry_after(response: requests.Response) -> Optional[float]:
+    """Đọc header Retry-After (chỉ hỗ trợ dạng số giây)"""
+    value = response.headers.get('Retry-After')
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+_client_lock = threading.Lock()
+_client: Optional[PancakeClient] = None
+_client_pid: Optional[int] = None
+
+
+def get_pancake_client() -> PancakeClient:
+    """
+    Trả về PancakeClient dùng chung trong process hiện tại.
+    Tạo lại sau khi fork (Celery prefork worker) để không dùng chung socket giữa các process.
+    """
+    global _client, _client_pid
+
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = PancakeClient()
+                _client_pid = pid
+                logger.info(f"Initialized Pancake API client (pool_size={_client.pool_size}, "
+                            f"max_retries={_client.max_retries}) for pid {pid}")
+    return _client
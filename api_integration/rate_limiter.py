@@ -0,0 +1,167 @@
+"""
+Token bucket rate limiter dùng chung giữa các Celery worker, lưu trên Redis (CELERY_BROKER_URL).
+
+Bucket được key theo API key, nên mọi worker/process dùng cùng một key Pancake
+chia sẻ chung một giới hạn. Rate tự điều chỉnh kiểu AIMD:
+- 429/5xx/timeout: giảm rate một nửa (không thấp hơn min_rate) và chặn toàn bộ
+  bucket trong Retry-After (hoặc penalty mặc định)
+- Request thành công: tăng rate dần lên lại tới max_rate
+"""
+import hashlib
+import logging
+import threading
+import time
+from typing import Optional
+
+import redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# KEYS[1] = bucket key; ARGV = default_rate, burst
+# Trả về số giây cần chờ (0 = đã lấy được token)
+_ACQUIRE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local default_rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'rate', 'blocked_until')
+local rate = tonumber(state[3]) or default_rate
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+local blocked_until = tonumber(state[4]) or 0
+if blocked_until > now then
+    return tostring(blocked_until - now)
+end
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now), 'rate', tostring(rate))
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(wait)
+"""
+
+# ARGV = default_rate, min_rate, penalty_seconds
+_PENALIZE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local rate = tonumber(redis.call('HGET', KEYS[1], 'rate')) or tonumber(ARGV[1])
+rate = math.max(tonumber(ARGV[2]), rate / 2)
+local blocked_until = tonumber(redis.call('HGET', KEYS[1], 'blocked_until')) or 0
+blocked_until = math.max(blocked_until, now + tonumber(ARGV[3]))
+redis.call('HSET', KEYS[1], 'rate', tostring(rate), 'tokens', '0', 'ts', tostring(now),
+           'blocked_until', tostring(blocked_until))
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(rate)
+"""
+
+# ARGV = max_rate, step
+_REWARD_SCRIPT = """
+local max_rate = tonumber(ARGV[1])
+local rate = tonumber(redis.call('HGET', KEYS[1], 'rate')) or max_rate
+if rate < max_rate then
+    rate = math.min(max_rate, rate + tonumber(ARGV[2]))
+    redis.call('HSET', KEYS[1], 'rate', tostring(rate))
+end
+return tostring(rate)
+"""
+
+
+class PancakeRateLimiter:
+    """Token bucket trên Redis, key theo API key, rate thích ứng với 429/5xx"""
+
+    FAILURE_THRESHOLD = 3  # Số lỗi Redis liên tiếp trước khi tạm bỏ qua limiter
+    BYPASS_SECONDS = 60
+
+    def __init__(self, api_key: str, redis_url: str = None, rate: float = None, burst: int = None,
+                 min_rate: float = None, penalty_seconds: float = None):
+        self.key = f"pancake:ratelimit:{hashlib.sha1(api_key.encode()).hexdigest()[:16]}"
+        self.redis_url = redis_url or settings.CELERY_BROKER_URL
+        self.max_rate = rate or getattr(settings, 'PANCAKE_API_RATE_LIMIT', 5.0)
+        self.burst = burst or getattr(settings, 'PANCAKE_API_RATE_BURST', 10)
+        self.min_rate = min_rate or getattr(settings, 'PANCAKE_API_MIN_RATE', 0.5)
+        self.penalty_seconds = penalty_seconds or getattr(settings, 'PANCAKE_API_RATE_PENALTY', 5.0)
+        # Mỗi request thành công tăng rate thêm 5% của max_rate
+        self.step = self.max_rate * 0.05
+
+        # Client và script tạo sẵn (chưa kết nối), dùng chung cho mọi thread của PancakeClient;
+        # connection pool của redis-py thread-safe nên lỗi không cần dựng lại client
+        self._redis = redis.Redis.from_url(self.redis_url, socket_timeout=5, socket_connect_timeout=5)
+        self._acquire = self._redis.register_script(_ACQUIRE_SCRIPT)
+        self._penalize = self._redis.register_script(_PENALIZE_SCRIPT)
+        self._reward = self._redis.register_script(_REWARD_SCRIPT)
+        self._state_lock = threading.Lock()
+        self._redis_failures = 0
+        self._redis_failed_at = 0.0
+
+    def _client(self) -> Optional[redis.Redis]:
+        """
+        None khi Redis lỗi liên tiếp FAILURE_THRESHOLD lần: tạm bỏ qua limiter BYPASS_SECONDS
+        thay vì làm hỏng sync; một lỗi lẻ của một thread không tắt limiter của các thread khác
+        """
+        with self._state_lock:
+            if (self._redis_failures >= self.FAILURE_THRESHOLD
+                    and time.time() - self._redis_failed_at < self.BYPASS_SECONDS):
+                return None
+        return self._redis
+
+    def _on_redis_ok(self):
+        if self._redis_failures:
+            with self._state_lock:
+                self._redis_failures = 0
+
+    def _on_redis_error(self, e: Exception):
+        with self._state_lock:
+            self._redis_failures += 1
+            self._redis_failed_at = time.time()
+            failures = self._redis_failures
+        if failures >= self.FAILURE_THRESHOLD:
+            logger.warning(f"Rate limiter Redis unavailable, continuing without global throttling "
+                           f"for {self.BYPASS_SECONDS}s: {e}")
+        else:
+            logger.warning(f"Rate limiter Redis error ({failures}/{self.FAILURE_THRESHOLD}): {e}")
+
+    def acquire(self):
+        """Block cho tới khi lấy được một token"""
+        while True:
+            if self._client() is None:
+                return
+            try:
+                wait = float(self._acquire(keys=[self.key], args=[self.max_rate, self.burst]))
+            except redis.RedisError as e:
+                self._on_redis_error(e)
+                return
+            self._on_redis_ok()
+            if wait <= 0:
+                return
+            time.sleep(min(wait, 60))
+
+    def penalize(self, retry_after: Optional[float] = None):
+        """Gọi khi gặp 429/5xx/timeout: giảm rate và chặn bucket trong retry_after giây"""
+        penalty = retry_after if retry_after is not None else self.penalty_seconds
+        if self._client() is not None:
+            try:
+                rate = float(self._penalize(keys=[self.key], args=[self.max_rate, self.min_rate, penalty]))
+                self._on_redis_ok()
+                logger.warning(f"Pancake API throttled, rate reduced to {rate:.2f} req/s, "
+                               f"pausing {penalty:.1f}s")
+                return
+            except redis.RedisError as e:
+                self._on_redis_error(e)
+
+        # Không có Redis: ít nhất backoff cục bộ trong process này
+        time.sleep(min(penalty, 60))
+
+    def reward(self):
+        """Gọi khi request thành công: tăng dần rate về max_rate"""
+        if self._client() is None:
+            return
+        try:
+            self._reward(keys=[self.key], args=[self.max_rate, self.step])
+            self._on_redis_ok()
+        except redis.RedisError as e:
+            self._on_redis_error(e)
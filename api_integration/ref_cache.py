@@ -0,0 +1,93 @@
+"""
+Cache (model, pancake_id) -> primary key trong một lần sync của một shop.
+
+Mỗi trang đơn hàng cần map users, customers, pages, products, variations từ
+pancake_id sang object để gán FK; phần lớn id lặp lại giữa các trang (seller,
+page, variation bán chạy). Cache chỉ query những id chưa gặp, giới hạn số entry
+theo LRU, và được bổ sung khi pipeline tự tạo row (vd customer fetch theo id).
+
+Giá trị trả về là instance chỉ có pk + pancake_id, đủ để gán FK khi ghi.
+Id không tìm thấy không được cache để lần sau vẫn query lại.
+"""
+import logging
+from collections import OrderedDict
+from typing import Dict, Iterable, Tuple
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class RefCache:
+    """LRU cache (model, pancake_id) -> pk, kèm thống kê hit/miss"""
+
+    def __init__(self, max_size: int = None):
+        if max_size is None:
+            max_size = getattr(settings, 'PANCAKE_SYNC_REF_CACHE_SIZE', 50000)
+        self.max_size = max(1, max_size)
+        self._entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(model, pancake_id) -> Tuple[str, str]:
+        return model._meta.label, str(pancake_id)
+
+    def _store(self, key, pk):
+        self._entries[key] = pk
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def remember(self, model, pairs: Iterable[Tuple]):
+        """Ghi nhận các (pancake_id, pk) pipeline vừa tạo/đọc được"""
+        for pancake_id, pk in pairs:
+            self._store(self._key(model, pancake_id), pk)
+
+    def resolve(self, model, pancake_ids: Iterable, queryset=None) -> Dict:
+        """
+        Map pancake_ids -> instance (pk, pancake_id); id chưa gặp được query một lần từ queryset
+        (mặc định model.objects, truyền queryset để giới hạn theo shop)
+        """
+        pancake_ids = set(pancake_ids)
+        resolved = {}
+        missing = []
+        for pancake_id in pancake_ids:
+            key = self._key(model, pancake_id)
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                resolved[pancake_id] = self._entries[key]
+                self.hits += 1
+            else:
+                missing.append(pancake_id)
+                self.misses += 1
+
+        if missing:
+            queryset = queryset if queryset is not None else model.objects.all()
+            found = dict(
+                (str(pancake_id), pk) for pancake_id, pk in
+                queryset.filter(pancake_id__in=missing).values_list('pancake_id', 'pk')
+            )
+            for pancake_id in missing:
+                pk = found.get(str(pancake_id))
+                if pk is not None:
+                    self._store(self._key(model, pancake_id), pk)
+                    resolved[pancake_id] = pk
+
+        return {pancake_id: model(pk=pk, pancake_id=pancake_id) for pancake_id, pk in resolved.items()}
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> Dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hit_rate, 4),
+            'size': len(self._entries),
+            'evictions': self.evictions,
+        }
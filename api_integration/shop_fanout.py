@@ -0,0 +1,205 @@
+"""
+Fan-out sync theo shop bằng Celery chord.
+
+Task tổng (sync_orders_task, sync_all_products, sync_all_customers_*) chỉ tạo
+SyncHistory rồi dispatch mỗi shop thành một subtask trong group; chord callback
+gộp kết quả của các shop vào SyncHistory. Với N worker, thời gian sync xấp xỉ
+shop chậm nhất thay vì tổng các shop.
+
+Kết quả của subtask là dict (JSON serializer) gồm các field int/list của result
+dataclass (OrderSyncResult, ProductSyncResult, CustomerSyncResult). Subtask luôn
+trả về kết quả kể cả khi lỗi để chord callback không bị ChordError.
+"""
+import logging
+from dataclasses import fields
+from typing import Callable, Dict, List, Optional
+
+from celery import chord, group
+from django.conf import settings
+
+from shops.models import Shop
+
+from .sync_checkpoints import SyncCheckpointTracker
+from .sync_events import publish_sync_event
+from .sync_locks import LOCK_COALESCE, LOCK_QUEUE, ShopSyncLock, default_lock_policy
+from .task_budget import TaskTimeBudget, replace_with_continuation
+
+logger = logging.getLogger(__name__)
+
+
+def _is_count(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def shop_payload(shop_id: int, shop: Optional[Shop] = None, result=None, **extra) -> Dict:
+    """Dict hoá result dataclass của một shop (bỏ các field không phải số đếm/errors)"""
+    payload = {'shop_id': shop_id, 'shop_name': shop.name if shop else None, 'errors': []}
+    if result is not None:
+        for f in fields(result):
+            value = getattr(result, f.name)
+            if f.name == 'errors':
+                payload['errors'] = list(value or [])
+            elif _is_count(value):
+                payload[f.name] = value
+    payload.update(extra)
+    return payload
+
+
+def merge_payload(payload: Dict, carry: Optional[Dict]) -> Dict:
+    """Cộng kết quả của các lần chạy trước (task tiếp nối) vào payload"""
+    if not carry:
+        return payload
+    for key, value in carry.items():
+        if key == 'errors':
+            payload['errors'] = list(value or []) + payload.get('errors', [])
+        elif key != 'shop_id' and _is_count(value):
+            payload[key] = payload.get(key, 0) + value
+    return payload
+
+
+def aggregate_shop_payloads(total_result, payloads: List[Dict]):
+    """Gộp kết quả các shop vào result dataclass tổng"""
+    for payload in payloads:
+        if not payload:
+            continue
+        for f in fields(total_result):
+            if f.name == 'errors':
+                total_result.errors.extend(payload.get('errors') or [])
+            elif _is_count(getattr(total_result, f.name)):
+                setattr(total_result, f.name, getattr(total_result, f.name) + payload.get(f.name, 0))
+    return total_result
+
+
+def _publish_shop_event(event: str, run_id: str, entity: str, payload: Dict):
+    """Event kết thúc (hoặc tạm dừng) của một shop cho SSE stream"""
+    publish_sync_event(
+        event,
+        entity=entity,
+        run_id=run_id,
+        shop_id=payload['shop_id'],
+        shop_name=payload['shop_name'],
+        errors=len(payload['errors']),
+        counts={key: value for key, value in payload.items() if _is_count(value) and key != 'shop_id'},
+    )
+
+
+def _locked_payload(shop_id: int, shop: Shop, entity: str, lock_policy: str,
+                    holder: Optional[Dict], carry: Optional[Dict]) -> Dict:
+    """Kết quả của shop không sync được vì run khác đang giữ lock (skip / coalesce)"""
+    holder_run = holder['run_id'] if holder else None
+    if lock_policy == LOCK_COALESCE:
+        logger.info(f"Shop {shop.name} {entity} sync coalesced into running run {holder_run}")
+        return merge_payload(shop_payload(shop_id, shop, coalesced_into=holder_run), carry)
+
+    logger.warning(f"Shop {shop.name} {entity} sync skipped: locked by run {holder_run}")
+    payload = merge_payload(shop_payload(shop_id, shop, skipped=True), carry)
+    payload['errors'].append(f"Shop {shop.name} skipped: {entity} sync already running (run {holder_run})")
+    return payload
+
+
+def run_shop_sync(task, shop_id: int, run_id: str, entity: str,
+                  sync_shop: Callable, on_completed: Callable = None, carry: Optional[Dict] = None,
+                  lock_policy: Optional[str] = None, lock_owner: Optional[str] = None) -> Dict:
+    """
+    Khung chung của subtask một shop.
+
+    - Bỏ qua shop đã xong trong run (checkpoint completed)
+    - Giữ lock (shop, entity) trong lúc sync, owner là lock_owner (mặc định run_id; window backfill
+      truyền run_id của cả backfill để các window cùng giữ lock); run khác đang giữ lock thì xử lý
+      theo lock_policy (mặc định PANCAKE_SYNC_LOCK_POLICY): queue retry subtask (giữ chỗ
+      trong chord), hết lượt retry thì skip như policy skip
+    - sync_shop(shop, checkpoint, budget) trả về result dataclass
+    - Bị interrupted (sắp hết soft time limit): thay task bằng task tiếp nối, giữ chỗ trong chord,
+      mang theo kết quả đã làm (carry) và giữ lock cho task tiếp nối
+    - Mất lock giữa chừng: dừng trước trang kế tiếp, không gọi on_completed; task tiếp nối phải
+      lấy lại lock nên xử lý theo lock_policy nếu run khác đang giữ
+    - Xong: gọi on_completed(shop, checkpoint, result) (watermark) rồi đánh dấu checkpoint completed
+    """
+    budget = TaskTimeBudget()
+    lock_policy = lock_policy or default_lock_policy()
+    shop = None
+    lock = None
+    result = None
+    try:
+        shop = Shop.objects.get(id=shop_id)
+        checkpoint = SyncCheckpointTracker(run_id, shop, entity)
+        if checkpoint.completed:
+            logger.info(f"Shop {shop.name} already synced {entity} in run {run_id}, skipping")
+            return merge_payload(shop_payload(shop_id, shop, skipped=True), carry)
+
+        lock = ShopSyncLock(shop, entity, owner=lock_owner or run_id, holder=run_id,
+                            task_id=task.request.id, hostname=task.request.hostname)
+        # Mất lock (lease hết hạn, run khác đã lấy): dừng trước trang kế tiếp như hết giờ
+        budget.stop_when = lambda: lock.lost
+        if lock.acquire():
+            try:
+                result = sync_shop(shop, checkpoint, budget)
+                payload = merge_payload(shop_payload(shop_id, shop, result), carry)
+                if lock.lost:
+                    logger.warning(f"Shop {shop.name} {entity} sync lost its lock in run {run_id}, "
+                                   f"stopped without advancing the watermark")
+                    result.interrupted = True
+
+                if not result.interrupted:
+                    if on_completed:
+                        on_completed(shop, checkpoint, result)
+                    checkpoint.mark_completed()
+            finally:
+                if result is not None and result.interrupted:
+                    lock.suspend()
+                else:
+                    lock.release()
+        else:
+            holder = lock.holder()
+            max_retries = getattr(settings, 'PANCAKE_SYNC_LOCK_MAX_RETRIES', 12)
+            if lock_policy != LOCK_QUEUE or task.request.retries >= max_retries:
+                payload = _locked_payload(shop_id, shop, entity, lock_policy, holder, carry)
+                _publish_shop_event('shop_skipped', run_id, entity, payload)
+                return payload
+    except Exception as e:
+        error_msg = f"Error processing shop {shop.name if shop else shop_id}: {str(e)}"
+        logger.error(error_msg, exc_info=True)
+        payload = merge_payload(shop_payload(shop_id, shop), carry)
+        payload['errors'].append(error_msg)
+        _publish_shop_event('shop_failed', run_id, entity, payload)
+        return payload
+
+    # Nằm ngoài try: retry() raise Retry, replace() raise Ignore để kết thúc task hiện tại
+    if result is None:
+        delay = getattr(settings, 'PANCAKE_SYNC_LOCK_RETRY_DELAY', 60)
+        logger.info(f"Shop {shop.name} {entity} sync locked by run {holder['run_id'] if holder else None}, "
+                    f"queued behind it (retry in {delay}s)")
+        raise task.retry(countdown=delay, max_retries=max_retries)
+
+    if result.interrupted:
+        _publish_shop_event('shop_interrupted', run_id, entity, payload)
+        return replace_with_continuation(task, carry=payload)
+
+    _publish_shop_event('shop_completed', run_id, entity, payload)
+    return payload
+
+
+def dispatch_chord(signatures: List, callback, callback_kwargs: Dict):
+    """Dispatch group các subtask, callback nhận list kết quả theo thứ tự subtask"""
+    result = chord(group(signatures))(callback.s(**callback_kwargs))
+    logger.info(f"Dispatched {len(signatures)} subtasks, callback {callback.name} ({result.id})")
+    return result
+
+
+def shop_chord(shop_task, callback, shop_ids: List[int], callback_kwargs: Dict, **shop_kwargs):
+    """
+    Chord group subtask theo shop -> callback (nhận list kết quả các shop), chưa dispatch:
+    apply_async() khi chạy độc lập, task.replace() khi là stage của pipeline
+    """
+    logger.info(f"Fanning out {shop_task.name} to {len(shop_ids)} shops, callback {callback.name}")
+    return chord(group([shop_task.s(shop_id=shop_id, **shop_kwargs) for shop_id in shop_ids]),
+                 callback.s(**callback_kwargs))
+
+
+def is_pipeline_stage(task) -> bool:
+    """
+    Task đang chạy như một stage của sync pipeline: còn task phía sau trong chain
+    hoặc nằm trong header của chord. Khi đó task dispatch phải replace() bằng chord
+    các shop thay vì dispatch rồi return, để stage sau chỉ chạy khi chord callback xong.
+    """
+    return bool(task.request.chain or task.request.chord)
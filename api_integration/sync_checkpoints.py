@@ -0,0 +1,110 @@
+"""
+Checkpoint để resume sync khi task bị kill (time limit) hoặc redeliver (acks_late).
+
+Mỗi run (Celery task id) có một checkpoint cho từng (shop, entity), được ghi
+sau khi một trang đã commit. Khi task chạy lại với cùng run_id, shop đã xong
+được bỏ qua và shop đang dở tiếp tục từ trang kế tiếp.
+"""
+import logging
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from django.utils import timezone
+
+from shops.models import Shop, SyncCheckpoint
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_RETENTION_DAYS = 7
+
+
+def resolve_run_id(task, run_id: Optional[str] = None) -> str:
+    """run_id của lần sync: truyền vào (continuation) > Celery task id > uuid mới"""
+    return run_id or getattr(task.request, 'id', None) or uuid.uuid4().hex
+
+
+class SyncCheckpointTracker:
+    """Đọc/ghi checkpoint của một (run, shop, entity)"""
+
+    def __init__(self, run_id: str, shop: Shop, entity: str):
+        self.checkpoint, created = SyncCheckpoint.objects.get_or_create(
+            run_id=run_id, shop=shop, entity=entity
+        )
+        # Số lỗi và max updated_at từ các lần chạy trước của cùng run
+        self.base_error_count = self.checkpoint.error_count
+        self.previous_watermark = self.checkpoint.watermark
+        # Trang lỗi đầu tiên của lần chạy hiện tại; last_page không tiến qua trang này
+        self.failed_page: Optional[int] = None
+
+        if not created and not self.checkpoint.completed and self.checkpoint.last_page:
+            logger.info(f"Resuming {entity} sync for shop {shop.name} (run {run_id}) "
+                        f"from page {self.checkpoint.last_page + 1}")
+
+    @property
+    def run_id(self) -> str:
+        return self.checkpoint.run_id
+
+    @property
+    def completed(self) -> bool:
+        return self.checkpoint.completed
+
+    @property
+    def start_page(self) -> int:
+        return self.checkpoint.last_page + 1
+
+    @property
+    def started_at(self) -> datetime:
+        """Thời điểm run bắt đầu xử lý shop này (lần chạy đầu tiên)"""
+        return self.checkpoint.created_at
+
+    @property
+    def params(self) -> Dict:
+        return self.checkpoint.params
+
+    @property
+    def had_previous_errors(self) -> bool:
+        return self.base_error_count > 0
+
+    def save_params(self, params: Dict):
+        self.checkpoint.params = params
+        self.checkpoint.save(update_fields=['params', 'updated_at'])
+
+    def page_committed(self, page: int, max_updated_at: Optional[datetime] = None, error_count: int = 0):
+        """
+        Ghi nhận trang đã commit; error_count là số lỗi trong lần chạy hiện tại.
+        Sau một trang lỗi (page_failed), last_page giữ nguyên để lần resume xử lý lại từ trang đó
+        """
+        if self.failed_page is None:
+            self.checkpoint.last_page = page
+        self.checkpoint.error_count = self.base_error_count + error_count
+        if max_updated_at and (self.checkpoint.watermark is None or max_updated_at > self.checkpoint.watermark):
+            self.checkpoint.watermark = max_updated_at
+        self.checkpoint.save(update_fields=['last_page', 'error_count', 'watermark', 'updated_at'])
+
+    def page_failed(self, page: int, error_count: int = 0):
+        """Trang fetch/ghi lỗi (chưa commit): không tiến checkpoint qua trang này"""
+        if self.failed_page is None:
+            self.failed_page = page
+            logger.info(f"Checkpoint of run {self.run_id} stays at page {self.checkpoint.last_page}: "
+                        f"page {page} failed")
+        self.checkpoint.error_count = self.base_error_count + error_count
+        self.checkpoint.save(update_fields=['error_count', 'updated_at'])
+
+    def merged_watermark(self, max_updated_at: Optional[datetime]) -> Optional[datetime]:
+        """Max updated_at của cả run (gồm các lần chạy trước khi resume)"""
+        candidates = [v for v in (self.previous_watermark, max_updated_at) if v]
+        return max(candidates) if candidates else None
+
+    def mark_completed(self):
+        self.checkpoint.completed = True
+        self.checkpoint.save(update_fields=['completed', 'updated_at'])
+
+
+def cleanup_old_checkpoints(days: int = CHECKPOINT_RETENTION_DAYS) -> int:
+    """Xoá checkpoint cũ hơn N ngày"""
+    cutoff = timezone.now() - timedelta(days=days)
+    deleted_count = SyncCheckpoint.objects.filter(updated_at__lt=cutoff).delete()[0]
+    if deleted_count:
+        logger.info(f"Cleaned up {deleted_count} old sync checkpoints")
+    return deleted_count
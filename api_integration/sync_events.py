@@ -0,0 +1,171 @@
+"""
+Kênh sự kiện tiến độ sync realtime qua Redis pub/sub, đọc bởi SSE endpoint (sync/events/).
+
+Engine publish sự kiện theo trang (shop, page/total_pages, rows/s, errors), theo shop
+(completed / interrupted / failed) và khi một run kết thúc. Publish là fire-and-forget:
+Redis lỗi thì tạm bỏ qua 60s thay vì làm hỏng sync; không ai subscribe thì PUBLISH
+gần như không tốn gì.
+
+SSE endpoint là async view: phải chạy qua ASGI (NhaLuaWebApp/asgi.py) để mỗi kết nối
+chỉ là một coroutine chờ Redis, không giữ một worker thread và không query DB.
+"""
+import json
+import logging
+import time
+from typing import AsyncIterator, Dict, Optional
+
+import redis
+import redis.asyncio as aioredis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHANNEL = 'pancake:sync:events'
+
+# Gửi comment keepalive khi không có event để proxy không cắt kết nối
+HEARTBEAT_SECONDS = 15
+
+
+def _redis_url() -> str:
+    return getattr(settings, 'PANCAKE_SYNC_EVENTS_REDIS_URL', None) or settings.CELERY_BROKER_URL
+
+
+def _channel() -> str:
+    return getattr(settings, 'PANCAKE_SYNC_EVENTS_CHANNEL', DEFAULT_CHANNEL)
+
+
+class SyncEventPublisher:
+    """Publish event JSON lên channel Redis; lỗi Redis không bao giờ lan ra sync"""
+
+    def __init__(self, redis_url: str = None, channel: str = None):
+        self.redis_url = redis_url or _redis_url()
+        self.channel = channel or _channel()
+        self._redis = None
+        self._redis_failed_at = 0.0
+
+    def _client(self) -> Optional[redis.Redis]:
+        if self._redis is None:
+            if time.time() - self._redis_failed_at < 60:
+                return None
+            self._redis = redis.Redis.from_url(self.redis_url, socket_timeout=2, socket_connect_timeout=2)
+        return self._redis
+
+    def publish(self, event: str, **data):
+        client = self._client()
+        if client is None:
+            return
+        payload = {'event': event, 'ts': time.time(), **data}
+        try:
+            client.publish(self.channel, json.dumps(payload, default=str))
+        except redis.RedisError as e:
+            logger.warning(f"Sync event channel unavailable, dropping events for 60s: {e}")
+            self._redis = None
+            self._redis_failed_at = time.time()
+
+
+_publisher: Optional[SyncEventPublisher] = None
+
+
+def publish_sync_event(event: str, **data):
+    """Publish một event tiến độ (page, shop_completed, run_finished...)"""
+    global _publisher
+    if _publisher is None:
+        _publisher = SyncEventPublisher()
+    _publisher.publish(event, **data)
+
+
+class ShopSyncEvents:
+    """Event theo trang của một (run, shop, entity), rows/s tính từ lúc shop bắt đầu"""
+
+    def __init__(self, entity: str, shop, run_id: Optional[str] = None):
+        self.entity = entity
+        self.shop = shop
+        self.run_id = run_id
+        self.started = time.monotonic()
+        self.rows = 0
+
+    def page_done(self, fetched, errors: int = 0):
+        """Gọi sau khi một trang (PageFetch) đã xử lý xong"""
+        data = fetched.data or {}
+        rows = len(data.get('data') or [])
+        self.rows += rows
+        elapsed = max(time.monotonic() - self.started, 1e-3)
+        publish_sync_event(
+            'page',
+            entity=self.entity,
+            run_id=self.run_id,
+            shop_id=self.shop.id,
+            shop_name=self.shop.name,
+            page=fetched.page,
+            total_pages=data.get('total_pages') or fetched.total_pages,
+            rows=rows,
+            rows_total=self.rows,
+            rows_per_second=round(self.rows / elapsed, 1),
+            errors=errors,
+        )
+
+
+def event_matches(event: Dict, run_id: str = None, entity: str = None, shop_id: str = None) -> bool:
+    """Lọc event theo run (gồm run con "<run_id>:<window>" của backfill), entity, shop"""
+    if run_id:
+        event_run = event.get('run_id') or ''
+        if event_run != run_id and not event_run.startswith(f"{run_id}:"):
+            return False
+    if entity and event.get('entity') != entity:
+        return False
+    if shop_id and str(event.get('shop_id')) != str(shop_id):
+        return False
+    return True
+
+
+async def open_sse_stream(run_id: str = None, entity: str = None, shop_id: str = None,
+                          heartbeat: int = HEARTBEAT_SECONDS) -> AsyncIterator[str]:
+    """
+    Subscribe channel ngay (Redis lỗi thì raise redis.RedisError ở đây, trước khi view trả
+    response) rồi trả iterator SSE đã gắn sẵn subscription
+    """
+    client = aioredis.Redis.from_url(_redis_url(), socket_connect_timeout=2)
+    pubsub = client.pubsub()
+    try:
+        await pubsub.subscribe(_channel())
+    except BaseException:
+        await pubsub.aclose()
+        await client.aclose()
+        raise
+    return iter_sse_events(client, pubsub, run_id, entity, shop_id, heartbeat)
+
+
+async def iter_sse_events(client, pubsub, run_id: str = None, entity: str = None, shop_id: str = None,
+                          heartbeat: int = HEARTBEAT_SECONDS) -> AsyncIterator[str]:
+    """Yield event dạng SSE cho tới khi client ngắt kết nối hoặc mất Redis"""
+    try:
+        # Client tự kết nối lại sau 5s nếu stream bị cắt
+        yield 'retry: 5000\n\n'
+        last_sent = time.monotonic()
+        while True:
+            try:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=heartbeat)
+            except redis.RedisError as e:
+                # Kết thúc stream; client kết nối lại và nhận 503 nếu Redis vẫn lỗi
+                logger.warning(f"Sync event channel lost, closing SSE stream: {e}")
+                yield f"event: stream_error\ndata: {json.dumps({'error': str(e)})}\n\n"
+                return
+            if message is not None:
+                try:
+                    event = json.loads(message['data'])
+                except (TypeError, ValueError):
+                    continue
+                if event_matches(event, run_id, entity, shop_id):
+                    yield f"event: {event.get('event', 'message')}\ndata: {json.dumps(event)}\n\n"
+                    last_sent = time.monotonic()
+                    continue
+            if time.monotonic() - last_sent >= heartbeat:
+                yield ': keepalive\n\n'
+                last_sent = time.monotonic()
+    finally:
+        try:
+            await pubsub.unsubscribe()
+        except redis.RedisError:
+            pass
+        await pubsub.aclose()
+        await client.aclose()
@@ -0,0 +1,215 @@
+"""
+Lease lock trên Redis theo (shop, entity) để hai run không sync cùng một shop cùng lúc.
+
+Hourly sync_orders_daily, POST thủ công và sync_single_shop_orders có thể chạy chồng lên
+nhau: cùng fetch lại các trang và tranh nhau ghi (upsert, xoá/ghi lại history). Subtask
+của một shop giữ lock trong lúc sync:
+
+- Lock là một hash Redis có TTL (lease); thread heartbeat gia hạn mỗi ttl/3 nên worker
+  chết thì lock tự hết hạn sau tối đa ttl giây
+- Owner là run_id: task tiếp nối (continuation) và task redeliver của cùng run vào lại
+  được lock mà run đó đang giữ
+- Các window backfill của cùng shop dùng chung lock (shop, 'orders') của run backfill,
+  mỗi window là một holder (field "holder:<window run_id>"); lock chỉ được xoá khi holder
+  cuối cùng release, nên incremental/repair không chạy chồng lên backfill của shop đó
+- Run khác gặp shop đang bị khoá xử lý theo policy (LOCK_POLICIES): skip, queue (retry
+  sau, giữ chỗ trong chord) hoặc coalesce (coi như run đang giữ lock sẽ lấy giúp dữ liệu)
+- Redis lỗi thì sync vẫn chạy không lock (fail open), giống kênh sự kiện tiến độ
+"""
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
+
+import redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'pancake:sync:lock'
+
+LOCK_SKIP = 'skip'          # Bỏ qua shop, ghi lỗi vào kết quả run
+LOCK_QUEUE = 'queue'        # Retry subtask sau PANCAKE_SYNC_LOCK_RETRY_DELAY giây
+LOCK_COALESCE = 'coalesce'  # Gộp vào run đang giữ lock, không tính là lỗi
+LOCK_POLICIES = (LOCK_SKIP, LOCK_QUEUE, LOCK_COALESCE)
+
+HOLDER_PREFIX = 'holder:'
+
+# Tạo mới hoặc vào lại lock của cùng owner; ARGV: owner, ttl, holder field, heartbeat_at,
+# các cặp field/value (chỉ ghi khi tạo mới)
+_ACQUIRE_SCRIPT = """
+local owner = redis.call('HGET', KEYS[1], 'owner')
+if owner and owner ~= ARGV[1] then
+    return 0
+end
+if not owner then
+    redis.call('HSET', KEYS[1], unpack(ARGV, 5))
+end
+redis.call('HSET', KEYS[1], ARGV[3], '1', 'heartbeat_at', ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# Gia hạn lease nếu vẫn là owner; ARGV: owner, ttl, heartbeat_at
+_RENEW_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'owner') == ARGV[1] then
+    redis.call('HSET', KEYS[1], 'heartbeat_at', ARGV[3])
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Bỏ holder; xoá lock khi không còn holder nào; ARGV: owner, holder field, HOLDER_PREFIX
+_RELEASE_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'owner') ~= ARGV[1] then
+    return 0
+end
+redis.call('HDEL', KEYS[1], ARGV[2])
+for _, field in ipairs(redis.call('HKEYS', KEYS[1])) do
+    if string.sub(field, 1, string.len(ARGV[3])) == ARGV[3] then
+        return 1
+    end
+end
+redis.call('DEL', KEYS[1])
+return 1
+"""
+
+_redis: Optional[redis.Redis] = None
+
+
+def _client() -> redis.Redis:
+    global _redis
+    if _redis is None:
+        url = getattr(settings, 'PANCAKE_SYNC_LOCK_REDIS_URL', None) or settings.CELERY_BROKER_URL
+        _redis = redis.Redis.from_url(url, socket_timeout=5, socket_connect_timeout=5, decode_responses=True)
+    return _redis
+
+
+def lock_key(shop_id: int, scope: str) -> str:
+    return f"{KEY_PREFIX}:{scope}:{shop_id}"
+
+
+def default_lock_policy() -> str:
+    return getattr(settings, 'PANCAKE_SYNC_LOCK_POLICY', LOCK_QUEUE)
+
+
+class ShopSyncLock:
+    """
+    Lease lock của một (shop, scope); scope là entity ('orders', 'products'...).
+    holder: token của phần việc đang giữ lock trong run của owner (mặc định = owner),
+    vd run_id của từng window backfill
+    """
+
+    def __init__(self, shop, scope: str, owner: str, holder: Optional[str] = None, task_id: Optional[str] = None,
+                 hostname: Optional[str] = None, ttl: Optional[int] = None):
+        self.shop = shop
+        self.scope = scope
+        self.owner = owner
+        self.holder_field = f"{HOLDER_PREFIX}{holder or owner}"
+        self.task_id = task_id or ''
+        self.hostname = hostname or ''
+        self.ttl = ttl or getattr(settings, 'PANCAKE_SYNC_LOCK_TTL', 10 * 60)
+        self.key = lock_key(shop.id, scope)
+        self.held = False
+        self.lost = False  # Lease hết hạn hoặc bị run khác lấy trong lúc đang sync
+        self._stop = threading.Event()
+        self._heartbeat: Optional[threading.Thread] = None
+
+    def acquire(self) -> bool:
+        """True nếu giữ được lock (hoặc Redis lỗi: chạy không lock); bắt đầu heartbeat"""
+        now = str(time.time())
+        fields = {
+            'owner': self.owner, 'task_id': self.task_id, 'hostname': self.hostname,
+            'shop_id': self.shop.id, 'shop_name': self.shop.name, 'scope': self.scope,
+            'acquired_at': now, 'heartbeat_at': now,
+        }
+        args = [self.owner, self.ttl, self.holder_field, now]
+        for field, value in fields.items():
+            args += [field, value]
+        try:
+            acquired = bool(_client().eval(_ACQUIRE_SCRIPT, 1, self.key, *args))
+        except redis.RedisError as e:
+            logger.warning(f"Sync lock unavailable for {self.key}, continuing without lock: {e}")
+            return True
+
+        if acquired:
+            self.held = True
+            self._stop.clear()
+            self._heartbeat = threading.Thread(target=self._renew_loop, name=f"lock-heartbeat:{self.key}",
+                                               daemon=True)
+            self._heartbeat.start()
+        return acquired
+
+    def _renew_loop(self):
+        interval = max(self.ttl / 3, 1)
+        while not self._stop.wait(interval):
+            try:
+                renewed = _client().eval(_RENEW_SCRIPT, 1, self.key, self.owner, self.ttl, str(time.time()))
+            except redis.RedisError as e:
+                logger.warning(f"Could not renew sync lock {self.key}: {e}")
+                continue
+            if not renewed:
+                self.lost = True
+                logger.warning(f"Sync lock {self.key} lost by run {self.owner}")
+                return
+
+    def _stop_heartbeat(self):
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join(timeout=5)
+            self._heartbeat = None
+
+    def release(self):
+        """Dừng heartbeat, bỏ holder này và xoá lock khi không còn holder nào của owner"""
+        self._stop_heartbeat()
+        if not self.held:
+            return
+        self.held = False
+        try:
+            _client().eval(_RELEASE_SCRIPT, 1, self.key, self.owner, self.holder_field, HOLDER_PREFIX)
+        except redis.RedisError as e:
+            logger.warning(f"Could not release sync lock {self.key}, it expires in {self.ttl}s: {e}")
+
+    def suspend(self):
+        """
+        Dừng heartbeat nhưng giữ lock cho task tiếp nối của cùng run;
+        task tiếp nối không chạy trong ttl giây thì lock tự hết hạn
+        """
+        self._stop_heartbeat()
+        self.held = False
+
+    def holder(self) -> Optional[Dict]:
+        try:
+            return _decode_holder(self.key, _client().hgetall(self.key), _client().ttl(self.key))
+        except redis.RedisError:
+            return None
+
+
+def _decode_holder(key: str, data: Dict, ttl: int) -> Optional[Dict]:
+    if not data:
+        return None
+    return {
+        'key': key,
+        'run_id': data.get('owner'),
+        'task_id': data.get('task_id') or None,
+        'hostname': data.get('hostname') or None,
+        'shop_id': int(data['shop_id']) if data.get('shop_id') else None,
+        'shop_name': data.get('shop_name'),
+        'scope': data.get('scope'),
+        'acquired_at': float(data['acquired_at']) if data.get('acquired_at') else None,
+        'heartbeat_at': float(data['heartbeat_at']) if data.get('heartbeat_at') else None,
+        'holders': sum(1 for field in data if field.startswith(HOLDER_PREFIX)),
+        'expires_in': ttl if ttl and ttl > 0 else None,
+    }
+
+
+def list_sync_locks(scope: Optional[str] = None) -> List[Dict]:
+    """Các lock đang được giữ (lọc theo scope, vd 'orders')"""
+    client = _client()
+    pattern = f"{KEY_PREFIX}:{scope}:*" if scope else f"{KEY_PREFIX}:*"
+    holders = []
+    for key in client.scan_iter(match=pattern, count=500):
+        holder = _decode_holder(key, client.hgetall(key), client.ttl(key))
+        if holder:
+            holders.append(holder)
+    return sorted(holders, key=lambda h: h['acquired_at'] or 0)
@@ -0,0 +1,123 @@
+"""
+Tiến độ sync cho web UI (polling endpoint sync/progress/<task_id>/).
+
+- Task chạy trọn trong một worker (sync_shops_task, sync_categories_task) báo tiến độ
+  qua update_state(state='PROGRESS', meta={...}) sau mỗi bước.
+- Task fan-out (products, customers, orders) kết thúc ngay sau khi dispatch chord và trả về
+  sync_history_id + run_id; tiến độ thật đọc từ SyncHistory (chord callback cập nhật khi xong)
+  và SyncCheckpoint của run (mỗi shop/window một checkpoint, ghi sau mỗi trang đã commit).
+"""
+import logging
+from typing import Dict, Optional
+
+from celery.result import AsyncResult
+from django.db.models import Count, Q, Sum
+
+from shops.models import SyncCheckpoint, SyncHistory
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_STATE = 'PROGRESS'
+
+
+def report_progress(task, current: int, total: int, message: str = '', **extra):
+    """update_state PROGRESS cho task đang chạy qua worker; bỏ qua khi hàm task được gọi trực tiếp"""
+    if not getattr(task.request, 'id', None):
+        return
+    meta = {'current': current, 'total': total, 'message': message}
+    meta.update(extra)
+    task.update_state(state=PROGRESS_STATE, meta=meta)
+
+
+def _percent(current: int, total: Optional[int]) -> Optional[int]:
+    if not total:
+        return None
+    return max(0, min(100, int(current * 100 / total)))
+
+
+def _dispatch_info(payload: Dict) -> Dict:
+    """sync_history_id, run_id và số subtask từ kết quả của task dispatch (có thể nằm trong 'data')"""
+    data = payload.get('data') if isinstance(payload.get('data'), dict) else {}
+    merged = {**data, **payload}
+    return {
+        'sync_history_id': merged.get('sync_history_id'),
+        'run_id': merged.get('run_id'),
+        'total': merged.get('windows') or merged.get('shops_dispatched') or merged.get('total_shops') or 0,
+    }
+
+
+def _run_progress(progress: Dict, sync_history_id: int, run_id: Optional[str], total: int) -> Dict:
+    """Tiến độ của một run fan-out theo SyncHistory + checkpoint các shop/window"""
+    history = SyncHistory.objects.filter(id=sync_history_id).first()
+    if history is None:
+        progress.update(status='failed', finished=True, message='Không tìm thấy lịch sử đồng bộ')
+        return progress
+
+    completed = pages = 0
+    if run_id:
+        # Backfill: checkpoint của mỗi window có run_id "<run_id>:<start>-<end>"
+        stats = SyncCheckpoint.objects.filter(
+            Q(run_id=run_id) | Q(run_id__startswith=f"{run_id}:")
+        ).aggregate(completed=Count('id', filter=Q(completed=True)), pages=Sum('last_page'))
+        completed, pages = stats['completed'] or 0, stats['pages'] or 0
+
+    finished = history.status != 'running'
+    progress.update({
+        'status': history.status if finished else 'running',
+        'finished': finished,
+        'percent': 100 if finished else min(99, _percent(completed, total) or 0),
+        'current': completed,
+        'total': total,
+        'pages_committed': pages,
+        'sync_history': {
+            'id': history.id,
+            'status': history.status,
+            'created_records': history.created_records,
+            'updated_records': history.updated_records,
+            'failed_records': history.failed_records,
+            'error_message': history.error_message,
+            'started_at': history.started_at.isoformat() if history.started_at else None,
+            'finished_at': history.finished_at.isoformat() if history.finished_at else None,
+        },
+    })
+    progress['message'] = (
+        (history.error_message or 'Đồng bộ hoàn tất') if finished
+        else f'Đã xong {completed}/{total} phần, {pages} trang đã lưu'
+    )
+    return progress
+
+
+def get_sync_progress(task_id: str) -> Dict:
+    """Trạng thái của task sync (task_id trả về khi enqueue) dạng dict cho JsonResponse"""
+    result = AsyncResult(task_id)
+    state = result.state
+    progress = {
+        'task_id': task_id,
+        'state': state,
+        'status': 'queued',
+        'finished': False,
+        'percent': 0,
+        'message': 'Đang chờ worker nhận task',
+    }
+
+    if state == PROGRESS_STATE:
+        meta = result.info if isinstance(result.info, dict) else {}
+        progress.update(meta)
+        progress.update(status='running', percent=_percent(meta.get('current', 0), meta.get('total')))
+    elif state in ('STARTED', 'RETRY'):
+        progress.update(status='running', percent=None, message='Đang đồng bộ')
+    elif state == 'FAILURE':
+        progress.update(status='failed', finished=True, percent=100, message=str(result.info))
+    elif state == 'SUCCESS':
+        payload = result.result if isinstance(result.result, dict) else {}
+        info = _dispatch_info(payload)
+        if info['sync_history_id']:
+            return _run_progress(progress, info['sync_history_id'], info['run_id'], info['total'])
+        progress.update(
+            status='completed' if payload.get('success', True) else 'completed_with_errors',
+            finished=True,
+            percent=100,
+            message=payload.get('message') or 'Đồng bộ hoàn tất',
+            result=payload,
+        )
+    return progress
@@ -0,0 +1,60 @@
+"""
+Watermark cho sync incremental theo shop + entity (orders, customers).
+
+Watermark = max updated_at đã ghi thành công. Lần sync sau chỉ fetch từ
+watermark - overlap, phần overlap để không bỏ sót bản ghi cập nhật sát mốc
+hoặc lệch đồng hồ giữa Pancake và server.
+"""
+import logging
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from shops.models import Shop, SyncWatermark
+
+logger = logging.getLogger(__name__)
+
+WATERMARK_OVERLAP = timedelta(minutes=getattr(settings, 'PANCAKE_SYNC_WATERMARK_OVERLAP_MINUTES', 10))
+
+
+def get_watermark(shop: Shop, entity: str) -> Optional[datetime]:
+    """Watermark hiện tại của shop cho entity, None nếu chưa từng sync incremental"""
+    return SyncWatermark.objects.filter(shop=shop, entity=entity).values_list('watermark', flat=True).first()
+
+
+def get_incremental_start(shop: Shop, entity: str, fallback_start: datetime) -> Tuple[datetime, bool]:
+    """
+    Mốc bắt đầu fetch cho lần sync incremental.
+    Trả về (start, is_incremental); nếu chưa có watermark thì dùng fallback_start (full window).
+    """
+    watermark = get_watermark(shop, entity)
+    if watermark is None:
+        return fallback_start, False
+
+    return watermark - WATERMARK_OVERLAP, True
+
+
+def advance_watermark(shop: Shop, entity: str, value: Optional[datetime]):
+    """Cập nhật watermark, chỉ tiến về phía trước"""
+    now = timezone.now()
+    watermark, created = SyncWatermark.objects.get_or_create(
+        shop=shop, entity=entity,
+        defaults={'watermark': value, 'last_synced_at': now}
+    )
+    if created:
+        logger.info(f"Initialized {entity} watermark for shop {shop.name}: {value}")
+        return
+
+    # Một UPDATE có điều kiện: hai run chồng nhau không thể kéo watermark lùi lại
+    advanced = 0
+    if value is not None:
+        advanced = SyncWatermark.objects.filter(
+            Q(watermark__isnull=True) | Q(watermark__lt=value), pk=watermark.pk
+        ).update(watermark=value, last_synced_at=now, updated_at=now)
+    if advanced:
+        logger.info(f"Advanced {entity} watermark for shop {shop.name}: {watermark.watermark} -> {value}")
+    else:
+        SyncWatermark.objects.filter(pk=watermark.pk).update(last_synced_at=now, updated_at=now)
@@ -0,0 +1,48 @@
+"""
+Giới hạn thời gian cho các sync task chạy dài.
+
+Task theo dõi thời gian đã chạy so với CELERY_TASK_SOFT_TIME_LIMIT; khi sắp hết
+thì dừng sau trang đã commit và thay bằng một task tiếp nối cùng run_id (trang và
+watermark nằm trong SyncCheckpoint) thay vì bị kill.
+"""
+import logging
+import time
+from typing import Callable, Optional
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class TaskTimeBudget:
+    """
+    Deadline của một task = soft time limit - margin, tính từ lúc khởi tạo.
+    stop_when: điều kiện dừng sớm khác (vd mất lock của shop), dừng theo cùng đường với hết giờ
+    """
+
+    def __init__(self, soft_limit: Optional[float] = None, margin: Optional[float] = None,
+                 stop_when: Optional[Callable[[], bool]] = None):
+        soft_limit = soft_limit or getattr(settings, 'CELERY_TASK_SOFT_TIME_LIMIT', 25 * 60)
+        margin = margin if margin is not None else getattr(settings, 'PANCAKE_SYNC_CONTINUATION_MARGIN', 5 * 60)
+        self.started = time.monotonic()
+        self.deadline = self.started + max(soft_limit - margin, 60)
+        self.stop_when = stop_when
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def exhausted(self) -> bool:
+        return time.monotonic() >= self.deadline or bool(self.stop_when and self.stop_when())
+
+
+def replace_with_continuation(task, **overrides):
+    """
+    Thay task hiện tại bằng task tiếp nối cùng args/kwargs (ghi đè bởi overrides).
+    Task tiếp nối giữ id và chỗ của task cũ trong chord/group, nên chord callback
+    chỉ chạy khi nó xong. Luôn raise Ignore.
+    """
+    kwargs = dict(task.request.kwargs or {}, **overrides)
+    logger.info(f"[CONTINUATION] {task.name} ({task.request.id}): approaching soft time limit, "
+                f"continuing in a replacement task")
+    return task.replace(task.s(*(task.request.args or ()), **kwargs))
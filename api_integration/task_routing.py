@@ -0,0 +1,58 @@
+"""
+Route các sync task vào queue riêng theo độ ưu tiên (CELERY_TASK_ROUTES trong settings).
+
+- sync_hot: sync incremental orders/customers (hourly, 3 giờ, sync một shop, web) cần
+  xong nhanh; chạy trên worker riêng nên không phải chờ sau sync catalog ban đêm
+- sync_bulk: shops, categories, products, customers full/reconcile, orders repair,
+  pipeline ban đêm, backfill và cleanup_*
+
+Cùng một task (sync_orders_task, subtask và chord callback của nó) có thể là hot hoặc
+bulk tuỳ kwarg mode, nên route bằng hàm thay vì bảng tên task. Priority chỉ có tác dụng
+trong một queue (Redis: 0 là cao nhất): backfill và cleanup nhường các task bulk khác.
+"""
+from typing import Dict, Optional
+
+HOT_QUEUE = 'sync_hot'
+BULK_QUEUE = 'sync_bulk'
+
+# Khớp PRIORITY_STEPS mặc định của Redis transport (0, 3, 6, 9)
+HOT_PRIORITY = 0
+BULK_PRIORITY = 3
+BACKGROUND_PRIORITY = 6
+
+TASK_PREFIX = 'api_integration.tasks.'
+
+# Hot khi mode là incremental (mặc định khi không truyền mode)
+MODE_ROUTED_TASKS = {
+    'sync_orders_task', 'sync_shop_orders_subtask', 'finalize_orders_sync',
+    'sync_all_customers_30_days', 'sync_shop_customers_subtask', 'finalize_customers_sync',
+}
+
+HOT_TASKS = {
+    'sync_orders_daily', 'sync_single_shop_orders', 'sync_orders_status_check', 'sync_orders_health_check',
+    'sync_single_shop_customers_30_days', 'sync_customer_pipeline',
+}
+
+# Bulk, priority thấp nhất
+BACKGROUND_TASKS = {'sync_orders_backfill', 'sync_orders_window_subtask'}
+
+
+def sync_task_route(name: str, args, kwargs, options, task=None, **kw) -> Optional[Dict]:
+    """Router của Celery: {'queue', 'priority'} cho task trong api_integration.tasks"""
+    if not name.startswith(TASK_PREFIX):
+        return None
+    short_name = name[len(TASK_PREFIX):]
+
+    if short_name in MODE_ROUTED_TASKS:
+        mode = (kwargs or {}).get('mode') or 'incremental'
+        if mode == 'incremental':
+            return {'queue': HOT_QUEUE, 'priority': HOT_PRIORITY}
+        if mode == 'backfill':
+            return {'queue': BULK_QUEUE, 'priority': BACKGROUND_PRIORITY}
+        return {'queue': BULK_QUEUE, 'priority': BULK_PRIORITY}
+
+    if short_name in HOT_TASKS:
+        return {'queue': HOT_QUEUE, 'priority': HOT_PRIORITY}
+    if short_name in BACKGROUND_TASKS or short_name.startswith('cleanup_'):
+        return {'queue': BULK_QUEUE, 'priority': BACKGROUND_PRIORITY}
+    return {'queue': BULK_QUEUE, 'priority': BULK_PRIORITY}
@@ -1,10 +1,11 @@
-from celery import shared_task
+from celery import shared_task, chain, group
+from celery.exceptions import Ignore
 from django.utils import timezone
 from django.conf import settings
 from django.core.mail import send_mail
 from django.template.loader import render_to_string
 import requests
-from typing import List, Dict, Tuple, Optional
+from typing import Callable, List, Dict, Set, Tuple, Optional
 from dataclasses import dataclass
 from shops.models import *
 import logging
@@ -15,6 +16,20 @@ from datetime import datetime
 import pytz
 from django.db import transaction, connection
 import time
+from .pancake_client import get_pancake_client
+from .page_pipeline import iter_prefetched_pages
+from .sync_watermarks import get_incremental_start, advance_watermark
+from .fingerprints import compute_fingerprint, order_history_key, status_history_key
+from .sync_checkpoints import SyncCheckpointTracker, resolve_run_id, cleanup_old_checkpoints
+from .task_budget import TaskTimeBudget
+from .shop_fanout import run_shop_sync, dispatch_chord, shop_chord, is_pipeline_stage, aggregate_shop_payloads
+from .bulk_upsert import bulk_upsert, delete_stale_children
+from .m2m_sync import sync_m2m
+from .ref_cache import RefCache
+from .sync_progress import report_progress
+from .sync_events import ShopSyncEvents, publish_sync_event
+from .sync_locks import LOCK_COALESCE, LOCK_QUEUE, list_sync_locks
+from .order_windows import month_windows, adaptive_windows, probe_total_pages, DEFAULT_BACKFILL_DAYS
 
 VIETNAM_TZ = pytz.timezone('Asia/Ho_Chi_Minh')
 logger = logging.getLogger(__name__)
@@ -89,16 +104,10 @@ def _send_sync_notification(task_name: str, result: dict, is_success: bool = Tru
 # ===== SHOP SYNC FUNCTIONS =====
 def _fetch_shops_data() -> Dict:
     """Fetch shops data from Pancake API"""
-    api_url = f"{settings.PANCAKE_API_BASE_URL}/shops"
-    params = {'api_key': settings.PANCAKE_API_KEY}
-    
     logger.info("Fetching shops data from Pancake API")
     
     try:
-        response = requests.get(api_url, params=params, timeout=30)
-        response.raise_for_status()
-        
-        data = response.json()
+        data = get_pancake_client().get_json("shops", endpoint='shops')
         shops_data = data.get('shops', [])
         logger.info(f"API response: {len(shops_data)} shops received")
         
@@ -107,67 +116,109 @@ def _fetch_shops_data() -> Dict:
         logger.error(f"API request failed: {e}")
         raise
 
-def _sync_single_shop(shop_data: Dict) -> Tuple[Shop, bool, int, int]:
-    """Sync a single shop with its pages and tags"""
+def _sync_shops_bulk(shops_data: List[Dict], result: ShopSyncResult):
+    """
+    Ghi toàn bộ response /shops: mỗi model (Shop, Page, Tag) một bulk upsert,
+    page/tag không còn trong response bị xoá bằng set-diff (một SELECT + một DELETE)
+    """
     vietnam_now = _get_vietnam_time()
-    
-    # Sync Shop
-    shop, shop_created = Shop.objects.update_or_create(
-        pancake_id=shop_data.get('id'),
-        defaults={
-            'name': shop_data.get('name', ''),
-            'currency': shop_data.get('currency', 'VND'),
-            'avatar_url': shop_data.get('avatar_url'),
-            'link_post_marketer': shop_data.get('link_post_marketer', []),
-            'last_sync': vietnam_now,
-        }
+    shops_data = [s for s in shops_data if s.get('id') is not None]
+    
+    # Sync Shops
+    shops_result = bulk_upsert(
+        Shop, [
+            Shop(
+                pancake_id=shop_data['id'],
+                name=shop_data.get('name', ''),
+                currency=shop_data.get('currency', 'VND'),
+                avatar_url=shop_data.get('avatar_url'),
+                link_post_marketer=shop_data.get('link_post_marketer', []),
+                last_sync=vietnam_now,
+            ) for shop_data in shops_data
+        ],
+        unique_fields=['pancake_id'],
+        update_fields=['name', 'currency', 'avatar_url', 'link_post_marketer', 'last_sync']
+    )
+    result.shops_created += shops_result.created
+    result.shops_updated += shops_result.updated
+    shops_map = dict(
+        Shop.objects.filter(pancake_id__in=[s['id'] for s in shops_data]).values_list('pancake_id', 'id')
     )
     
     # Sync Pages
-    pages_synced = 0
-    tags_synced = 0
-    existing_page_ids = []
+    pages = []
+    page_ids_by_shop = {}
+    for shop_data in shops_data:
+        shop_pk = shops_map[shop_data['id']]
+        page_ids_by_shop[shop_pk] = set()
+        for page_data in shop_data.get('pages', []):
+            if page_data.get('id') is None:
+                continue
+            page_ids_by_shop[shop_pk].add(str(page_data['id']))
+            pages.append(Page(
+                shop_id=shop_pk,
+                pancake_id=page_data['id'],
+                name=page_data.get('name', ''),
+                platform=page_data.get('platform', ''),
+                username=page_data.get('username'),
+                is_onboard_xendit=page_data.get('is_onboard_xendit'),
+                progressive_catalog_error=page_data.get('progressive_catalog_error'),
+                settings=page_data.get('settings', {}),
+            ))
+    
+    pages_result = bulk_upsert(
+        Page, pages, unique_fields=['shop', 'pancake_id'],
+        update_fields=['name', 'platform', 'username', 'is_onboard_xendit',
+                       'progressive_catalog_error', 'settings']
+    )
+    result.pages_created += pages_result.created
+    result.pages_updated += pages_result.updated
     
-    for page_data in shop_data.get('pages', []):
-        page, page_created = Page.objects.update_or_create(
-            shop=shop,
-            pancake_id=page_data.get('id'),
-            defaults={
-                'name': page_data.get('name', ''),
-                'platform': page_data.get('platform', ''),
-                'username': page_data.get('username'),
-                'is_onboard_xendit': page_data.get('is_onboard_xendit'),
-                'progressive_catalog_error': page_data.get('progressive_catalog_error'),
-                'settings': page_data.get('settings', {}),
-            }
-        )
-        existing_page_ids.append(page.pancake_id)
-        pages_synced += 1
-        
-        # Sync Tags
-        existing_tag_ids = []
-        for tag_data in page_data.get('tags', []):
-            tag, tag_created = Tag.objects.update_or_create(
-                page=page,
-                pancake_id=tag_data.get('id'),
-                defaults={
-                    'text': tag_data.get('text', ''),
-                    'color': tag_data.get('color', ''),
-                    'lighten_color': tag_data.get('lighten_color', ''),
-                    'description': tag_data.get('description', ''),
-                    'is_lead_event': tag_data.get('is_lead_event', False),
-                }
-            )
-            existing_tag_ids.append(tag.pancake_id)
-            tags_synced += 1
-        
-        # Xóa tags không còn tồn tại
-        page.tags.exclude(pancake_id__in=existing_tag_ids).delete()
+    # Xóa pages không còn tồn tại (tags đi theo cascade)
+    pages_deleted = delete_stale_children(Page, 'shop', page_ids_by_shop)
+    
+    pages_map = {
+        (shop_pk, pancake_id): pk for pk, shop_pk, pancake_id in Page.objects.filter(
+            shop_id__in=page_ids_by_shop
+        ).values_list('id', 'shop_id', 'pancake_id')
+    }
+    
+    # Sync Tags
+    tags = []
+    tag_ids_by_page = {}
+    for shop_data in shops_data:
+        shop_pk = shops_map[shop_data['id']]
+        for page_data in shop_data.get('pages', []):
+            page_pk = pages_map.get((shop_pk, str(page_data.get('id'))))
+            if page_pk is None:
+                continue
+            tag_ids_by_page[page_pk] = set()
+            for tag_data in page_data.get('tags', []):
+                if tag_data.get('id') is None:
+                    continue
+                tag_ids_by_page[page_pk].add(str(tag_data['id']))
+                tags.append(Tag(
+                    page_id=page_pk,
+                    pancake_id=tag_data['id'],
+                    text=tag_data.get('text', ''),
+                    color=tag_data.get('color', ''),
+                    lighten_color=tag_data.get('lighten_color', ''),
+                    description=tag_data.get('description', ''),
+                    is_lead_event=tag_data.get('is_lead_event', False),
+                ))
+    
+    tags_result = bulk_upsert(
+        Tag, tags, unique_fields=['page', 'pancake_id'],
+        update_fields=['text', 'color', 'lighten_color', 'description', 'is_lead_event']
+    )
+    result.tags_created += tags_result.created
+    result.tags_updated += tags_result.updated
     
-    # Xóa pages không còn tồn tại
-    shop.pages.exclude(pancake_id__in=existing_page_ids).delete()
+    # Xóa tags không còn tồn tại
+    tags_deleted = delete_stale_children(Tag, 'page', tag_ids_by_page)
     
-    return shop, shop_created, pages_synced, tags_synced
+    if pages_deleted or tags_deleted:
+        logger.info(f"Deleted {pages_deleted} stale pages, {tags_deleted} stale tags")
 
 def _sync_all_shops() -> ShopSyncResult:
     """Sync all shops from Pancake API"""
@@ -178,33 +229,20 @@ def _sync_all_shops() -> ShopSyncResult:
         shops_data = _fetch_shops_data()
         logger.info(f"Starting sync for {len(shops_data)} shops at {vietnam_start}")
         
-        for i, shop_data in enumerate(shops_data):
-            try:
-                # Sync từng shop riêng biệt để tránh rollback toàn bộ
-                with transaction.atomic():
-                    shop, shop_created, pages_synced, tags_synced = _sync_single_shop(shop_data)
-                    
-                    if shop_created:
-                        result.shops_created += 1
-                    else:
-                        result.shops_updated += 1
-                    
-                    result.pages_created += pages_synced
-                    result.tags_created += tags_synced
-                    
-                    logger.info(f"Synced shop {shop.name}: {pages_synced} pages, {tags_synced} tags")
-                    
-            except Exception as e:
-                error_msg = f"Error syncing shop {i+1}: {str(e)}"
-                logger.error(error_msg, exc_info=True)
-                result.errors.append(error_msg)
-                continue
+        try:
+            with transaction.atomic():
+                _sync_shops_bulk(shops_data, result)
+        except Exception as e:
+            # Rollback toàn bộ response, reset counters của lần ghi dở
+            result = ShopSyncResult(errors=[f"Error syncing {len(shops_data)} shops: {str(e)}"])
+            logger.error(result.errors[0], exc_info=True)
         
         vietnam_end = _get_vietnam_time()
         duration = (vietnam_end - vietnam_start).total_seconds()
         logger.info(f"Shop sync completed in {duration:.2f}s: "
                    f"{result.shops_created + result.shops_updated} shops, "
-                   f"{result.pages_created} pages, {result.tags_created} tags")
+                   f"{result.pages_created + result.pages_updated} pages, "
+                   f"{result.tags_created + result.tags_updated} tags")
         
     except Exception as e:
         error_msg = f"Critical error in shop sync: {str(e)}"
@@ -216,15 +254,12 @@ def _sync_all_shops() -> ShopSyncResult:
 # ===== CATEGORY SYNC FUNCTIONS =====
 def _fetch_categories_for_shop(shop: Shop) -> List[Dict]:
     """Fetch categories for a single shop"""
-    api_url = f"{settings.PANCAKE_API_BASE_URL}/shops/{shop.pancake_id}/categories"
-    params = {'api_key': settings.PANCAKE_API_KEY}
-    
     logger.info(f"Fetching categories for shop {shop.name}")
     
     try:
-        response = requests.get(api_url, params=params, timeout=30)
-        response.raise_for_status()
-        response_data = response.json()
+        response_data = get_pancake_client().get_json(
+            f"shops/{shop.pancake_id}/categories", endpoint='categories'
+        )
         
         if not response_data.get('success', False):
             raise ValueError(f"API returned success=false for shop {shop.name}")
@@ -241,97 +276,87 @@ def _fetch_categories_for_shop(shop: Shop) -> List[Dict]:
         logger.error(f"API error for shop {shop.name}: {e}")
         raise
 
+def _flatten_category_tree(categories_data: List[Dict], parent_id=None, flat: Dict = None) -> Dict:
+    """Duyệt cây categories (nodes lồng nhau) thành {pancake_id: (category_data, parent pancake_id)}"""
+    if flat is None:
+        flat = {}
+    for category_data in categories_data:
+        pancake_id = category_data.get('id')
+        if not pancake_id:
+            continue
+        flat[pancake_id] = (category_data, parent_id)
+        _flatten_category_tree(category_data.get('nodes') or [], pancake_id, flat)
+    return flat
+
 def _sync_categories_for_shop(shop: Shop) -> Tuple[int, int]:
-    """Sync categories for a single shop"""
+    """
+    Sync categories for a single shop:
+    một bulk upsert cho cả cây, một bulk update cho parent, một set-diff delete
+    """
     try:
         categories_data = _fetch_categories_for_shop(shop)
         
         if not categories_data:
             return 0, 0
         
-        existing_category_ids = []
-        category_map = {}
-        created_count = 0
-        updated_count = 0
-        
-        # Lần 1: Tạo/update tất cả parent categories
-        for category_data in categories_data:
-            pancake_id = category_data.get('id')
-            if not pancake_id:
-                continue
-                
-            category, created = Category.objects.update_or_create(
-                shop=shop,
-                pancake_id=pancake_id,
-                defaults={
-                    'name': category_data.get('text', ''),
-                    'description': '',
-                    'sort_order': 0,
-                    'is_active': not category_data.get('is_admin_category', False),
-                    'parent': None
-                }
-            )
-            existing_category_ids.append(category.pancake_id)
-            category_map[pancake_id] = category
-            
-            if created:
-                created_count += 1
-            else:
-                updated_count += 1
+        flat = _flatten_category_tree(categories_data)
+        
+        # Lần 1: upsert tất cả categories (chưa gán parent)
+        upsert_result = bulk_upsert(
+            Category, [
+                Category(
+                    shop=shop,
+                    pancake_id=pancake_id,
+                    name=category_data.get('text', ''),
+                    description='',
+                    sort_order=0,
+                    is_active=not category_data.get('is_admin_category', False),
+                ) for pancake_id, (category_data, _) in flat.items()
+            ],
+            unique_fields=['shop', 'pancake_id'],
+            update_fields=['name', 'description', 'sort_order', 'is_active']
+        )
+        created_count, updated_count = upsert_result.created, upsert_result.updated
         
-        # Lần 2: Xử lý nested categories (nodes)
-        for category_data in categories_data:
-            parent_id = category_data.get('id')
-            nodes = category_data.get('nodes', [])
-            
-            if parent_id in category_map and nodes:
-                parent_category = category_map[parent_id]
-                
-                for node_data in nodes:
-                    node_id = node_data.get('id')
-                    if not node_id:
-                        continue
-                    
-                    child_category, created = Category.objects.update_or_create(
-                        shop=shop,
-                        pancake_id=node_id,
-                        defaults={
-                            'name': node_data.get('text', ''),
-                            'description': '',
-                            'sort_order': 0,
-                            'is_active': not node_data.get('is_admin_category', False),
-                            'parent': parent_category
-                        }
-                    )
-                    existing_category_ids.append(child_category.pancake_id)
-                    
-                    if created:
-                        created_count += 1
-                    else:
-                        updated_count += 1
+        # Lần 2: gán parent cho các category có parent thay đổi
+        categories = {
+            str(c.pancake_id): c for c in Category.objects.filter(
+                shop=shop, pancake_id__in=list(flat)
+            ).only('id', 'pancake_id', 'parent_id')
+        }
+        to_reparent = []
+        for pancake_id, (_, parent_id) in flat.items():
+            category = categories.get(str(pancake_id))
+            parent = categories.get(str(parent_id)) if parent_id else None
+            if category and category.parent_id != (parent.id if parent else None):
+                category.parent_id = parent.id if parent else None
+                to_reparent.append(category)
+        if to_reparent:
+            Category.objects.bulk_update(to_reparent, ['parent'], batch_size=500)
         
         # Xóa categories không còn tồn tại
-        deleted_count = shop.categories.exclude(pancake_id__in=existing_category_ids).delete()[0]
+        deleted_count = delete_stale_children(Category, 'shop', {shop.pk: flat.keys()})
         if deleted_count > 0:
             logger.info(f"Deleted {deleted_count} categories for shop {shop.name}")
         
-        logger.info(f"Shop {shop.name}: {created_count} created, {updated_count} updated categories")
+        logger.info(f"Shop {shop.name}: {created_count} created, {updated_count} updated categories "
+                    f"({len(to_reparent)} re-parented)")
         return created_count, updated_count
         
     except Exception as e:
         logger.error(f"Error syncing categories for shop {shop.name}: {e}", exc_info=True)
         raise
 
-def _sync_all_categories() -> CategorySyncResult:
-    """Sync categories for all shops"""
+def _sync_all_categories(on_progress: Optional[Callable] = None) -> CategorySyncResult:
+    """Sync categories for all shops; on_progress(done, total, shop) được gọi sau mỗi shop"""
     result = CategorySyncResult()
     vietnam_start = _get_vietnam_time()
     
     try:
-        shops = Shop.objects.all()
-        logger.info(f"Starting category sync for {shops.count()} shops at {vietnam_start}")
+        shops = list(Shop.objects.all())
+        logger.info(f"Starting category sync for {len(shops)} shops at {vietnam_start}")
         
-        for shop in shops:
+        for index, shop in enumerate(shops, 1):
             try:
                 # Sync từng shop riêng biệt
                 with transaction.atomic():
@@ -343,7 +368,9 @@ def _sync_all_categories() -> CategorySyncResult:
                 error_msg = f"Shop {shop.name}: {str(e)}"
                 logger.error(error_msg)
                 result.errors.append(error_msg)
-                continue
+            finally:
+                if on_progress:
+                    on_progress(index, len(shops), shop)
         
         vietnam_end = _get_vietnam_time()
         duration = (vietnam_end - vietnam_start).total_seconds()
@@ -370,6 +397,7 @@ def sync_shops_task(self):
     
     try:
         logger.info(f"Starting {task_name} task at {vietnam_start}")
+        report_progress(self, 0, 1, 'Đang tải và lưu danh sách shops')
         
         # Thực hiện đồng bộ
         result = _sync_all_shops()
@@ -384,8 +412,8 @@ def sync_shops_task(self):
             'duration_seconds': duration,
             'shops_created': result.shops_created,
             'shops_updated': result.shops_updated,
-            'pages_synced': result.pages_created,
-            'tags_synced': result.tags_created,
+            'pages_synced': result.pages_created + result.pages_updated,
+            'tags_synced': result.tags_created + result.tags_updated,
             'total_errors': len(result.errors),
             'error_details': result.errors[:10],  # Chỉ lấy 10 lỗi đầu
             'success': len(result.errors) == 0
@@ -432,9 +460,14 @@ def sync_categories_task(self):
     
     try:
         logger.info(f"Starting {task_name} task at {vietnam_start}")
+        report_progress(self, 0, Shop.objects.count(), 'Đang đồng bộ danh mục')
         
         # Thực hiện đồng bộ
-        result = _sync_all_categories()
+        result = _sync_all_categories(
+            on_progress=lambda done, total, shop: report_progress(
+                self, done, total, f'Đã đồng bộ danh mục {done}/{total} shops ({shop.name})'
+            )
+        )
         vietnam_end = _get_vietnam_time()
         duration = (vietnam_end - vietnam_start).total_seconds()
         
@@ -482,58 +515,74 @@ def sync_categories_task(self):
         
         raise exc
 
+# ===== SYNC PIPELINE =====
+def _build_sync_pipeline(started_at: str):
+    """
+    Pipeline sync toàn bộ theo phụ thuộc dữ liệu, thay cho các mốc cron cách nhau:
+    
+        shops -> ( categories -> products  ||  customers ) -> orders -> finish
+    
+    - Categories/products và customers chỉ cần shops nên chạy song song
+    - Orders cần products (variations) và customers để gán FK nên chờ cả hai nhánh
+    - Stage fan-out (products, customers, orders) tự replace bằng chord theo shop,
+      stage sau bắt đầu ngay khi callback finalize của stage trước xong
+    - Signature immutable (.si): stage không nhận kết quả của stage trước
+    """
+    return chain(
+        sync_shops_task.si(),
+        group(
+            chain(sync_categories_task.si(), sync_all_products.si()),
+            sync_all_customers_30_days.si(mode='reconcile'),
+        ),
+        sync_orders_task.si(mode='repair'),
+        finish_sync_pipeline.s(started_at=started_at),
+    )
+
 @shared_task
 def sync_all_data_task():
     """
-    Task tổng hợp để sync cả shops và categories theo thứ tự
+    Task tổng hợp: dispatch pipeline shops -> categories -> products -> customers -> orders
+    rồi kết thúc ngay, không giữ worker chờ các stage
     """
     vietnam_start = _get_vietnam_time()
-    logger.info(f"Starting full data sync at {vietnam_start}")
+    logger.info(f"Starting full data sync pipeline at {vietnam_start}")
     
-    results = {
+    pipeline_result = _build_sync_pipeline(vietnam_start.isoformat()).apply_async()
+    
+    return {
+        'success': True,
+        'message': 'Dispatched full data sync pipeline',
         'start_time': vietnam_start.isoformat(),
-        'shops_result': None,
-        'categories_result': None,
-        'overall_success': True
+        'pipeline_task_id': pipeline_result.id
     }
-    
-    try:
-        
-        logger.info("Step 1: Syncing shops...")
-        shops_result = sync_shops_task.apply()
-        results['shops_result'] = shops_result.result
-        
-        if not results['shops_result']['success']:
-            results['overall_success'] = False
-            logger.warning("Shop sync failed, but continuing with category sync...")
-        
-        
-        logger.info("Step 2: Syncing categories...")
-        categories_result = sync_categories_task.apply()
-        results['categories_result'] = categories_result.result
-        
-        if not results['categories_result']['success']:
-            results['overall_success'] = False
-        
-    except Exception as e:
-        logger.error(f"Error in full data sync: {e}", exc_info=True)
-        results['overall_success'] = False
-        results['error'] = str(e)
-    
+
+@shared_task
+def finish_sync_pipeline(orders_result, started_at: str):
+    """Stage cuối của pipeline: log tổng thời gian, nhận kết quả finalize_orders_sync"""
     vietnam_end = _get_vietnam_time()
-    results['end_time'] = vietnam_end.isoformat()
-    results['total_duration'] = (vietnam_end - vietnam_start).total_seconds()
+    duration = (vietnam_end - datetime.fromisoformat(started_at)).total_seconds()
+    success = orders_result.get('success', False) if isinstance(orders_result, dict) else False
     
-    logger.info(f"Full data sync completed: {results}")
-    return results
+    logger.info(f"Full data sync pipeline completed in {duration:.1f}s (orders success: {success})")
+    return {
+        'success': success,
+        'start_time': started_at,
+        'end_time': vietnam_end.isoformat(),
+        'total_duration': duration,
+        'orders_result': orders_result
+    }
 
 @dataclass
 class ProductSyncResult:
     products_created: int = 0
     products_updated: int = 0
+    products_unchanged: int = 0
     variations_created: int = 0
     variations_updated: int = 0
+    variations_stock_updated: int = 0
+    variations_unchanged: int = 0
     fields_created: int = 0
+    interrupted: bool = False  # Dừng giữa chừng do sắp hết thời gian, resume từ checkpoint
     errors: List[str] = None
     
     def __post_init__(self):
@@ -582,19 +631,16 @@ def _reset_database_connection():
 # ===== API FUNCTIONS =====
 def _fetch_product_variations_page(shop_id: int, page: int = 1, page_size: int = 30) -> Dict:
     """Fetch single page of product variations from Pancake API"""
-    api_url = f"{settings.PANCAKE_API_BASE_URL}/shops/{shop_id}/products/variations"
     params = {
-        'api_key': settings.PANCAKE_API_KEY,
         'page': page,
         'page_size': page_size,
     }
     
     logger.info(f"Fetching shop {shop_id}, page {page} with page_size {page_size}")
     
-    response = requests.get(api_url, params=params, timeout=540)
-    response.raise_for_status()
-    
-    data = response.json()
+    data = get_pancake_client().get_json(
+        f"shops/{shop_id}/products/variations", params=params, endpoint='variations'
+    )
     logger.info(f"API response: success={data.get('success')}, page={data.get('page_number')}, "
                 f"total_pages={data.get('total_pages')}, data_count={len(data.get('data', []))}")
     
@@ -713,108 +759,157 @@ def _extract_fields_data(variations_data: List[Dict]) -> List[Dict]:
     logger.info(f"Extracted {len(fields_dict)} unique fields")
     return list(fields_dict.values())
 
+# ===== CHANGE DETECTION =====
+# Các field không đưa vào fingerprint: quan hệ/metadata sync và tồn kho (có fast path riêng)
+PRODUCT_HASH_EXCLUDE = ('shop', 'last_sync', 'sync_hash')
+VARIATION_STOCK_FIELDS = ['remain_quantity', 'variations_warehouses']
+VARIATION_HASH_EXCLUDE = ('product', 'last_sync', 'sync_hash', 'fields_data', *VARIATION_STOCK_FIELDS)
+
 # ===== BULK DATABASE OPERATIONS =====
-def _bulk_upsert_products(products_data: List[Dict]) -> Tuple[int, int]:
-    """Bulk create/update products"""
+def _bulk_upsert_products(products_data: List[Dict]) -> Tuple[int, int, int]:
+    """
+    Upsert products, bỏ qua product không đổi (so sánh sync_hash)
+    
+    Lỗi ghi được raise để trang bị tính là lỗi (result.errors, checkpoint không tiến qua trang)
+    
+    Returns:
+        (created, updated, unchanged)
+    """
     if not products_data:
-        return 0, 0
+        return 0, 0, 0
     
     shop = products_data[0]['shop']
     pancake_ids = [p['pancake_id'] for p in products_data]
     
-    existing_products = {
-        p.pancake_id: p for p in Product.objects.filter(
-            pancake_id__in=pancake_ids, shop=shop
-        )
-    }
+    existing_hashes = dict(
+        Product.objects.filter(pancake_id__in=pancake_ids, shop=shop).values_list('pancake_id', 'sync_hash')
+    )
+    category_pks = _resolve_category_pks(products_data, shop)
     
-    products_to_create = []
-    products_to_update = []
+    products_to_upsert = []
+    unchanged_count = 0
     m2m_data = []
     
     for product_data in products_data:
         pancake_id = product_data['pancake_id']
-        category_ids = product_data.pop('category_ids', [])
-        
-        if pancake_id in existing_products:
-            product = existing_products[pancake_id]
-            for field, value in product_data.items():
-                if field != 'shop':
-                    setattr(product, field, value)
-            products_to_update.append(product)
-            m2m_data.append((product, category_ids))
-        else:
-            product = Product(**product_data)
-            products_to_create.append(product)
-            m2m_data.append((product, category_ids))
-    
-    created_count = 0
-    if products_to_create:
-        try:
-            Product.objects.bulk_create(products_to_create, batch_size=30, ignore_conflicts=True)
-            created_count = len(products_to_create)
-            logger.info(f"Bulk created {created_count} products")
-        except Exception as e:
-            logger.error(f"Error bulk creating products: {e}")
+        category_ids = product_data.pop('category_ids', None) or []
+        # Fingerprint gồm pk category local (không phải id upstream): category chưa sync thì
+        # hash đổi khi category có mặt, product được ghi lại và M2M được bổ sung
+        local_category_pks = sorted({category_pks[str(c)] for c in category_ids if str(c) in category_pks})
+        sync_hash = compute_fingerprint(dict(product_data, category_pks=local_category_pks),
+                                        exclude=PRODUCT_HASH_EXCLUDE)
+        product_data['sync_hash'] = sync_hash
+        
+        if existing_hashes.get(pancake_id) == sync_hash:
+            unchanged_count += 1
+            continue
+        product = Product(**product_data)
+        products_to_upsert.append(product)
+        m2m_data.append((product, local_category_pks))
     
-    updated_count = 0
-    if products_to_update:
+    created_count = updated_count = 0
+    if products_to_upsert:
         try:
-            Product.objects.bulk_update(
-                products_to_update,
-                ['display_id', 'name', 'image_url', 'note_product', 'is_published', 
-                 'tags', 'manipulation_warehouses', 'inserted_at', 'last_sync'],
-                batch_size=30
-            )
-            updated_count = len(products_to_update)
-            logger.info(f"Bulk updated {updated_count} products")
+            # sync_hash chỉ được lưu khi M2M cũng ghi xong, nếu không lần sau vẫn coi là đổi
+            with transaction.atomic():
+                result = bulk_upsert(
+                    Product, products_to_upsert,
+                    unique_fields=['shop', 'pancake_id'],
+                    update_fields=['display_id', 'name', 'image_url', 'note_product', 'is_published', 
+                                   'tags', 'manipulation_warehouses', 'inserted_at', 'last_sync', 'sync_hash']
+                )
+                _handle_product_categories_m2m(m2m_data, shop)
+            created_count, updated_count = result.created, result.updated
+            logger.info(f"Upserted products: {created_count} created, {updated_count} updated")
         except Exception as e:
-            logger.error(f"Error bulk updating products: {e}")
+            logger.error(f"Error upserting products: {e}")
+            raise
     
-    _handle_product_categories_m2m(m2m_data, shop)
+    if unchanged_count:
+        logger.info(f"Skipped {unchanged_count} unchanged products")
     
-    return created_count, updated_count
+    return created_count, updated_count, unchanged_count
+
+def _resolve_category_pks(products_data: List[Dict], shop: Shop) -> Dict[str, int]:
+    """category id upstream (str) -> pk Category local của shop; cảnh báo id chưa có trong DB"""
+    # Category.pancake_id là IntegerField, category_ids từ API có thể là int hoặc str
+    all_category_ids = {str(c) for p in products_data for c in (p.get('category_ids') or [])}
+    if not all_category_ids:
+        return {}
+    category_pks = {
+        str(pancake_id): pk for pancake_id, pk in Category.objects.filter(
+            shop=shop, pancake_id__in=all_category_ids
+        ).values_list('pancake_id', 'id')
+    }
+    missing = all_category_ids - category_pks.keys()
+    if missing:
+        logger.warning(f"Shop {shop.name}: {len(missing)} categories not synced yet, "
+                       f"products keep them unlinked until they are: {sorted(missing)[:10]}")
+    return category_pks
 
 def _handle_product_categories_m2m(m2m_data: List[Tuple], shop: Shop):
-    """Handle product-category M2M relationships"""
-    for product, category_ids in m2m_data:
-        if category_ids:
-            try:
-                if not product.pk:
-                    try:
-                        product = Product.objects.get(
-                            shop=shop, 
-                            pancake_id=product.pancake_id
-                        )
-                    except Product.DoesNotExist:
-                        logger.warning(f"Product {product.pancake_id} not found in database")
-                        continue
-                
-                categories = Category.objects.filter(shop=shop, pancake_id__in=category_ids)
-                product.categories.set(categories)
-                
-            except Exception as e:
-                logger.error(f"Error setting categories for product {product.pancake_id}: {e}")
+    """
+    Ghi M2M product-category (set-based cho cả trang); m2m_data = [(product, local_category_pks)].
+    Lỗi được raise để caller rollback cả upsert (sync_hash) cùng transaction.
+    """
+    if not m2m_data:
+        return
+    
+    product_ids = dict(
+        Product.objects.filter(
+            shop=shop, pancake_id__in=[product.pancake_id for product, _ in m2m_data]
+        ).values_list('pancake_id', 'id')
+    )
+    
+    desired = {}
+    for product, category_pks in m2m_data:
+        product_pk = product_ids.get(product.pancake_id)
+        if product_pk is None:
+            logger.warning(f"Product {product.pancake_id} not found in database")
+            continue
+        desired[product_pk] = set(category_pks)
+    
+    result = sync_m2m(Product._meta.get_field('categories'), desired)
+    logger.info(f"Product categories M2M: {result.added} added, {result.removed} removed")
 
-def _bulk_upsert_variations(variations_data: List[Dict]) -> Tuple[int, int]:
-    """Bulk create/update variations"""
+def _bulk_upsert_variations(variations_data: List[Dict]) -> Tuple[int, int, int, int]:
+    """
+    Upsert variations với change detection:
+    - sync_hash (không gồm tồn kho) đổi: upsert toàn bộ cột + M2M fields
+    - chỉ tồn kho đổi: fast path chỉ ghi các cột tồn kho
+    - không đổi gì: bỏ qua
+    
+    Variation cần set lại M2M fields được đánh dấu `fields_changed` trong variations_data.
+    Lỗi ghi được raise như _bulk_upsert_products.
+    
+    Returns:
+        (created, updated, stock_updated, unchanged)
+    """
     if not variations_data:
-        return 0, 0
+        return 0, 0, 0, 0
     
     pancake_ids = [v['pancake_id'] for v in variations_data]
     
     existing_variations = {
-        v.pancake_id: v for v in ProductVariation.objects.filter(
+        row[0]: row[1:] for row in ProductVariation.objects.filter(
             pancake_id__in=pancake_ids
-        ).select_related('product')
+        ).values_list('pancake_id', 'sync_hash', *VARIATION_STOCK_FIELDS)
     }
     
-    variations_to_create = []
-    variations_to_update = []
+    # Field đã được upsert trước variations trong cùng trang
+    all_field_ids = {str(f['id']) for v in variations_data for f in v.get('fields_data') or [] if f.get('id')}
+    field_pks = dict(
+        ProductVariationField.objects.filter(pancake_id__in=all_field_ids).values_list('pancake_id', 'id')
+    ) if all_field_ids else {}
+    
+    variations_to_upsert = []
+    variations_stock_only = []
+    unchanged_count = 0
     
     for variation_data in variations_data:
         pancake_id = variation_data['pancake_id']
-        variation_data.pop('fields_data', [])
+        # Giữ lại fields_data cho _handle_variation_fields_m2m
+        fields_data = variation_data.pop('fields_data', [])
         
         # Set default values
         variation_data.setdefault('is_composite', False)
@@ -826,41 +921,32 @@ def _bulk_upsert_variations(variations_data: List[Dict]) -> Tuple[int, int]:
         variation_data.setdefault('remain_quantity', 0)
         variation_data.setdefault('weight', 0)
         
-        if pancake_id in existing_variations:
-            variation = existing_variations[pancake_id]
-            for field, value in variation_data.items():
-                if field != 'product':
-                    setattr(variation, field, value)
-            variations_to_update.append(variation)
-        else:
-            variations_to_create.append(ProductVariation(**variation_data))
-    
-    created_count = 0
-    if variations_to_create:
-        try:
-            created_variations = ProductVariation.objects.bulk_create(
-                variations_to_create, batch_size=30, ignore_conflicts=True
-            )
-            created_count = len(created_variations)
-            logger.info(f"Bulk created {created_count} variations")
-        except Exception as e:
-            logger.error(f"Bulk create failed: {e}")
-            # Fallback to individual creation
-            created_count = 0
-            for variation in variations_to_create:
-                try:
-                    ProductVariation.objects.create(**{
-                        field.name: getattr(variation, field.name)
-                        for field in variation._meta.fields
-                        if hasattr(variation, field.name) and 
-                           (getattr(variation, field.name) is not None or not field.has_default())
-                    })
-                    created_count += 1
-                except Exception as individual_error:
-                    logger.error(f"Failed to create variation {variation.pancake_id}: {individual_error}")
+        # Fingerprint gồm pk field local: field chưa ghi được thì hash đổi ở lần sau và M2M được sửa
+        sync_hash = compute_fingerprint(
+            dict(variation_data, field_pks=sorted({
+                field_pks[str(f['id'])] for f in fields_data if f.get('id') and str(f['id']) in field_pks
+            })),
+            exclude=VARIATION_HASH_EXCLUDE,
+        )
+        variation_data['sync_hash'] = sync_hash
+        
+        existing = existing_variations.get(pancake_id)
+        if existing and existing[0] == sync_hash:
+            stock_values = existing[1:]
+            if any(value != variation_data.get(field) for field, value in zip(VARIATION_STOCK_FIELDS, stock_values)):
+                variations_stock_only.append(ProductVariation(**variation_data))
+            else:
+                unchanged_count += 1
+            variation_data['fields_data'] = fields_data
+            variation_data['fields_changed'] = False
+            continue
+        
+        variations_to_upsert.append(ProductVariation(**variation_data))
+        variation_data['fields_data'] = fields_data
+        variation_data['fields_changed'] = True
     
-    updated_count = 0
-    if variations_to_update:
+    created_count = updated_count = 0
+    if variations_to_upsert:
         try:
             fields_to_update = [
                 'display_id', 'barcode', 'retail_price', 'retail_price_after_discount',
@@ -868,88 +954,98 @@ def _bulk_upsert_variations(variations_data: List[Dict]) -> Tuple[int, int]:
                 'wholesale_price', 'remain_quantity', 'weight', 'is_composite',
                 'is_hidden', 'is_locked', 'is_removed', 'is_sell_negative_variation',
                 'images', 'videos', 'composite_products', 'bonus_variations',
-                'variations_warehouses', 'inserted_at', 'last_sync'
+                'variations_warehouses', 'inserted_at', 'last_sync', 'sync_hash'
             ]
-            ProductVariation.objects.bulk_update(variations_to_update, fields_to_update, batch_size=30)
-            updated_count = len(variations_to_update)
-            logger.info(f"Bulk updated {updated_count} variations")
+            # sync_hash chỉ được lưu khi M2M fields cũng ghi xong
+            with transaction.atomic():
+                result = bulk_upsert(
+                    ProductVariation, variations_to_upsert,
+                    unique_fields=['product', 'pancake_id'], update_fields=fields_to_update
+                )
+                _handle_variation_fields_m2m(variations_data, field_pks)
+            created_count, updated_count = result.created, result.updated
+            logger.info(f"Upserted variations: {created_count} created, {updated_count} updated")
         except Exception as e:
-            logger.error(f"Error bulk updating variations: {e}")
+            logger.error(f"Error upserting variations: {e}")
+            raise
     
-    return created_count, updated_count
+    stock_updated_count = 0
+    if variations_stock_only:
+        try:
+            result = bulk_upsert(
+                ProductVariation, variations_stock_only,
+                unique_fields=['product', 'pancake_id'], update_fields=VARIATION_STOCK_FIELDS
+            )
+            stock_updated_count = result.updated
+            logger.info(f"Stock-only updated {stock_updated_count} variations")
+        except Exception as e:
+            logger.error(f"Error updating variation stock: {e}")
+            raise
+    
+    if unchanged_count:
+        logger.info(f"Skipped {unchanged_count} unchanged variations")
+    
+    return created_count, updated_count, stock_updated_count, unchanged_count
 
 def _bulk_upsert_fields(fields_data: List[Dict]) -> int:
-    """Bulk create/update variation fields"""
+    """Upsert variation fields, trả về số field mới; lỗi ghi được raise"""
     if not fields_data:
         return 0
     
-    pancake_ids = [f['pancake_id'] for f in fields_data]
-    
-    existing_fields = {
-        f.pancake_id: f for f in ProductVariationField.objects.filter(
-            pancake_id__in=pancake_ids
+    try:
+        result = bulk_upsert(
+            ProductVariationField, [ProductVariationField(**field_data) for field_data in fields_data],
+            unique_fields=['pancake_id'], update_fields=['name', 'key_value', 'value'], hash_field='sync_hash'
         )
-    }
-    
-    fields_to_create = []
-    fields_to_update = []
-    
-    for field_data in fields_data:
-        pancake_id = field_data['pancake_id']
-        
-        if pancake_id in existing_fields:
-            field = existing_fields[pancake_id]
-            for attr, value in field_data.items():
-                setattr(field, attr, value)
-            fields_to_update.append(field)
-        else:
-            fields_to_create.append(ProductVariationField(**field_data))
-    
-    created_count = 0
-    if fields_to_create:
-        try:
-            ProductVariationField.objects.bulk_create(fields_to_create, batch_size=30, ignore_conflicts=True)
-            created_count = len(fields_to_create)
-            logger.info(f"Bulk created {created_count} fields")
-        except Exception as e:
-            logger.error(f"Error bulk creating fields: {e}")
-    
-    if fields_to_update:
-        try:
-            ProductVariationField.objects.bulk_update(
-                fields_to_update, ['name', 'key_value', 'value'], batch_size=30
-            )
-            logger.info(f"Bulk updated {len(fields_to_update)} fields")
-        except Exception as e:
-            logger.error(f"Error bulk updating fields: {e}")
-    
-    return created_count
+        logger.info(f"Upserted fields: {result.created} created, {result.updated} updated")
+        return result.created
+    except Exception as e:
+        logger.error(f"Error upserting fields: {e}")
+        raise
 
-def _handle_variation_fields_m2m(variations_data: List[Dict]):
-    """Handle variation-fields M2M relationships"""
-    logger.info(f"Processing M2M for {len(variations_data)} variations")
+def _handle_variation_fields_m2m(variations_data: List[Dict], field_pks: Dict[str, int]):
+    """
+    Ghi M2M variation-fields (set-based cho cả trang) cho các variation mới/thay đổi.
+    Lỗi được raise để caller rollback cả upsert (sync_hash) cùng transaction.
+    """
+    # Variation không đổi (sync_hash gồm pk field) thì M2M cũng không đổi
+    changed = [v for v in variations_data if v.get('fields_changed', True)]
+    if not changed:
+        return
+    
+    logger.info(f"Processing M2M for {len(changed)}/{len(variations_data)} variations")
+    
+    variation_pks = {
+        (product_id, pancake_id): pk for pk, product_id, pancake_id in ProductVariation.objects.filter(
+            product__in={v['product'].pk for v in changed},
+            pancake_id__in=[v['pancake_id'] for v in changed]
+        ).values_list('id', 'product_id', 'pancake_id')
+    }
     
-    for variation_data in variations_data:
-        variation_id = variation_data['pancake_id']
-        fields_data = variation_data.get('fields_data', [])
-        
-        if not fields_data:
-            continue
-            
-        try:
-            variation = ProductVariation.objects.get(pancake_id=variation_id)
-            field_ids = [f.get('id') for f in fields_data if f.get('id')]
-            fields = ProductVariationField.objects.filter(pancake_id__in=field_ids)
-            variation.fields.set(fields)
-        except ProductVariation.DoesNotExist:
-            logger.warning(f"Variation {variation_id} not found for M2M setup")
+    desired = {}
+    for variation_data in changed:
+        variation_pk = variation_pks.get((variation_data['product'].pk, str(variation_data['pancake_id'])))
+        if variation_pk is None:
+            logger.warning(f"Variation {variation_data['pancake_id']} not found for M2M setup")
             continue
-        except Exception as e:
-            logger.error(f"Error setting M2M for variation {variation_id}: {e}")
+        desired[variation_pk] = {
+            field_pks[str(f['id'])] for f in variation_data.get('fields_data') or []
+            if f.get('id') and str(f['id']) in field_pks
+        }
+    
+    result = sync_m2m(ProductVariation._meta.get_field('fields'), desired)
+    logger.info(f"Variation fields M2M: {result.added} added, {result.removed} removed")
 
 # ===== SYNC SHOP FUNCTION =====
-def _sync_shop_products(shop: Shop) -> ProductSyncResult:
-    """Sync all products for a single shop"""
+def _sync_shop_products(shop: Shop, checkpoint: Optional[SyncCheckpointTracker] = None,
+                        budget: Optional[TaskTimeBudget] = None) -> ProductSyncResult:
+    """
+    Sync all products for a single shop
+    
+    Args:
+        checkpoint: Nếu có, bắt đầu từ trang sau trang đã commit và ghi checkpoint sau mỗi trang
+        budget: Nếu có và đã hết thời gian, dừng trước trang kế tiếp (result.interrupted = True)
+    """
     result = ProductSyncResult()
     
     try:
@@ -959,10 +1055,38 @@ def _sync_shop_products(shop: Shop) -> ProductSyncResult:
         
         logger.info(f"Starting sync for shop: {shop.name} (ID: {shop.pancake_id})")
         
-        while page <= total_pages:
+        events = ShopSyncEvents('products', shop, checkpoint.run_id if checkpoint else None)
+        
+        def _on_page_done(fetched):
+            if checkpoint:
+                # Trang chỉ được tính là đã commit khi fetch và ghi không thêm lỗi nào
+                if fetched.error is None and len(result.errors) == errors_before_page:
+                    checkpoint.page_committed(fetched.page, error_count=len(result.errors))
+                else:
+                    checkpoint.page_failed(fetched.page, len(result.errors))
+            events.page_done(fetched, errors=len(result.errors))
+        
+        # Trang tiếp theo được fetch ở thread nền trong khi trang hiện tại đang ghi DB
+        fetched_pages = iter_prefetched_pages(
+            lambda p: _fetch_product_variations_page(shop.pancake_id, p, 30),
+            start_page=checkpoint.start_page if checkpoint else 1,
+            on_page_done=_on_page_done,
+        )
+        
+        for fetched in fetched_pages:
+            page = fetched.page
+            # Sắp hết thời gian: dừng trước trang này (chưa commit), task tiếp nối resume từ checkpoint
+            if budget and budget.exhausted():
+                logger.warning(f"Time budget exhausted for shop {shop.name} before page {page}, "
+                              f"handing off to continuation task")
+                result.interrupted = True
+                break
+            errors_before_page = len(result.errors)
+            
             try:
-                # Fetch data
-                api_response = _fetch_product_variations_page(shop.pancake_id, page, 30)
+                if fetched.error:
+                    raise fetched.error
+                api_response = fetched.data
                 
                 if not api_response.get('success', False):
                     error_msg = f"API returned success=false for shop {shop.name} page {page}"
@@ -977,7 +1101,6 @@ def _sync_shop_products(shop: Shop) -> ProductSyncResult:
                 
                 if not variations_data:
                     logger.warning(f"No data for shop {shop.name} page {page}")
-                    page += 1
                     continue
                 
                 # Extract and transform data
@@ -985,7 +1108,7 @@ def _sync_shop_products(shop: Shop) -> ProductSyncResult:
                 fields_data = _extract_fields_data(variations_data)
                 
                 # Bulk upsert operations
-                products_created, products_updated = _bulk_upsert_products(products_data)
+                products_created, products_updated, products_unchanged = _bulk_upsert_products(products_data)
                 fields_created = _bulk_upsert_fields(fields_data)
                 
                 # Create products map for variations
@@ -998,31 +1121,28 @@ def _sync_shop_products(shop: Shop) -> ProductSyncResult:
                 
                 # Extract and upsert variations
                 variations_data_processed = _extract_variations_data(variations_data, products_map)
-                variations_created, variations_updated = _bulk_upsert_variations(variations_data_processed)
-                
-                # Handle M2M relationships
-                _handle_variation_fields_m2m(variations_data_processed)
+                (variations_created, variations_updated,
+                 variations_stock_updated, variations_unchanged) = _bulk_upsert_variations(variations_data_processed)
                 
                 # Aggregate results
                 result.products_created += products_created
                 result.products_updated += products_updated
+                result.products_unchanged += products_unchanged
                 result.variations_created += variations_created
                 result.variations_updated += variations_updated
+                result.variations_stock_updated += variations_stock_updated
+                result.variations_unchanged += variations_unchanged
                 result.fields_created += fields_created
                 
                 processed_pages += 1
                 logger.info(f"Completed page {page}/{total_pages} for shop {shop.name}")
                 
-                # Small delay between pages
-                time.sleep(0.5)
-                
             except Exception as page_error:
                 error_msg = f"Error processing page {page} for shop {shop.name}: {str(page_error)}"
                 logger.error(error_msg, exc_info=True)
                 result.errors.append(error_msg)
-            
-            page += 1
         
+        fetched_pages.close()
         logger.info(f"Completed sync for shop {shop.name}: {processed_pages}/{total_pages} pages processed")
             
     except requests.RequestException as e:
@@ -1053,8 +1173,11 @@ def sync_single_shop_products(self, shop_id: int):
             'shop_name': shop.name,
             'products_created': result.products_created,
             'products_updated': result.products_updated,
+            'products_unchanged': result.products_unchanged,
             'variations_created': result.variations_created,
             'variations_updated': result.variations_updated,
+            'variations_stock_updated': result.variations_stock_updated,
+            'variations_unchanged': result.variations_unchanged,
             'fields_created': result.fields_created,
             'errors': result.errors,
             'completed_at': _get_vietnam_time().isoformat()
@@ -1083,12 +1206,98 @@ def sync_single_shop_products(self, shop_id: int):
         }
 
 @shared_task(bind=True)
-def sync_all_products(self):
+def sync_shop_products_subtask(self, shop_id: int, run_id: str, carry: Optional[Dict] = None):
+    """
+    Subtask của chord sync_all_products: sync products cho một shop
+    
+    Args:
+        shop_id: Shop ID
+        run_id: Id của lần sync (checkpoint theo run)
+        carry: Kết quả đã làm của task trước khi bị thay bằng task tiếp nối
+    """
+    def _sync(shop, checkpoint, budget):
+        logger.info(f"Processing products for shop: {shop.name}")
+        shop_result = _sync_shop_products(shop, checkpoint=checkpoint, budget=budget)
+        logger.info(f"Shop {shop.name} completed: "
+                   f"{shop_result.products_created + shop_result.products_updated} products, "
+                   f"{shop_result.variations_created + shop_result.variations_updated} variations")
+        return shop_result
+    
+    return run_shop_sync(self, shop_id, run_id, 'products', _sync, carry=carry)
+
+@shared_task(bind=True)
+def finalize_products_sync(self, shop_results: List[Dict], sync_history_id: int, run_id: str):
+    """Chord callback của sync_all_products: gộp kết quả các shop vào SyncHistory"""
+    vietnam_end = _get_vietnam_time()
+    sync_history = SyncHistory.objects.get(id=sync_history_id)
+    duration = (vietnam_end - sync_history.started_at).total_seconds()
+    total_result = aggregate_shop_payloads(ProductSyncResult(), shop_results)
+    
+    # Update sync history
+    sync_history.status = 'completed' if not total_result.errors else 'failed'
+    sync_history.created_records = total_result.products_created
+    sync_history.updated_records = total_result.products_updated
+    sync_history.failed_records = len(total_result.errors)
+    sync_history.finished_at = vietnam_end
+    sync_history.total_records = total_result.products_created + total_result.products_updated
+    sync_history.error_message = '; '.join(total_result.errors[:3]) if total_result.errors else None
+    sync_history.error_details = {
+        'run_id': run_id,
+        'total_errors': len(total_result.errors),
+        'errors': total_result.errors[:10],
+        'change_detection': {
+            'products_unchanged': total_result.products_unchanged,
+            'variations_stock_updated': total_result.variations_stock_updated,
+            'variations_unchanged': total_result.variations_unchanged,
+        },
+        'shop_results': shop_results
+    }
+    sync_history.save()
+    publish_sync_event('run_finished', entity='products', run_id=run_id, sync_history_id=sync_history.id,
+                       status=sync_history.status, errors=len(total_result.errors))
+    
+    logger.info(f"Product sync completed in {duration:.2f}s: "
+               f"{total_result.products_created} products created, "
+               f"{total_result.products_updated} products updated, "
+               f"{total_result.products_unchanged} products unchanged, "
+               f"{total_result.variations_created} variations created, "
+               f"{total_result.variations_updated} variations updated, "
+               f"{total_result.variations_stock_updated} variations stock-only, "
+               f"{total_result.variations_unchanged} variations unchanged")
+    
+    return {
+        'success': len(total_result.errors) == 0,
+        'duration_seconds': duration,
+        'products_created': total_result.products_created,
+        'products_updated': total_result.products_updated,
+        'products_unchanged': total_result.products_unchanged,
+        'variations_created': total_result.variations_created,
+        'variations_updated': total_result.variations_updated,
+        'variations_stock_updated': total_result.variations_stock_updated,
+        'variations_unchanged': total_result.variations_unchanged,
+        'fields_created': total_result.fields_created,
+        'shops_processed': len(shop_results),
+        'errors_count': len(total_result.errors),
+        'errors': total_result.errors[:10],  # Only return first 10 errors
+        'shop_results': shop_results,
+        'completed_at': vietnam_end.isoformat(),
+        'run_id': run_id,
+        'sync_history_id': sync_history.id
+    }
+
+@shared_task(bind=True)
+def sync_all_products(self, run_id=None):
     """
     Main task to sync products for all shops
     Scheduled to run every 4 hours via Celery Beat
+    
+    Mỗi shop chạy trong một subtask riêng (chord), finalize_products_sync gộp kết quả.
+    
+    Args:
+        run_id: Id của lần sync để resume từ checkpoint (mặc định là task id)
     """
     vietnam_start = _get_vietnam_time()
+    run_id = resolve_run_id(self, run_id)
     logger.info(f"Starting scheduled product sync at {vietnam_start}")
     
     try:
@@ -1097,92 +1306,35 @@ def sync_all_products(self):
             sync_type='products_scheduled',
             status='running',
             started_at=vietnam_start,
-            total_records=0
+            total_records=0,
+            error_details={'run_id': run_id}
         )
         
-        shops = Shop.objects.all()
-        total_result = ProductSyncResult()
-        shop_results = []
-        
-        logger.info(f"Found {shops.count()} shops to sync")
-        
-        for shop in shops:
-            try:
-                logger.info(f"Processing products for shop: {shop.name}")
-                shop_result = _sync_shop_products(shop)
-                
-                # Aggregate results
-                total_result.products_created += shop_result.products_created
-                total_result.products_updated += shop_result.products_updated
-                total_result.variations_created += shop_result.variations_created
-                total_result.variations_updated += shop_result.variations_updated
-                total_result.fields_created += shop_result.fields_created
-                total_result.errors.extend(shop_result.errors)
-                
-                shop_results.append({
-                    'shop_id': shop.id,
-                    'shop_name': shop.name,
-                    'products_created': shop_result.products_created,
-                    'products_updated': shop_result.products_updated,
-                    'variations_created': shop_result.variations_created,
-                    'variations_updated': shop_result.variations_updated,
-                    'fields_created': shop_result.fields_created,
-                    'errors': shop_result.errors
-                })
-                
-                logger.info(f"Shop {shop.name} completed: "
-                           f"{shop_result.products_created + shop_result.products_updated} products, "
-                           f"{shop_result.variations_created + shop_result.variations_updated} variations")
-                
-            except Exception as e:
-                error_msg = f"Error processing shop {shop.name}: {str(e)}"
-                logger.error(error_msg, exc_info=True)
-                total_result.errors.append(error_msg)
-                shop_results.append({
-                    'shop_id': shop.id,
-                    'shop_name': shop.name,
-                    'error': error_msg
-                })
-        
-        vietnam_end = _get_vietnam_time()
-        duration = (vietnam_end - vietnam_start).total_seconds()
+        shop_ids = list(Shop.objects.order_by('id').values_list('id', flat=True))
+        logger.info(f"Found {len(shop_ids)} shops to sync")
         
-        # Update sync history
-        sync_history.status = 'completed' if not total_result.errors else 'failed'
-        sync_history.created_records = total_result.products_created
-        sync_history.updated_records = total_result.products_updated
-        sync_history.failed_records = len(total_result.errors)
-        sync_history.finished_at = vietnam_end
-        sync_history.total_records = total_result.products_created + total_result.products_updated
-        sync_history.error_message = '; '.join(total_result.errors[:3]) if total_result.errors else None
-        sync_history.error_details = {
-            'total_errors': len(total_result.errors),
-            'errors': total_result.errors[:10],
-            'shop_results': shop_results
-        }
-        sync_history.save()
+        if not shop_ids:
+            sync_history.status = 'completed'
+            sync_history.finished_at = _get_vietnam_time()
+            sync_history.save()
+            return {'success': True, 'shops_processed': 0, 'sync_history_id': sync_history.id}
         
-        logger.info(f"Product sync completed in {duration:.2f}s: "
-                   f"{total_result.products_created} products created, "
-                   f"{total_result.products_updated} products updated, "
-                   f"{total_result.variations_created} variations created, "
-                   f"{total_result.variations_updated} variations updated")
+        stage = shop_chord(
+            sync_shop_products_subtask, finalize_products_sync, shop_ids,
+            callback_kwargs={'sync_history_id': sync_history.id, 'run_id': run_id},
+            run_id=run_id
+        )
         
-        return {
-            'success': len(total_result.errors) == 0,
-            'duration_seconds': duration,
-            'products_created': total_result.products_created,
-            'products_updated': total_result.products_updated,
-            'variations_created': total_result.variations_created,
-            'variations_updated': total_result.variations_updated,
-            'fields_created': total_result.fields_created,
-            'shops_processed': len(shop_results),
-            'errors_count': len(total_result.errors),
-            'errors': total_result.errors[:10],  # Only return first 10 errors
-            'shop_results': shop_results,
-            'completed_at': vietnam_end.isoformat(),
-            'sync_history_id': sync_history.id
-        }
+        if not is_pipeline_stage(self):
+            chord_result = stage.apply_async()
+            return {
+                'success': True,
+                'message': f'Dispatched product sync for {len(shop_ids)} shops',
+                'shops_dispatched': len(shop_ids),
+                'run_id': run_id,
+                'callback_task_id': chord_result.id,
+                'sync_history_id': sync_history.id
+            }
         
     except Exception as e:
         vietnam_error = _get_vietnam_time()
@@ -1202,6 +1354,10 @@ def sync_all_products(self):
             'error': f'Critical error in sync: {str(e)}',
             'completed_at': vietnam_error.isoformat()
         }
+    
+    # Stage của sync pipeline: stage sau chỉ chạy khi finalize_products_sync xong
+    # (nằm ngoài try: replace() raise Ignore)
+    return self.replace(stage)
 
 @shared_task
 def cleanup_old_sync_histories():
@@ -1221,6 +1377,8 @@ def cleanup_old_sync_histories():
                 deleted_count = SyncHistory.objects.filter(id__in=old_ids).delete()[0]
                 logger.info(f"Cleaned up {deleted_count} old {sync_type} sync histories")
         
+        cleanup_old_checkpoints()
+        
         return {'success': True, 'message': 'Cleanup completed'}
         
     except Exception as e:
@@ -1232,6 +1390,7 @@ from celery import shared_task
 from django.utils import timezone
 from django.conf import settings
 from django.db import transaction
+from django.db.models import Exists, OuterRef, Subquery
 import requests
 from typing import List, Dict, Tuple, Optional
 from dataclasses import dataclass
@@ -1252,6 +1411,12 @@ class CustomerSyncResult:
     customers_updated: int = 0
     addresses_created: int = 0
     addresses_updated: int = 0
+    users_unchanged: int = 0  # Bỏ qua ghi vì sync_hash không đổi
+    customers_unchanged: int = 0
+    addresses_unchanged: int = 0
+    orders_reassigned: int = 0  # Order chuyển từ anonymous sang customer thật
+    max_updated_at: Optional[datetime] = None  # Max updated_at từ API, dùng làm watermark
+    interrupted: bool = False  # Dừng giữa chừng do sắp hết thời gian, resume từ checkpoint
     errors: List[str] = None
     
     def __post_init__(self):
@@ -1343,9 +1508,7 @@ def _fetch_customers_page(shop_id: int, page: int = 1, page_size: int = 50,
         start_time_updated_at: Start time for updated_at filter (optional)
         end_time_updated_at: End time for updated_at filter (optional)
     """
-    api_url = f"{settings.PANCAKE_API_BASE_URL}/shops/{shop_id}/customers"
     params = {
-        'api_key': settings.PANCAKE_API_KEY,
         'page_number': page,  # Updated parameter name
         'page_size': page_size,
     }
@@ -1368,10 +1531,9 @@ def _fetch_customers_page(shop_id: int, page: int = 1, page_size: int = 50,
         logger.info(f"Date range filter: {start_time_updated_at} to {end_time_updated_at}")
     
     try:
-        response = requests.get(api_url, params=params, timeout=60)
-        response.raise_for_status()
-        
-        data = response.json()
+        data = get_pancake_client().get_json(
+            f"shops/{shop_id}/customers", params=params, endpoint='customers'
+        )
         logger.info(f"API response: success={data.get('success')}, page={data.get('page_number')}, "
                     f"total_pages={data.get('total_pages')}, data_count={len(data.get('data', []))}")
         
@@ -1380,6 +1542,48 @@ def _fetch_customers_page(shop_id: int, page: int = 1, page_size: int = 50,
         logger.error(f"API request failed for shop {shop_id} page {page}: {e}")
         raise
 
+def _fetch_customers_by_ids(shop_id: int, customer_ids: List[str], batch_size: int = 100) -> Tuple[List[Dict], bool]:
+    """
+    Fetch customers theo danh sách id (filter customer_ids của API customers), mỗi request tối đa batch_size id
+    
+    Trả về (customers có id nằm trong customer_ids, filter_applied). Response chứa customer ngoài
+    batch nghĩa là API bỏ qua filter: dừng ngay, filter_applied=False để caller không gọi lại.
+    """
+    wanted = {str(customer_id) for customer_id in customer_ids}
+    customer_ids = sorted(wanted)
+    customers_data = []
+    
+    for start in range(0, len(customer_ids), batch_size):
+        batch = customer_ids[start:start + batch_size]
+        params = {
+            'customer_ids': ','.join(batch),
+            'page_number': 1,
+            'page_size': len(batch),
+        }
+        logger.info(f"Fetching {len(batch)} customers by id for shop {shop_id}")
+        
+        try:
+            data = get_pancake_client().get_json(
+                f"shops/{shop_id}/customers", params=params, endpoint='customers'
+            )
+        except requests.RequestException as e:
+            logger.error(f"API request failed fetching customers by id for shop {shop_id}: {e}")
+            raise
+        
+        if not data.get('success', False):
+            raise ValueError(f"API returned success=false fetching customers by id for shop {shop_id}")
+        
+        batch_ids = set(batch)
+        returned = data.get('data', [])
+        if any(str(c.get('id')) not in batch_ids for c in returned):
+            logger.warning(f"Customers API ignored customer_ids filter for shop {shop_id}, "
+                           f"stop fetching customers by id")
+            customers_data.extend(c for c in returned if str(c.get('id')) in wanted)
+            return customers_data, False
+        customers_data.extend(returned)
+    
+    return customers_data, True
+
 # ===== DATA EXTRACTION FUNCTIONS =====
 def _extract_users_data(customers_data: List[Dict]) -> List[Dict]:
     """Extract unique users (creators/assigned users) from customers response"""
@@ -1523,124 +1727,66 @@ def _extract_addresses_data(customers_data: List[Dict]) -> List[Dict]:
     return addresses
 
 # ===== BULK DATABASE OPERATIONS =====
-def _bulk_upsert_users(users_data: List[Dict]) -> Tuple[int, int]:
-    """Bulk create/update users"""
+def _bulk_upsert_users(users_data: List[Dict]) -> Tuple[int, int, int]:
+    """Upsert users, bỏ qua user không đổi (sync_hash). Returns (created, updated, unchanged)"""
     if not users_data:
-        return 0, 0
+        return 0, 0, 0
     
     from shops.models import User  # Import your User model
     
-    pancake_ids = [u['pancake_id'] for u in users_data]
-    
-    existing_users = {
-        u.pancake_id: u for u in User.objects.filter(pancake_id__in=pancake_ids)
-    }
-    
-    users_to_create = []
-    users_to_update = []
-    
-    for user_data in users_data:
-        pancake_id = user_data['pancake_id']
-        
-        if pancake_id in existing_users:
-            user = existing_users[pancake_id]
-            for field, value in user_data.items():
-                setattr(user, field, value)
-            users_to_update.append(user)
-        else:
-            users_to_create.append(User(**user_data))
-    
-    created_count = 0
-    if users_to_create:
-        try:
-            User.objects.bulk_create(users_to_create, batch_size=50, ignore_conflicts=True)
-            created_count = len(users_to_create)
-            logger.info(f"Bulk created {created_count} users")
-        except Exception as e:
-            logger.error(f"Error bulk creating users: {e}")
-    
-    updated_count = 0
-    if users_to_update:
-        try:
-            User.objects.bulk_update(
-                users_to_update,
-                ['name', 'avatar_url', 'fb_id', 'phone_number', 'last_sync'],
-                batch_size=50
-            )
-            updated_count = len(users_to_update)
-            logger.info(f"Bulk updated {updated_count} users")
-        except Exception as e:
-            logger.error(f"Error bulk updating users: {e}")
-    
-    return created_count, updated_count
+    try:
+        result = bulk_upsert(
+            User, [User(**user_data) for user_data in users_data],
+            unique_fields=['pancake_id'],
+            update_fields=['name', 'avatar_url', 'fb_id', 'phone_number', 'last_sync'],
+            hash_field='sync_hash'
+        )
+        logger.info(f"Upserted users: {result.created} created, {result.updated} updated, "
+                    f"{result.unchanged} unchanged")
+        return result.created, result.updated, result.unchanged
+    except Exception as e:
+        logger.error(f"Error upserting users: {e}")
+        return 0, 0, 0
 
-def _bulk_upsert_customers(customers_data: List[Dict]) -> Tuple[int, int]:
-    """Bulk create/update customers"""
+def _bulk_upsert_customers(customers_data: List[Dict]) -> Tuple[int, int, int]:
+    """Upsert customers, bỏ qua customer không đổi (sync_hash). Returns (created, updated, unchanged)"""
     if not customers_data:
-        return 0, 0
+        return 0, 0, 0
     
     from shops.models import Customer  # Import your Customer model
     
-    shop = customers_data[0]['shop']
-    pancake_ids = [c['pancake_id'] for c in customers_data]
-    
-    existing_customers = {
-        c.pancake_id: c for c in Customer.objects.filter(
-            pancake_id__in=pancake_ids, shop=shop
-        )
-    }
-    
-    customers_to_create = []
-    customers_to_update = []
-    
+    customers_to_upsert = []
     for customer_data in customers_data:
-        pancake_id = customer_data['pancake_id']
         customer_data.pop('addresses_data', [])
-        
-        if pancake_id in existing_customers:
-            customer = existing_customers[pancake_id]
-            for field, value in customer_data.items():
-                if field != 'shop':
-                    setattr(customer, field, value)
-            customers_to_update.append(customer)
-        else:
-            customers_to_create.append(Customer(**customer_data))
+        customers_to_upsert.append(Customer(**customer_data))
     
-    created_count = 0
-    if customers_to_create:
-        try:
-            Customer.objects.bulk_create(customers_to_create, batch_size=50, ignore_conflicts=True)
-            created_count = len(customers_to_create)
-            logger.info(f"Bulk created {created_count} customers")
-        except Exception as e:
-            logger.error(f"Error bulk creating customers: {e}")
-    
-    updated_count = 0
-    if customers_to_update:
-        try:
-            fields_to_update = [
-                'customer_id', 'name', 'username', 'gender', 'date_of_birth',
-                'phone_numbers', 'emails', 'fb_id', 'current_debts', 'purchased_amount',
-                'total_amount_referred', 'reward_point', 'used_reward_point',
-                'order_count', 'succeed_order_count', 'returned_order_count', 'last_order_at',
-                'referral_code', 'count_referrals', 'is_block', 'is_discount_by_level',
-                'is_adjust_debts', 'active_levera_pay', 'creator', 'assigned_user',
-                'level', 'currency', 'user_block_id', 'conversation_tags',
-                'order_sources', 'tags', 'list_voucher', 'notes',
-                'inserted_at', 'updated_at_api', 'last_sync'
-            ]
-            Customer.objects.bulk_update(customers_to_update, fields_to_update, batch_size=50)
-            updated_count = len(customers_to_update)
-            logger.info(f"Bulk updated {updated_count} customers")
-        except Exception as e:
-            logger.error(f"Error bulk updating customers: {e}")
-    
-    return created_count, updated_count
+    try:
+        fields_to_update = [
+            'customer_id', 'name', 'username', 'gender', 'date_of_birth',
+            'phone_numbers', 'emails', 'fb_id', 'current_debts', 'purchased_amount',
+            'total_amount_referred', 'reward_point', 'used_reward_point',
+            'order_count', 'succeed_order_count', 'returned_order_count', 'last_order_at',
+            'referral_code', 'count_referrals', 'is_block', 'is_discount_by_level',
+            'is_adjust_debts', 'active_levera_pay', 'creator', 'assigned_user',
+            'level', 'currency', 'user_block_id', 'conversation_tags',
+            'order_sources', 'tags', 'list_voucher', 'notes',
+            'inserted_at', 'updated_at_api', 'last_sync'
+        ]
+        result = bulk_upsert(
+            Customer, customers_to_upsert,
+            unique_fields=['shop', 'pancake_id'], update_fields=fields_to_update, hash_field='sync_hash'
+        )
+        logger.info(f"Upserted customers: {result.created} created, {result.updated} updated, "
+                    f"{result.unchanged} unchanged")
+        return result.created, result.updated, result.unchanged
+    except Exception as e:
+        logger.error(f"Error upserting customers: {e}")
+        return 0, 0, 0
 
-def _bulk_upsert_addresses(addresses_data: List[Dict], customers_map: Dict) -> Tuple[int, int]:
-    """Bulk create/update customer addresses"""
+def _bulk_upsert_addresses(addresses_data: List[Dict], customers_map: Dict) -> Tuple[int, int, int]:
+    """Upsert customer addresses, bỏ qua địa chỉ không đổi. Returns (created, updated, unchanged)"""
     if not addresses_data:
-        return 0, 0
+        return 0, 0, 0
     
     from shops.models import CustomerAddress  # Import your CustomerAddress model
     
@@ -1653,58 +1799,102 @@ def _bulk_upsert_addresses(addresses_data: List[Dict], customers_map: Dict) -> T
             valid_addresses.append(address_data)
     
     if not valid_addresses:
-        return 0, 0
+        return 0, 0, 0
     
-    pancake_ids = [a['pancake_id'] for a in valid_addresses]
+    try:
+        fields_to_update = [
+            'full_name', 'phone_number', 'address', 'full_address', 'post_code',
+            'country_code', 'province_id', 'district_id', 'commune_id', 'last_sync'
+        ]
+        result = bulk_upsert(
+            CustomerAddress, [CustomerAddress(**address_data) for address_data in valid_addresses],
+            unique_fields=['customer', 'pancake_id'], update_fields=fields_to_update, hash_field='sync_hash'
+        )
+        logger.info(f"Upserted addresses: {result.created} created, {result.updated} updated, "
+                    f"{result.unchanged} unchanged")
+        return result.created, result.updated, result.unchanged
+    except Exception as e:
+        logger.error(f"Error upserting addresses: {e}")
+        return 0, 0, 0
+
+def _reassign_pending_orders(shop: Shop) -> int:
+    """
+    Gán lại các order đang dùng anonymous customer cho customer thật đã sync về.
     
-    existing_addresses = {
-        a.pancake_id: a for a in CustomerAddress.objects.filter(
-            pancake_id__in=pancake_ids
-        ).select_related('customer')
-    }
+    Một câu UPDATE set-based theo cột pending_customer_pancake_id (index (shop, pending_customer_pancake_id)),
+    order chưa có customer trong DB giữ nguyên để lần sync sau xử lý.
+    """
+    real_customers = Customer.objects.filter(
+        shop_id=OuterRef('shop_id'), pancake_id=OuterRef('pending_customer_pancake_id')
+    )
+    reassigned = Order.objects.filter(
+        shop=shop, pending_customer_pancake_id__isnull=False
+    ).filter(Exists(real_customers)).update(
+        customer=Subquery(real_customers.values('id')[:1]),
+        pending_customer_pancake_id=None,
+        updated_at=timezone.now(),
+    )
+    if reassigned:
+        logger.info(f"Reassigned {reassigned} orders from anonymous to real customers for shop {shop.name}")
+    return reassigned
+
+def _upsert_customers_batch(shop: Shop, customers_data: List[Dict], result: CustomerSyncResult) -> Dict:
+    """
+    Ghi một batch customers từ API (users -> customers -> addresses), cộng số đếm vào result
     
-    addresses_to_create = []
-    addresses_to_update = []
+    Returns:
+        customers_map {pancake_id: Customer} của batch
+    """
+    # Extract and transform data
+    users_data = _extract_users_data(customers_data)
     
-    for address_data in valid_addresses:
-        pancake_id = address_data['pancake_id']
-        
-        if pancake_id in existing_addresses:
-            address = existing_addresses[pancake_id]
-            for field, value in address_data.items():
-                if field != 'customer':
-                    setattr(address, field, value)
-            addresses_to_update.append(address)
-        else:
-            addresses_to_create.append(CustomerAddress(**address_data))
+    # Bulk upsert users first
+    users_created, users_updated, users_unchanged = _bulk_upsert_users(users_data)
     
-    created_count = 0
-    if addresses_to_create:
-        try:
-            CustomerAddress.objects.bulk_create(addresses_to_create, batch_size=50, ignore_conflicts=True)
-            created_count = len(addresses_to_create)
-            logger.info(f"Bulk created {created_count} addresses")
-        except Exception as e:
-            logger.error(f"Error bulk creating addresses: {e}")
+    # Create users map for customers
+    user_ids = [ud['pancake_id'] for ud in users_data]
+    users_map = {
+        u.pancake_id: u for u in User.objects.filter(pancake_id__in=user_ids)
+    }
     
-    updated_count = 0
-    if addresses_to_update:
-        try:
-            fields_to_update = [
-                'full_name', 'phone_number', 'address', 'full_address', 'post_code',
-                'country_code', 'province_id', 'district_id', 'commune_id', 'last_sync'
-            ]
-            CustomerAddress.objects.bulk_update(addresses_to_update, fields_to_update, batch_size=50)
-            updated_count = len(addresses_to_update)
-            logger.info(f"Bulk updated {updated_count} addresses")
-        except Exception as e:
-            logger.error(f"Error bulk updating addresses: {e}")
+    # Extract and upsert customers
+    customers_data_processed = _extract_customers_data(customers_data, shop, users_map)
+    customers_created, customers_updated, customers_unchanged = _bulk_upsert_customers(
+        customers_data_processed
+    )
     
-    return created_count, updated_count
+    # Create customers map for addresses
+    customer_ids = [cd['pancake_id'] for cd in customers_data_processed]
+    customers_map = {
+        c.pancake_id: c for c in Customer.objects.filter(
+            shop=shop, pancake_id__in=customer_ids
+        )
+    }
+    
+    # Extract and upsert addresses
+    addresses_data = _extract_addresses_data(customers_data)
+    addresses_created, addresses_updated, addresses_unchanged = _bulk_upsert_addresses(
+        addresses_data, customers_map
+    )
+    
+    # Aggregate results
+    result.users_created += users_created
+    result.users_updated += users_updated
+    result.customers_created += customers_created
+    result.customers_updated += customers_updated
+    result.addresses_created += addresses_created
+    result.addresses_updated += addresses_updated
+    result.users_unchanged += users_unchanged
+    result.customers_unchanged += customers_unchanged
+    result.addresses_unchanged += addresses_unchanged
+    
+    return customers_map
 
 # ===== SYNC FUNCTIONS =====
 def _sync_shop_customers(shop, start_time_updated_at: Optional[datetime] = None,
-                        end_time_updated_at: Optional[datetime] = None) -> CustomerSyncResult:
+                        end_time_updated_at: Optional[datetime] = None,
+                        checkpoint: Optional[SyncCheckpointTracker] = None,
+                        budget: Optional[TaskTimeBudget] = None) -> CustomerSyncResult:
     """
     Sync customers for a single shop with date range filtering
     
@@ -1712,6 +1902,8 @@ def _sync_shop_customers(shop, start_time_updated_at: Optional[datetime] = None,
         shop: Shop instance
         start_time_updated_at: Start time for updated_at filter (optional)
         end_time_updated_at: End time for updated_at filter (optional)
+        checkpoint: Nếu có, bắt đầu từ trang sau trang đã commit và ghi checkpoint sau mỗi trang
+        budget: Nếu có và đã hết thời gian, dừng trước trang kế tiếp (result.interrupted = True)
     """
     result = CustomerSyncResult()
     
@@ -1729,16 +1921,44 @@ def _sync_shop_customers(shop, start_time_updated_at: Optional[datetime] = None,
             sync_type = "full"
             logger.info(f"Starting full customer sync for shop: {shop.name} (ID: {shop.pancake_id})")
         
-        while page <= total_pages:
+        events = ShopSyncEvents('customers', shop, checkpoint.run_id if checkpoint else None)
+        
+        def _on_page_done(fetched):
+            if checkpoint:
+                # Trang chỉ được tính là đã commit khi fetch và ghi không thêm lỗi nào
+                if fetched.error is None and len(result.errors) == errors_before_page:
+                    checkpoint.page_committed(fetched.page, result.max_updated_at, len(result.errors))
+                else:
+                    checkpoint.page_failed(fetched.page, len(result.errors))
+            events.page_done(fetched, errors=len(result.errors))
+        
+        # Trang tiếp theo được fetch ở thread nền trong khi trang hiện tại đang ghi DB
+        fetched_pages = iter_prefetched_pages(
+            lambda p: _fetch_customers_page(
+                shop.pancake_id, 
+                p, 
+                50,
+                start_time_updated_at=start_time_updated_at,
+                end_time_updated_at=end_time_updated_at
+            ),
+            start_page=checkpoint.start_page if checkpoint else 1,
+            on_page_done=_on_page_done,
+        )
+        
+        for fetched in fetched_pages:
+            page = fetched.page
+            # Sắp hết thời gian: dừng trước trang này (chưa commit), task tiếp nối resume từ checkpoint
+            if budget and budget.exhausted():
+                logger.warning(f"Time budget exhausted for shop {shop.name} before page {page}, "
+                              f"handing off to continuation task")
+                result.interrupted = True
+                break
+            errors_before_page = len(result.errors)
+            
             try:
-                # Fetch data with date range filter
-                api_response = _fetch_customers_page(
-                    shop.pancake_id, 
-                    page, 
-                    50,
-                    start_time_updated_at=start_time_updated_at,
-                    end_time_updated_at=end_time_updated_at
-                )
+                if fetched.error:
+                    raise fetched.error
+                api_response = fetched.data
                 
                 if not api_response.get('success', False):
                     error_msg = f"API returned success=false for shop {shop.name} page {page}"
@@ -1753,60 +1973,25 @@ def _sync_shop_customers(shop, start_time_updated_at: Optional[datetime] = None,
                 
                 if not customers_data:
                     logger.info(f"No data for shop {shop.name} page {page}")
-                    page += 1
                     continue
                 
-                # Extract and transform data
-                users_data = _extract_users_data(customers_data)
-                
-                # Bulk upsert users first
-                users_created, users_updated = _bulk_upsert_users(users_data)
-                
-                # Create users map for customers
-                from shops.models import User
-                user_ids = [ud['pancake_id'] for ud in users_data]
-                users_map = {
-                    u.pancake_id: u for u in User.objects.filter(pancake_id__in=user_ids)
-                }
-                
-                # Extract and upsert customers
-                customers_data_processed = _extract_customers_data(customers_data, shop, users_map)
-                customers_created, customers_updated = _bulk_upsert_customers(customers_data_processed)
+                _upsert_customers_batch(shop, customers_data, result)
                 
-                # Create customers map for addresses
-                from shops.models import Customer
-                customer_ids = [cd['pancake_id'] for cd in customers_data_processed]
-                customers_map = {
-                    c.pancake_id: c for c in Customer.objects.filter(
-                        shop=shop, pancake_id__in=customer_ids
-                    )
-                }
-                
-                # Extract and upsert addresses
-                addresses_data = _extract_addresses_data(customers_data)
-                addresses_created, addresses_updated = _bulk_upsert_addresses(addresses_data, customers_map)
-                
-                # Aggregate results
-                result.users_created += users_created
-                result.users_updated += users_updated
-                result.customers_created += customers_created
-                result.customers_updated += customers_updated
-                result.addresses_created += addresses_created
-                result.addresses_updated += addresses_updated
+                # Theo dõi max updated_at từ API cho watermark
+                for customer_data in customers_data:
+                    updated_at = _parse_datetime(customer_data.get('updated_at'))
+                    if updated_at and (result.max_updated_at is None or updated_at > result.max_updated_at):
+                        result.max_updated_at = updated_at
                                 
                 processed_pages += 1
                 logger.info(f"Completed page {page}/{total_pages} for shop {shop.name}")
                 
-                # Small delay between pages
-                time.sleep(0.5)
-                
             except Exception as page_error:
                 error_msg = f"Error processing page {page} for shop {shop.name}: {str(page_error)}"
                 logger.error(error_msg, exc_info=True)
                 result.errors.append(error_msg)
-            
-            page += 1
         
+        fetched_pages.close()
         logger.info(f"Completed {sync_type} customer sync for shop {shop.name}: {processed_pages}/{total_pages} pages processed")
             
     except requests.RequestException as e:
@@ -1847,6 +2032,9 @@ def sync_single_shop_customers_30_days(self, shop_id: int):
             end_time_updated_at=end_time_updated_at
         )
         
+        if not result.errors:
+            advance_watermark(shop, 'customers', result.max_updated_at or end_time_updated_at)
+        
         vietnam_end = _get_vietnam_time()
         
         return {
@@ -1886,350 +2074,296 @@ def sync_single_shop_customers_30_days(self, shop_id: int):
         }
 
 @shared_task(bind=True)
-def sync_all_customers_30_days(self):
+def sync_shop_customers_subtask(self, shop_id: int, run_id: str, mode: str = 'incremental',
+                                start_time_updated_at: Optional[str] = None,
+                                end_time_updated_at: Optional[str] = None, carry: Optional[Dict] = None):
     """
-    Sync customers for all shops for the last 30 days
+    Subtask của chord sync_all_customers_30_days / sync_all_customers_full: sync customers cho một shop
+    
+    Args:
+        shop_id: Shop ID
+        run_id: Id của lần sync (checkpoint theo run)
+        mode: 'incremental', 'reconcile' hoặc 'full' (không lọc theo ngày)
+        start_time_updated_at, end_time_updated_at: Window (ISO) của lần sync, None với mode 'full'
+        carry: Kết quả đã làm của task trước khi bị thay bằng task tiếp nối
     """
-    task_name = "30-Day Customer Sync"
+    window_start = datetime.fromisoformat(start_time_updated_at) if start_time_updated_at else None
+    window_end = datetime.fromisoformat(end_time_updated_at) if end_time_updated_at else None
+    
+    def _sync(shop, checkpoint, budget):
+        if mode == 'full':
+            logger.info(f"Processing all customers for shop: {shop.name}")
+            # No date filter for full sync
+            shop_result = _sync_shop_customers(shop, checkpoint=checkpoint, budget=budget)
+        else:
+            if checkpoint.params:
+                # Resume: giữ nguyên window của lần chạy trước trong cùng run
+                shop_start_updated_at = datetime.fromisoformat(checkpoint.params['start_time_updated_at'])
+                shop_end_updated_at = datetime.fromisoformat(checkpoint.params['end_time_updated_at'])
+                is_incremental = checkpoint.params.get('is_incremental', False)
+            else:
+                # Incremental: bắt đầu từ watermark của shop; reconcile: full 30 ngày
+                if mode == 'reconcile':
+                    shop_start_updated_at, is_incremental = window_start, False
+                else:
+                    shop_start_updated_at, is_incremental = get_incremental_start(
+                        shop, 'customers', window_start
+                    )
+                shop_end_updated_at = window_end
+                checkpoint.save_params({
+                    'start_time_updated_at': shop_start_updated_at.isoformat(),
+                    'end_time_updated_at': shop_end_updated_at.isoformat(),
+                    'is_incremental': is_incremental,
+                })
+            
+            logger.info(f"Processing customers for shop: {shop.name} updated since {shop_start_updated_at} "
+                       f"({'watermark' if is_incremental else 'full window'})")
+            shop_result = _sync_shop_customers(
+                shop, 
+                start_time_updated_at=shop_start_updated_at,
+                end_time_updated_at=shop_end_updated_at,
+                checkpoint=checkpoint,
+                budget=budget
+            )
+        
+        # Order đang chờ customer của shop: gán lại ngay sau khi customers được ghi
+        try:
+            shop_result.orders_reassigned = _reassign_pending_orders(shop)
+        except Exception as e:
+            logger.error(f"Error reassigning pending orders for shop {shop.name}: {e}")
+            shop_result.errors.append(f"Order reassignment error: {str(e)}")
+        
+        logger.info(f"Shop {shop.name} completed: "
+                   f"{shop_result.customers_created + shop_result.customers_updated} customers, "
+                   f"{shop_result.addresses_created + shop_result.addresses_updated} addresses, "
+                   f"{shop_result.orders_reassigned} orders reassigned")
+        return shop_result
+    
+    def _advance_watermark(shop, checkpoint, shop_result):
+        # Chỉ tiến watermark khi cả run của shop không lỗi
+        if shop_result.errors or checkpoint.had_previous_errors:
+            return
+        shop_end_updated_at = checkpoint.params.get('end_time_updated_at')
+        advance_watermark(
+            shop, 'customers',
+            checkpoint.merged_watermark(shop_result.max_updated_at)
+            or (datetime.fromisoformat(shop_end_updated_at) if shop_end_updated_at else None)
+        )
+    
+    return run_shop_sync(self, shop_id, run_id, 'customers', _sync, _advance_watermark, carry=carry)
+
+@shared_task(bind=True)
+def finalize_customers_sync(self, shop_results: List[Dict], sync_history_id: int, run_id: str,
+                            task_name: str, sync_type: str, mode: Optional[str] = None,
+                            date_range: Optional[Dict] = None):
+    """Chord callback của sync_all_customers_30_days / sync_all_customers_full"""
+    vietnam_end = _get_vietnam_time()
+    sync_history = SyncHistory.objects.get(id=sync_history_id)
+    vietnam_start = _get_vietnam_time(sync_history.started_at)
+    duration = (vietnam_end - vietnam_start).total_seconds()
+    total_result = aggregate_shop_payloads(CustomerSyncResult(), shop_results)
+    
+    # Update sync history
+    sync_history.status = 'completed' if not total_result.errors else 'failed'
+    sync_history.created_records = total_result.customers_created
+    sync_history.updated_records = total_result.customers_updated
+    sync_history.failed_records = len(total_result.errors)
+    sync_history.finished_at = vietnam_end
+    sync_history.total_records = total_result.customers_created + total_result.customers_updated
+    sync_history.error_message = '; '.join(total_result.errors[:3]) if total_result.errors else None
+    sync_history.error_details = {
+        'total_errors': len(total_result.errors),
+        'errors': total_result.errors[:10],
+        'change_detection': {
+            'users_unchanged': total_result.users_unchanged,
+            'customers_unchanged': total_result.customers_unchanged,
+            'addresses_unchanged': total_result.addresses_unchanged,
+        },
+        'shop_results': shop_results,
+        'sync_type': sync_type,
+        'mode': mode,
+        'run_id': run_id,
+        'date_range': date_range
+    }
+    sync_history.save()
+    publish_sync_event('run_finished', entity='customers', run_id=run_id, sync_history_id=sync_history.id,
+                       status=sync_history.status, errors=len(total_result.errors))
+    
+    # Create summary
+    summary = {
+        'task_id': self.request.id,
+        'start_time': vietnam_start.isoformat(),
+        'end_time': vietnam_end.isoformat(),
+        'duration_seconds': duration,
+        'sync_type': sync_type,
+        'mode': mode,
+        'date_range': date_range,
+        'shops_processed': len(shop_results),
+        'users_created': total_result.users_created,
+        'users_updated': total_result.users_updated,
+        'customers_created': total_result.customers_created,
+        'customers_updated': total_result.customers_updated,
+        'addresses_created': total_result.addresses_created,
+        'addresses_updated': total_result.addresses_updated,
+        'customers_unchanged': total_result.customers_unchanged,
+        'orders_reassigned': total_result.orders_reassigned,
+        'total_errors': len(total_result.errors),
+        'error_details': total_result.errors[:10],
+        'success': len(total_result.errors) == 0,
+        'run_id': run_id,
+        'sync_history_id': sync_history.id
+    }
+    
+    # Log results
+    if summary['success']:
+        logger.info(f"{task_name} completed successfully: {summary}")
+    else:
+        logger.warning(f"{task_name} completed with errors: {summary}")
+    
+    return summary
+
+def _dispatch_customers_sync(task, task_name: str, sync_history_type: str, sync_type: str, run_id: str,
+                             mode: str, start_time_updated_at=None, end_time_updated_at=None) -> Dict:
+    """Tạo SyncHistory và dispatch chord customers theo shop, dùng chung cho 30 ngày và full"""
     vietnam_start = _get_vietnam_time()
+    sync_history = None
+    date_range = None
+    if start_time_updated_at and end_time_updated_at:
+        date_range = {
+            'start': start_time_updated_at.isoformat(),
+            'end': end_time_updated_at.isoformat()
+        }
     
     try:
-        from shops.models import Shop, SyncHistory
-        
         logger.info(f"Starting {task_name} at {vietnam_start}")
         
         # Create sync history record
         sync_history = SyncHistory.objects.create(
-            sync_type='customers_30_days',
+            sync_type=sync_history_type,
             status='running',
             started_at=vietnam_start,
-            total_records=0
+            total_records=0,
+            error_details={'sync_type': sync_type, 'mode': mode, 'run_id': run_id, 'date_range': date_range}
         )
         
-        shops = Shop.objects.all()
-        total_result = CustomerSyncResult()
-        shop_results = []
-        
-        # Calculate date range: today to 30 days ago
-        end_time_updated_at = vietnam_start
-        start_time_updated_at = vietnam_start - timedelta(days=30)
-        
-        logger.info(f"Found {shops.count()} shops to sync customers (30 days: {start_time_updated_at} to {end_time_updated_at})")
-        
-        for shop in shops:
-            try:
-                logger.info(f"Processing 30-day customers for shop: {shop.name}")
-                shop_result = _sync_shop_customers(
-                    shop, 
-                    start_time_updated_at=start_time_updated_at,
-                    end_time_updated_at=end_time_updated_at
-                )
-                
-                # Aggregate results
-                total_result.users_created += shop_result.users_created
-                total_result.users_updated += shop_result.users_updated
-                total_result.customers_created += shop_result.customers_created
-                total_result.customers_updated += shop_result.customers_updated
-                total_result.addresses_created += shop_result.addresses_created
-                total_result.addresses_updated += shop_result.addresses_updated
-                total_result.errors.extend(shop_result.errors)
-                
-                shop_results.append({
-                    'shop_id': shop.id,
-                    'shop_name': shop.name,
-                    'users_created': shop_result.users_created,
-                    'users_updated': shop_result.users_updated,
-                    'customers_created': shop_result.customers_created,
-                    'customers_updated': shop_result.customers_updated,
-                    'addresses_created': shop_result.addresses_created,
-                    'addresses_updated': shop_result.addresses_updated,
-                    'errors': shop_result.errors
-                })
-                
-                logger.info(f"Shop {shop.name} completed: "
-                           f"{shop_result.customers_created + shop_result.customers_updated} customers, "
-                           f"{shop_result.addresses_created + shop_result.addresses_updated} addresses")
-                
-            except Exception as e:
-                error_msg = f"Error processing shop {shop.name}: {str(e)}"
-                logger.error(error_msg, exc_info=True)
-                total_result.errors.append(error_msg)
-                shop_results.append({
-                    'shop_id': shop.id,
-                    'shop_name': shop.name,
-                    'error': error_msg
-                })
+        shop_ids = list(Shop.objects.order_by('id').values_list('id', flat=True))
+        logger.info(f"Found {len(shop_ids)} shops to sync customers ({mode}, window: {date_range or 'all'})")
         
-        vietnam_end = _get_vietnam_time()
-        duration = (vietnam_end - vietnam_start).total_seconds()
-        
-        # Update sync history
-        sync_history.status = 'completed' if not total_result.errors else 'failed'
-        sync_history.created_records = total_result.customers_created
-        sync_history.updated_records = total_result.customers_updated
-        sync_history.failed_records = len(total_result.errors)
-        sync_history.finished_at = vietnam_end
-        sync_history.total_records = total_result.customers_created + total_result.customers_updated
-        sync_history.error_message = '; '.join(total_result.errors[:3]) if total_result.errors else None
-        sync_history.error_details = {
-            'total_errors': len(total_result.errors),
-            'errors': total_result.errors[:10],
-            'shop_results': shop_results,
-            'sync_type': '30_days',
-            'date_range': {
-                'start': start_time_updated_at.isoformat(),
-                'end': end_time_updated_at.isoformat()
-            }
-        }
-        sync_history.save()
-        
-        # Create summary
-        summary = {
-            'task_id': self.request.id,
-            'start_time': vietnam_start.isoformat(),
-            'end_time': vietnam_end.isoformat(),
-            'duration_seconds': duration,
-            'sync_type': '30_days',
-            'date_range': {
-                'start': start_time_updated_at.isoformat(),
-                'end': end_time_updated_at.isoformat()
+        if not shop_ids:
+            sync_history.status = 'completed'
+            sync_history.finished_at = _get_vietnam_time()
+            sync_history.save()
+            return {'success': True, 'shops_processed': 0, 'sync_history_id': sync_history.id}
+        
+        stage = shop_chord(
+            sync_shop_customers_subtask, finalize_customers_sync, shop_ids,
+            callback_kwargs={
+                'sync_history_id': sync_history.id,
+                'run_id': run_id,
+                'task_name': task_name,
+                'sync_type': sync_type,
+                'mode': mode,
+                'date_range': date_range,
             },
-            'shops_processed': len(shop_results),
-            'users_created': total_result.users_created,
-            'users_updated': total_result.users_updated,
-            'customers_created': total_result.customers_created,
-            'customers_updated': total_result.customers_updated,
-            'addresses_created': total_result.addresses_created,
-            'addresses_updated': total_result.addresses_updated,
-            'total_errors': len(total_result.errors),
-            'error_details': total_result.errors[:10],
-            'success': len(total_result.errors) == 0,
-            'sync_history_id': sync_history.id
-        }
-        
-        # Log results
-        if summary['success']:
-            logger.info(f"{task_name} completed successfully: {summary}")
-        else:
-            logger.warning(f"{task_name} completed with errors: {summary}")
-        
-        # Send notification
-
+            run_id=run_id,
+            mode=mode,
+            start_time_updated_at=date_range['start'] if date_range else None,
+            end_time_updated_at=date_range['end'] if date_range else None
+        )
         
-        return summary
+        if not is_pipeline_stage(task):
+            chord_result = stage.apply_async()
+            return {
+                'task_id': task.request.id,
+                'start_time': vietnam_start.isoformat(),
+                'sync_type': sync_type,
+                'mode': mode,
+                'date_range': date_range,
+                'shops_dispatched': len(shop_ids),
+                'success': True,
+                'run_id': run_id,
+                'callback_task_id': chord_result.id,
+                'sync_history_id': sync_history.id
+            }
         
     except Exception as exc:
         vietnam_error = _get_vietnam_time()
-        error_summary = {
-            'task_id': self.request.id,
-            'error_time': vietnam_error.isoformat(),
-            'error_message': str(exc),
-            'sync_type': '30_days',
-            'retry_count': self.request.retries,
-            'max_retries': self.max_retries
-        }
-        
-        logger.error(f"Error in {task_name} task: {error_summary}", exc_info=True)
+        logger.error(f"Error in {task_name} task: {exc}", exc_info=True)
         
         # Update sync history for critical failure
-        try:
+        if sync_history is not None:
             sync_history.status = 'failed'
             sync_history.error_message = f"Critical error: {str(exc)}"
             sync_history.finished_at = vietnam_error
             sync_history.save()
-        except:
-            pass
         
-        # Retry if not exhausted
-        if self.request.retries < self.max_retries:
-            logger.info(f"Retrying {task_name} task in 5 minutes...")
-            raise self.retry(exc=exc, countdown=300)
-        
-        # Send error notification
-
-        
-        raise exc
+        raise
+    
+    # Stage của sync pipeline: stage sau chỉ chạy khi finalize_customers_sync xong
+    # (nằm ngoài try: replace() raise Ignore)
+    return task.replace(stage)
 
 @shared_task(bind=True)
-def sync_all_customers_full(self):
+def sync_all_customers_30_days(self, mode='incremental', run_id=None):
     """
-    Full customer sync for all shops (no date filter)
-    Should be run weekly or when needed
+    Sync customers for all shops
+    
+    Mỗi shop chạy trong một subtask riêng (chord), finalize_customers_sync gộp kết quả.
+    
+    Args:
+        mode: 'incremental' - chỉ fetch khách hàng cập nhật từ watermark của từng shop
+              (shop chưa có watermark thì fetch 30 ngày);
+              'reconcile' - deep reconcile, fetch lại toàn bộ 30 ngày gần nhất
+        run_id: Id của lần sync để resume từ checkpoint (mặc định là task id)
     """
-    task_name = "Full Customer Sync"
+    task_name = "30-Day Customer Sync" if mode == 'reconcile' else "Incremental Customer Sync"
     vietnam_start = _get_vietnam_time()
+    run_id = resolve_run_id(self, run_id)
     
     try:
-        from shops.models import Shop, SyncHistory
-        
-        logger.info(f"Starting {task_name} at {vietnam_start}")
-        
-        # Create sync history record
-        sync_history = SyncHistory.objects.create(
-            sync_type='customers_full',
-            status='running',
-            started_at=vietnam_start,
-            total_records=0
+        # Calculate date range: today to 30 days ago
+        return _dispatch_customers_sync(
+            self, task_name, 'customers_30_days', '30_days', run_id, mode,
+            start_time_updated_at=vietnam_start - timedelta(days=30),
+            end_time_updated_at=vietnam_start
         )
-        
-        shops = Shop.objects.all()
-        total_result = CustomerSyncResult()
-        shop_results = []
-        
-        logger.info(f"Found {shops.count()} shops for full customer sync")
-        
-        for shop in shops:
-            try:
-                logger.info(f"Processing all customers for shop: {shop.name}")
-                # No date filter for full sync
-                shop_result = _sync_shop_customers(shop)
-                
-                # Aggregate results
-                total_result.users_created += shop_result.users_created
-                total_result.users_updated += shop_result.users_updated
-                total_result.customers_created += shop_result.customers_created
-                total_result.customers_updated += shop_result.customers_updated
-                total_result.addresses_created += shop_result.addresses_created
-                total_result.addresses_updated += shop_result.addresses_updated
-                total_result.errors.extend(shop_result.errors)
-                
-                shop_results.append({
-                    'shop_id': shop.id,
-                    'shop_name': shop.name,
-                    'users_created': shop_result.users_created,
-                    'users_updated': shop_result.users_updated,
-                    'customers_created': shop_result.customers_created,
-                    'customers_updated': shop_result.customers_updated,
-                    'addresses_created': shop_result.addresses_created,
-                    'addresses_updated': shop_result.addresses_updated,
-                    'errors': shop_result.errors
-                })
-                
-                logger.info(f"Shop {shop.name} completed: "
-                           f"{shop_result.customers_created + shop_result.customers_updated} customers, "
-                           f"{shop_result.addresses_created + shop_result.addresses_updated} addresses")
-                
-            except Exception as e:
-                error_msg = f"Error processing shop {shop.name}: {str(e)}"
-                logger.error(error_msg, exc_info=True)
-                total_result.errors.append(error_msg)
-                shop_results.append({
-                    'shop_id': shop.id,
-                    'shop_name': shop.name,
-                    'error': error_msg
-                })
-        
-        vietnam_end = _get_vietnam_time()
-        duration = (vietnam_end - vietnam_start).total_seconds()
-        
-        # Update sync history
-        sync_history.status = 'completed' if not total_result.errors else 'failed'
-        sync_history.created_records = total_result.customers_created
-        sync_history.updated_records = total_result.customers_updated
-        sync_history.failed_records = len(total_result.errors)
-        sync_history.finished_at = vietnam_end
-        sync_history.total_records = total_result.customers_created + total_result.customers_updated
-        sync_history.error_message = '; '.join(total_result.errors[:3]) if total_result.errors else None
-        sync_history.error_details = {
-            'total_errors': len(total_result.errors),
-            'errors': total_result.errors[:10],
-            'shop_results': shop_results,
-            'sync_type': 'full'
-        }
-        sync_history.save()
-        
-        # Create summary
-        summary = {
-            'task_id': self.request.id,
-            'start_time': vietnam_start.isoformat(),
-            'end_time': vietnam_end.isoformat(),
-            'duration_seconds': duration,
-            'sync_type': 'full',
-            'shops_processed': len(shop_results),
-            'users_created': total_result.users_created,
-            'users_updated': total_result.users_updated,
-            'customers_created': total_result.customers_created,
-            'customers_updated': total_result.customers_updated,
-            'addresses_created': total_result.addresses_created,
-            'addresses_updated': total_result.addresses_updated,
-            'total_errors': len(total_result.errors),
-            'error_details': total_result.errors[:10],
-            'success': len(total_result.errors) == 0,
-            'sync_history_id': sync_history.id
-        }
-        
-        # Log results
-        if summary['success']:
-            logger.info(f"{task_name} completed successfully: {summary}")
-        else:
-            logger.warning(f"{task_name} completed with errors: {summary}")
-        
-        # Send notification
-
-        
-        return summary
-        
+    except Ignore:
+        # Đã replace bằng chord (stage của pipeline)
+        raise
     except Exception as exc:
-        vietnam_error = _get_vietnam_time()
-        error_summary = {
-            'task_id': self.request.id,
-            'error_time': vietnam_error.isoformat(),
-            'error_message': str(exc),
-            'sync_type': 'full',
-        }
-        
-        logger.error(f"Error in {task_name} task: {error_summary}", exc_info=True)
-        
-        # Update sync history for critical failure
-        try:
-            sync_history.status = 'failed'
-            sync_history.error_message = f"Critical error: {str(exc)}"
-            sync_history.finished_at = vietnam_error
-            sync_history.save()
-        except:
-            pass
-        
-        # Send error notification
+        # Retry if not exhausted
+        if self.request.retries < self.max_retries:
+            logger.info(f"Retrying {task_name} task in 5 minutes...")
+            raise self.retry(exc=exc, countdown=300)
+        raise
 
-        
-        raise exc
+@shared_task(bind=True)
+def sync_all_customers_full(self, run_id=None):
+    """
+    Full customer sync for all shops (no date filter)
+    Should be run weekly or when needed
+    
+    Args:
+        run_id: Id của lần sync để resume từ checkpoint (mặc định là task id)
+    """
+    run_id = resolve_run_id(self, run_id)
+    return _dispatch_customers_sync(self, "Full Customer Sync", 'customers_full', 'full', run_id, 'full')
 
 @shared_task
 def sync_customer_pipeline():
     """
-    Orchestrate customer sync pipeline with proper dependencies
-    Run this for scheduled customer syncs
+    Dispatch customer sync (30 ngày, incremental) thay vì chạy inline trong worker này
     """
     vietnam_start = _get_vietnam_time()
     logger.info(f"Starting customer sync pipeline at {vietnam_start}")
     
-    results = {
+    dispatch_result = sync_all_customers_30_days.apply_async()
+    
+    return {
+        'success': True,
         'start_time': vietnam_start.isoformat(),
-        '30_days_result': None,
-        'overall_success': True
+        'dispatch_task_id': dispatch_result.id
     }
-    
-    try:
-        # Run 30-day sync
-        logger.info("Running 30-day customer sync...")
-        sync_30_days_result = sync_all_customers_30_days.apply()
-        results['30_days_result'] = sync_30_days_result.result
-        
-        if not results['30_days_result']['success']:
-            results['overall_success'] = False
-            logger.warning("30-day customer sync had errors")
-        
-    except Exception as e:
-        logger.error(f"Error in customer sync pipeline: {e}", exc_info=True)
-        results['overall_success'] = False
-        results['error'] = str(e)
-    
-    vietnam_end = _get_vietnam_time()
-    results['end_time'] = vietnam_end.isoformat()
-    results['total_duration'] = (vietnam_end - vietnam_start).total_seconds()
-    
-    logger.info(f"Customer sync pipeline completed: {results}")
-    return results
 
 @shared_task
 def cleanup_old_customer_sync_histories():
@@ -2250,6 +2384,9 @@ def cleanup_old_customer_sync_histories():
                 deleted_count = SyncHistory.objects.filter(id__in=old_ids).delete()[0]
                 logger.info(f"Cleaned up {deleted_count} old {sync_type} sync histories")
         
+        # Task này chạy định kỳ trên beat nên dọn luôn checkpoint cũ của mọi entity
+        cleanup_old_checkpoints()
+        
         return {'success': True, 'message': 'Customer sync history cleanup completed'}
         
     except Exception as e:
@@ -2339,6 +2476,13 @@ class OrderSyncResult:
     partners_created: int = 0
     warehouses_created: int = 0
     histories_created: int = 0
+    customers_fetched: int = 0  # Customer chưa sync, fetch theo id trong lúc sync đơn
+    orders_unchanged: int = 0  # Bỏ qua ghi vì sync_hash không đổi
+    items_unchanged: int = 0
+    ref_cache_hits: int = 0  # Lookup users/customers/pages/products/variations không cần query
+    ref_cache_misses: int = 0
+    max_updated_at: Optional[datetime] = None  # Max updated_at từ API, dùng làm watermark
+    interrupted: bool = False  # Dừng giữa chừng do sắp hết thời gian, resume từ checkpoint
     errors: List[str] = None
     
     def __post_init__(self):
@@ -2357,8 +2501,26 @@ def _get_vietnam_time(dt=None):
     
     return dt.astimezone(VIETNAM_TZ)
 
-def _get_or_create_anonymous_customer(shop: Shop) -> Customer:
-    """Get or create anonymous customer for orders without customer data"""
+@dataclass
+class CustomerLookupState:
+    """Trạng thái fetch customer theo id trong một lần sync đơn của một shop"""
+    not_found: Set[str] = None  # Id Pancake không trả về, không hỏi lại trong run này
+    by_id_supported: bool = True  # False khi API bỏ qua filter customer_ids
+    
+    def __post_init__(self):
+        if self.not_found is None:
+            self.not_found = set()
+
+def _get_or_create_anonymous_customer(shop: Shop, ref_cache: Optional[RefCache] = None) -> Customer:
+    """
+    Get or create anonymous customer for orders without customer data
+    
+    Có ref_cache thì pk được nhớ trong run như các FK khác, không giữ instance qua các run.
+    """
+    if ref_cache:
+        cached = ref_cache.resolve(Customer, ['anonymous'], Customer.objects.filter(shop=shop))
+        if cached:
+            return cached['anonymous']
     try:
         anonymous_customer, created = Customer.objects.get_or_create(
             shop=shop,
@@ -2372,11 +2534,52 @@ def _get_or_create_anonymous_customer(shop: Shop) -> Customer:
         )
         if created:
             logger.info(f"Created anonymous customer for shop {shop.name}")
+        if ref_cache:
+            ref_cache.remember(Customer, [('anonymous', anonymous_customer.pk)])
         return anonymous_customer
     except Exception as e:
         logger.error(f"Error creating anonymous customer for shop {shop.name}: {e}")
         raise
 
+def _fetch_missing_customers(shop: Shop, customer_ids: Set, customers_map: Dict, result: OrderSyncResult,
+                             ref_cache: Optional[RefCache] = None,
+                             lookup: Optional[CustomerLookupState] = None) -> Dict:
+    """
+    Fetch và upsert các customer mà order trong trang tham chiếu nhưng chưa có trong DB,
+    trả về customers_map đã bổ sung để order được gán đúng customer ngay trong lần ghi này.
+    Lỗi fetch không chặn trang đơn hàng: order rơi về anonymous customer + pending_customer_pancake_id.
+    
+    lookup (một instance cho cả run): id Pancake không trả về không bị hỏi lại ở các trang sau;
+    API bỏ qua filter customer_ids thì tắt fetch theo id cho phần còn lại của run.
+    """
+    if lookup is None:
+        lookup = CustomerLookupState()
+    if not lookup.by_id_supported:
+        return customers_map
+    
+    missing_ids = ({str(customer_id) for customer_id in customer_ids}
+                   - {str(pid) for pid in customers_map} - lookup.not_found)
+    if not missing_ids:
+        return customers_map
+    
+    try:
+        customers_data, filter_applied = _fetch_customers_by_ids(shop.pancake_id, list(missing_ids))
+        if customers_data:
+            fetched_map = _upsert_customers_batch(shop, customers_data, CustomerSyncResult())
+            if ref_cache:
+                ref_cache.remember(Customer, ((pancake_id, c.pk) for pancake_id, c in fetched_map.items()))
+            customers_map = {**customers_map, **fetched_map}
+        result.customers_fetched += len(customers_data)
+        if filter_applied:
+            lookup.not_found |= missing_ids - {str(c.get('id')) for c in customers_data}
+        else:
+            lookup.by_id_supported = False
+        logger.info(f"Fetched {len(customers_data)}/{len(missing_ids)} missing customers for shop {shop.name}")
+    except Exception as e:
+        logger.warning(f"Error fetching {len(missing_ids)} missing customers for shop {shop.name}: {e}")
+    
+    return customers_map
+
 def _parse_datetime(datetime_str: Optional[str]) -> Optional[timezone.datetime]:
     """Parse datetime string from API and convert to Vietnam timezone"""
     if not datetime_str:
@@ -2439,15 +2642,15 @@ def _get_or_create_choice_value(model_class, field_name: str, value, display_nam
     
     return value
 
-def _get_date_range_timestamps():
-    """Get timestamp range for last 30 days"""
+def _get_date_range_timestamps(days: int = 30):
+    """Get timestamp range for last N days (default 30)"""
     vietnam_now = _get_vietnam_time()
     
     # End date: today at 23:59:59
     end_date = vietnam_now.replace(hour=23, minute=59, second=59, microsecond=999999)
     
-    # Start date: 30 days ago at 00:00:00
-    start_date = (vietnam_now - timedelta(days=30)).replace(hour=0, minute=0, second=0, microsecond=0)
+    # Start date: N days ago at 00:00:00
+    start_date = (vietnam_now - timedelta(days=days)).replace(hour=0, minute=0, second=0, microsecond=0)
     
     # Convert to Unix timestamp
     start_timestamp = int(start_date.timestamp())
@@ -2458,9 +2661,7 @@ def _get_date_range_timestamps():
 # ===== API FUNCTIONS =====
 def _fetch_orders_page_with_date_range(shop_id: int, start_timestamp: int, end_timestamp: int, page: int = 1, page_size: int = 100) -> Dict:
     """Fetch single page of orders from Pancake API with date range"""
-    api_url = f"{settings.PANCAKE_API_BASE_URL}/shops/{shop_id}/orders"
     params = {
-        'api_key': settings.PANCAKE_API_KEY,
         'updateStatus': 'updated_at',
         'startDateTime': start_timestamp,
         'endDateTime': end_timestamp,
@@ -2471,10 +2672,9 @@ def _fetch_orders_page_with_date_range(shop_id: int, start_timestamp: int, end_t
     logger.info(f"Fetching orders for shop {shop_id}, page {page} with date range {start_timestamp}-{end_timestamp}")
     
     try:
-        response = requests.get(api_url, params=params, timeout=300)
-        response.raise_for_status()
-        
-        data = response.json()
+        data = get_pancake_client().get_json(
+            f"shops/{shop_id}/orders", params=params, endpoint='orders'
+        )
         logger.info(f"API response: success={data.get('success')}, page={data.get('page_number')}, "
                     f"total_pages={data.get('total_pages')}, data_count={len(data.get('data', []))}")
         
@@ -2484,7 +2684,8 @@ def _fetch_orders_page_with_date_range(shop_id: int, start_timestamp: int, end_t
         raise
 
 # ===== DATA EXTRACTION FUNCTIONS =====
-def _extract_orders_data(orders_data: List[Dict], shop: Shop, users_map: Dict, customers_map: Dict, pages_map: Dict) -> List[Dict]:
+def _extract_orders_data(orders_data: List[Dict], shop: Shop, users_map: Dict, customers_map: Dict, pages_map: Dict,
+                         ref_cache: Optional[RefCache] = None) -> List[Dict]:
     """Extract orders data from API response"""
     orders = []
     vietnam_now = _get_vietnam_time()
@@ -2535,21 +2736,19 @@ def _extract_orders_data(orders_data: List[Dict], shop: Shop, users_map: Dict, c
             
             # Customer - handle missing customer with anonymous customer and track for later reassignment
             customer_data = order_data.get('customer')
-            customer_pancake_id_from_order = None
+            pending_customer_pancake_id = None
             
             if customer_data and customer_data.get('id'):
-                customer_pancake_id_from_order = customer_data['id']
-                customer = customers_map.get(customer_pancake_id_from_order)
+                customer = customers_map.get(customer_data['id'])
                 
                 if not customer:
-                    logger.warning(f"Customer {customer_pancake_id_from_order} not found for order {order_id}, using anonymous customer")
-                    customer = _get_or_create_anonymous_customer(shop)
-                    # Lưu customer_id từ API vào order note để có thể reassign sau
-                    original_note = order_data.get('note', '')
-                    order_data['note'] = f"{original_note}\n[MISSING_CUSTOMER_ID:{customer_pancake_id_from_order}]".strip()
+                    logger.warning(f"Customer {customer_data['id']} not found for order {order_id}, using anonymous customer")
+                    customer = _get_or_create_anonymous_customer(shop, ref_cache)
+                    # Lưu customer_id từ API để reassign sau khi sync customers
+                    pending_customer_pancake_id = str(customer_data['id'])
             else:
                 logger.warning(f"Order {order_id} has no customer data, using anonymous customer")
-                customer = _get_or_create_anonymous_customer(shop)
+                customer = _get_or_create_anonymous_customer(shop, ref_cache)
             
             # Page
             page_data = order_data.get('page')
@@ -2598,6 +2797,7 @@ def _extract_orders_data(orders_data: List[Dict], shop: Shop, users_map: Dict, c
                 'marketer': marketer,
                 'last_editor': last_editor,
                 'customer': customer,
+                'pending_customer_pancake_id': pending_customer_pancake_id,
                 'page': page,
                 
                 # Pricing
@@ -2820,88 +3020,63 @@ def _extract_items_data(orders_data: List[Dict], products_map: Dict, variations_
     return items
 
 # ===== BULK UPSERT FUNCTIONS =====
-def _safe_bulk_upsert_orders(orders_data: List[Dict]) -> Tuple[int, int]:
-    """Safely bulk create/update orders with transaction management"""
-    if not orders_data:
-        return 0, 0
+def _safe_bulk_upsert_orders(orders_data: List[Dict]) -> Tuple[int, int, int]:
+    """
+    Upsert orders (INSERT ... ON DUPLICATE KEY UPDATE), bỏ qua đơn không đổi (sync_hash)
     
-    shop = orders_data[0]['shop']
-    pancake_ids = [o['pancake_id'] for o in orders_data]
+    Returns:
+        (created, updated, unchanged)
+    """
+    if not orders_data:
+        return 0, 0, 0
     
     created_count = 0
     updated_count = 0
+    unchanged_count = 0
     
     try:
-        # Get existing orders
-        existing_orders = {
-            o.pancake_id: o for o in Order.objects.filter(
-                pancake_id__in=pancake_ids, shop=shop
-            )
-        }
-        
-        orders_to_create = []
-        orders_to_update = []
-        
-        for order_data in orders_data:
-            pancake_id = order_data['pancake_id']
-            
-            # Remove related data before creating model instance
-            related_data_fields = [
-                'shipping_address_data', 'warehouse_info_data', 'partner_data',
-                'items_data', 'status_history_data', 'histories_data'
-            ]
-            clean_order_data = {k: v for k, v in order_data.items() if k not in related_data_fields}
-            
-            if pancake_id in existing_orders:
-                # Update existing
-                order = existing_orders[pancake_id]
-                for field, value in clean_order_data.items():
-                    if field != 'shop':
-                        setattr(order, field, value)
-                orders_to_update.append(order)
-            else:
-                # Create new
-                orders_to_create.append(Order(**clean_order_data))
-        
-        # Use separate transactions for create and update
-        if orders_to_create:
-            with transaction.atomic():
-                Order.objects.bulk_create(orders_to_create, batch_size=100, ignore_conflicts=True)
-                created_count = len(orders_to_create)
-                logger.info(f"Bulk created {created_count} orders")
-        
-        if orders_to_update:
-            with transaction.atomic():
-                # Define fields to update
-                fields_to_update = [
-                    'status', 'sub_status', 'order_sources', 'order_sources_name',
-                    'total_price', 'total_discount', 'total_price_after_sub_discount',
-                    'shipping_fee', 'partner_fee', 'tax', 'cod', 'prepaid',
-                    'transfer_money', 'money_to_collect', 'charged_by_card',
-                    'charged_by_momo', 'charged_by_qrpay', 'cash', 'exchange_payment',
-                    'exchange_value', 'surcharge', 'levera_point', 'bank_payments',
-                    'prepaid_by_point', 'advanced_platform_fee', 'bill_full_name',
-                    'bill_phone_number', 'bill_email', 'is_free_shipping',
-                    'is_livestream', 'is_live_shopping', 'is_exchange_order',
-                    'is_smc', 'customer_pay_fee', 'received_at_shop', 'return_fee',
-                    'warehouse_id', 'note', 'note_print', 'note_image', 'link',
-                    'link_confirm_order', 'order_link', 'account', 'account_name',
-                    'page_external_id', 'conversation_id', 'post_id', 'ad_id', 'ads_source',
-                    'p_utm_source', 'p_utm_medium', 'p_utm_campaign', 'p_utm_content',
-                    'p_utm_term', 'p_utm_id', 'customer_referral_code', 'pke_mkter',
-                    'marketplace_id', 'fee_marketplace', 'tags', 'customer_needs',
-                    'activated_combo_products', 'activated_promotion_advances',
-                    'payment_purchase_histories', 'total_quantity', 'items_length',
-                    'returned_reason', 'returned_reason_name', 'time_assign_seller',
-                    'time_assign_care', 'time_send_partner', 'estimate_delivery_date',
-                    'buyer_total_amount', 'updated_at_api', 'order_currency',
-                    'last_sync', 'creator', 'assigning_seller', 'assigning_care',
-                    'marketer', 'last_editor', 'customer', 'page'
-                ]
-                
-                Order.objects.bulk_update(orders_to_update, fields_to_update, batch_size=100)
-                updated_count = len(orders_to_update)
-                logger.info(f"Bulk updated {updated_count} orders")
+        # Remove related data before creating model instance
+        related_data_fields = [
+            'shipping_address_data', 'warehouse_info_data', 'partner_data',
+            'items_data', 'status_history_data', 'histories_data'
+        ]
+        orders_to_upsert = [
+            Order(**{k: v for k, v in order_data.items() if k not in related_data_fields})
+            for order_data in orders_data
+        ]
+        
+        # Define fields to update
+        fields_to_update = [
+            'status', 'sub_status', 'order_sources', 'order_sources_name',
+            'total_price', 'total_discount', 'total_price_after_sub_discount',
+            'shipping_fee', 'partner_fee', 'tax', 'cod', 'prepaid',
+            'transfer_money', 'money_to_collect', 'charged_by_card',
+            'charged_by_momo', 'charged_by_qrpay', 'cash', 'exchange_payment',
+            'exchange_value', 'surcharge', 'levera_point', 'bank_payments',
+            'prepaid_by_point', 'advanced_platform_fee', 'bill_full_name',
+            'bill_phone_number', 'bill_email', 'is_free_shipping',
+            'is_livestream', 'is_live_shopping', 'is_exchange_order',
+            'is_smc', 'customer_pay_fee', 'received_at_shop', 'return_fee',
+            'warehouse_id', 'note', 'note_print', 'note_image', 'link',
+            'link_confirm_order', 'order_link', 'account', 'account_name',
+            'page_external_id', 'conversation_id', 'post_id', 'ad_id', 'ads_source',
+            'p_utm_source', 'p_utm_medium', 'p_utm_campaign', 'p_utm_content',
+            'p_utm_term', 'p_utm_id', 'customer_referral_code', 'pke_mkter',
+            'marketplace_id', 'fee_marketplace', 'tags', 'customer_needs',
+            'activated_combo_products', 'activated_promotion_advances',
+            'payment_purchase_histories', 'total_quantity', 'items_length',
+            'returned_reason', 'returned_reason_name', 'time_assign_seller',
+            'time_assign_care', 'time_send_partner', 'estimate_delivery_date',
+            'buyer_total_amount', 'updated_at_api', 'order_currency',
+            'last_sync', 'creator', 'assigning_seller', 'assigning_care',
+            'marketer', 'last_editor', 'customer', 'pending_customer_pancake_id', 'page'
+        ]
+        
+        result = bulk_upsert(Order, orders_to_upsert, unique_fields=['shop', 'pancake_id'],
+                             update_fields=fields_to_update, batch_size=100, hash_field='sync_hash')
+        created_count, updated_count, unchanged_count = result.created, result.updated, result.unchanged
+        logger.info(f"Upserted orders: {created_count} created, {updated_count} updated, "
+                    f"{unchanged_count} unchanged")
         
     except Exception as e:
         logger.error(f"Error in bulk upsert orders: {e}", exc_info=True)
@@ -2909,10 +3084,10 @@ def _safe_bulk_upsert_orders(orders_data: List[Dict]) -> Tuple[int, int]:
         _reset_database_connection()
         raise
     
-    return created_count, updated_count
+    return created_count, updated_count, unchanged_count
 
 def _safe_bulk_upsert_shipping_addresses(addresses_data: List[Dict], orders_map: Dict) -> Tuple[int, int]:
-    """Safely bulk create/update shipping addresses"""
+    """Upsert shipping addresses (một địa chỉ mỗi order)"""
     if not addresses_data:
         return 0, 0
     
@@ -2932,46 +3107,20 @@ def _safe_bulk_upsert_shipping_addresses(addresses_data: List[Dict], orders_map:
     updated_count = 0
     
     try:
-        order_ids = [a['order'].id for a in valid_addresses]
-        existing_addresses = {
-            a.order_id: a for a in OrderShippingAddress.objects.filter(order_id__in=order_ids)
-        }
-        
-        addresses_to_create = []
-        addresses_to_update = []
-        
-        for address_data in valid_addresses:
-            order_id = address_data['order'].id
-            
-            if order_id in existing_addresses:
-                # Update existing
-                address = existing_addresses[order_id]
-                for field, value in address_data.items():
-                    if field != 'order':
-                        setattr(address, field, value)
-                addresses_to_update.append(address)
-            else:
-                # Create new
-                addresses_to_create.append(OrderShippingAddress(**address_data))
-        
-        if addresses_to_create:
-            with transaction.atomic():
-                OrderShippingAddress.objects.bulk_create(addresses_to_create, batch_size=100, ignore_conflicts=True)
-                created_count = len(addresses_to_create)
-                logger.info(f"Bulk created {created_count} shipping addresses")
-        
-        if addresses_to_update:
-            with transaction.atomic():
-                fields_to_update = [
-                    'full_name', 'phone_number', 'address', 'full_address',
-                    'country_code', 'province_id', 'province_name', 'district_id',
-                    'district_name', 'commune_id', 'commune_name', 'commnue_name',
-                    'new_province_id', 'new_commune_id', 'new_full_address',
-                    'post_code', 'marketplace_address', 'render_type', 'commune_code_sicepat'
-                ]
-                OrderShippingAddress.objects.bulk_update(addresses_to_update, fields_to_update, batch_size=100)
-                updated_count = len(addresses_to_update)
-                logger.info(f"Bulk updated {updated_count} shipping addresses")
+        fields_to_update = [
+            'full_name', 'phone_number', 'address', 'full_address',
+            'country_code', 'province_id', 'province_name', 'district_id',
+            'district_name', 'commune_id', 'commune_name', 'commnue_name',
+            'new_province_id', 'new_commune_id', 'new_full_address',
+            'post_code', 'marketplace_address', 'render_type', 'commune_code_sicepat'
+        ]
+        result = bulk_upsert(
+            OrderShippingAddress, [OrderShippingAddress(**address_data) for address_data in valid_addresses],
+            unique_fields=['order'], update_fields=fields_to_update, batch_size=100, hash_field='sync_hash'
+        )
+        created_count, updated_count = result.created, result.updated
+        logger.info(f"Upserted shipping addresses: {created_count} created, {updated_count} updated, "
+                    f"{result.unchanged} unchanged")
                 
     except Exception as e:
         logger.error(f"Error in bulk upsert shipping addresses: {e}", exc_info=True)
@@ -2980,10 +3129,10 @@ def _safe_bulk_upsert_shipping_addresses(addresses_data: List[Dict], orders_map:
     
     return created_count, updated_count
 
-def _safe_bulk_upsert_order_items(items_data: List[Dict], orders_map: Dict) -> Tuple[int, int]:
-    """Safely bulk create/update order items"""
+def _safe_bulk_upsert_order_items(items_data: List[Dict], orders_map: Dict) -> Tuple[int, int, int]:
+    """Upsert order items theo (order, item_id), bỏ qua item không đổi. Returns (created, updated, unchanged)"""
     if not items_data:
-        return 0, 0
+        return 0, 0, 0
     
     # Filter valid items
     valid_items = []
@@ -2995,68 +3144,41 @@ def _safe_bulk_upsert_order_items(items_data: List[Dict], orders_map: Dict) -> T
             valid_items.append(item_data)
     
     if not valid_items:
-        return 0, 0
+        return 0, 0, 0
     
     created_count = 0
     updated_count = 0
+    unchanged_count = 0
     
     try:
-        # Get existing items
-        order_item_pairs = [(item['order'].id, item['item_id']) for item in valid_items]
-        existing_items = {}
-        for item in OrderItem.objects.filter(order_id__in=[pair[0] for pair in order_item_pairs]):
-            existing_items[(item.order_id, item.item_id)] = item
-        
-        items_to_create = []
-        items_to_update = []
-        
-        for item_data in valid_items:
-            order_id = item_data['order'].id
-            item_id = item_data['item_id']
-            key = (order_id, item_id)
-            
-            if key in existing_items:
-                # Update existing
-                item = existing_items[key]
-                for field, value in item_data.items():
-                    if field not in ['order', 'item_id']:
-                        setattr(item, field, value)
-                items_to_update.append(item)
-            else:
-                # Create new
-                items_to_create.append(OrderItem(**item_data))
-        
-        if items_to_create:
-            with transaction.atomic():
-                OrderItem.objects.bulk_create(items_to_create, batch_size=100, ignore_conflicts=True)
-                created_count = len(items_to_create)
-                logger.info(f"Bulk created {created_count} order items")
-        
-        if items_to_update:
-            with transaction.atomic():
-                fields_to_update = [
-                    'product', 'variation', 'quantity', 'added_to_cart_quantity',
-                    'retail_price', 'discount_each_product', 'same_price_discount',
-                    'total_discount', 'is_bonus_product', 'is_composite',
-                    'is_discount_percent', 'is_wholesale', 'one_time_product',
-                    'return_quantity', 'returned_count', 'returning_quantity',
-                    'exchange_count', 'composite_item_id', 'measure_group_id',
-                    'note', 'note_product', 'components', 'variation_info'
-                ]
-                OrderItem.objects.bulk_update(items_to_update, fields_to_update, batch_size=100)
-                updated_count = len(items_to_update)
-                logger.info(f"Bulk updated {updated_count} order items")
+        fields_to_update = [
+            'product', 'variation', 'quantity', 'added_to_cart_quantity',
+            'retail_price', 'discount_each_product', 'same_price_discount',
+            'total_discount', 'is_bonus_product', 'is_composite',
+            'is_discount_percent', 'is_wholesale', 'one_time_product',
+            'return_quantity', 'returned_count', 'returning_quantity',
+            'exchange_count', 'composite_item_id', 'measure_group_id',
+            'note', 'note_product', 'components', 'variation_info'
+        ]
+        result = bulk_upsert(
+            OrderItem, [OrderItem(**item_data) for item_data in valid_items],
+            unique_fields=['order', 'item_id'], update_fields=fields_to_update, batch_size=100,
+            hash_field='sync_hash'
+        )
+        created_count, updated_count, unchanged_count = result.created, result.updated, result.unchanged
+        logger.info(f"Upserted order items: {created_count} created, {updated_count} updated, "
+                    f"{unchanged_count} unchanged")
                 
     except Exception as e:
         logger.error(f"Error in bulk upsert order items: {e}", exc_info=True)
         _reset_database_connection()
         raise
     
-    return created_count, updated_count
+    return created_count, updated_count, unchanged_count
 
 # ===== WAREHOUSE, PARTNER AND HISTORY FUNCTIONS =====
 def _bulk_upsert_warehouses(orders_data: List[Dict], orders_map: Dict) -> int:
-    """Bulk create/update order warehouses"""
+    """Upsert order warehouses (một warehouse mỗi order)"""
     warehouses_data = []
     
     for order_data in orders_data:
@@ -3089,53 +3211,29 @@ def _bulk_upsert_warehouses(orders_data: List[Dict], orders_map: Dict) -> int:
     created_count = 0
     
     try:
-        # Get existing warehouses
-        order_ids = [w['order'].id for w in warehouses_data]
-        existing_warehouses = {
-            w.order_id: w for w in OrderWarehouse.objects.filter(order_id__in=order_ids)
-        }
-        
-        warehouses_to_create = []
-        warehouses_to_update = []
-        
-        for warehouse_data in warehouses_data:
-            order_id = warehouse_data['order'].id
-            
-            if order_id in existing_warehouses:
-                # Update existing
-                warehouse = existing_warehouses[order_id]
-                for field, value in warehouse_data.items():
-                    if field != 'order':
-                        setattr(warehouse, field, value)
-                warehouses_to_update.append(warehouse)
-            else:
-                # Create new
-                warehouses_to_create.append(OrderWarehouse(**warehouse_data))
-        
-        if warehouses_to_create:
-            with transaction.atomic():
-                OrderWarehouse.objects.bulk_create(warehouses_to_create, batch_size=100, ignore_conflicts=True)
-                created_count = len(warehouses_to_create)
-                logger.info(f"Bulk created {created_count} warehouses")
-        
-        if warehouses_to_update:
-            with transaction.atomic():
-                fields_to_update = [
-                    'name', 'address', 'full_address', 'phone_number', 'province_id',
-                    'district_id', 'commune_id', 'postcode', 'settings',
-                    'has_snappy_service', 'custom_id', 'affiliate_id', 'ffm_id'
-                ]
-                OrderWarehouse.objects.bulk_update(warehouses_to_update, fields_to_update, batch_size=100)
-                logger.info(f"Bulk updated {len(warehouses_to_update)} warehouses")
+        fields_to_update = [
+            'name', 'address', 'full_address', 'phone_number', 'province_id',
+            'district_id', 'commune_id', 'postcode', 'settings',
+            'has_snappy_service', 'custom_id', 'affiliate_id', 'ffm_id'
+        ]
+        result = bulk_upsert(
+            OrderWarehouse, [OrderWarehouse(**data) for data in warehouses_data],
+            unique_fields=['order'], update_fields=fields_to_update, batch_size=100,
+            hash_field='sync_hash'
+        )
+        created_count = result.created
+        logger.info(f"Upserted warehouses: {result.created} created, {result.updated} updated, "
+                    f"{result.unchanged} unchanged")
                 
     except Exception as e:
         logger.error(f"Error bulk processing warehouses: {e}", exc_info=True)
         _reset_database_connection()
+        raise
     
     return created_count
 
 def _bulk_upsert_partners(orders_data: List[Dict], orders_map: Dict) -> int:
-    """Bulk create/update order partners"""
+    """Upsert order partners (một partner mỗi order)"""
     partners_data = []
     
     for order_data in orders_data:
@@ -3178,58 +3276,75 @@ def _bulk_upsert_partners(orders_data: List[Dict], orders_map: Dict) -> int:
     created_count = 0
     
     try:
-        # Get existing partners
-        order_ids = [p['order'].id for p in partners_data]
-        existing_partners = {
-            p.order_id: p for p in OrderPartner.objects.filter(order_id__in=order_ids)
-        }
-        
-        partners_to_create = []
-        partners_to_update = []
-        
-        for partner_data in partners_data:
-            order_id = partner_data['order'].id
-            
-            if order_id in existing_partners:
-                # Update existing
-                partner = existing_partners[order_id]
-                for field, value in partner_data.items():
-                    if field != 'order':
-                        setattr(partner, field, value)
-                partners_to_update.append(partner)
-            else:
-                # Create new
-                partners_to_create.append(OrderPartner(**partner_data))
-        
-        if partners_to_create:
-            with transaction.atomic():
-                OrderPartner.objects.bulk_create(partners_to_create, batch_size=100, ignore_conflicts=True)
-                created_count = len(partners_to_create)
-                logger.info(f"Bulk created {created_count} partners")
-        
-        if partners_to_update:
-            with transaction.atomic():
-                fields_to_update = [
-                    'partner_id', 'partner_name', 'partner_status', 'extend_code',
-                    'order_number_vtp', 'sort_code', 'custom_partner_id', 'cod',
-                    'total_fee', 'delivery_name', 'delivery_tel', 'count_of_delivery',
-                    'system_created', 'is_returned', 'is_ghn_v2', 'printed_form',
-                    'order_id_ghn', 'first_delivery_at', 'picked_up_at', 'paid_at',
-                    'updated_at_partner', 'service_partner', 'extend_update'
-                ]
-                OrderPartner.objects.bulk_update(partners_to_update, fields_to_update, batch_size=100)
-                logger.info(f"Bulk updated {len(partners_to_update)} partners")
+        fields_to_update = [
+            'partner_id', 'partner_name', 'partner_status', 'extend_code',
+            'order_number_vtp', 'sort_code', 'custom_partner_id', 'cod',
+            'total_fee', 'delivery_name', 'delivery_tel', 'count_of_delivery',
+            'system_created', 'is_returned', 'is_ghn_v2', 'printed_form',
+            'order_id_ghn', 'first_delivery_at', 'picked_up_at', 'paid_at',
+            'updated_at_partner', 'service_partner', 'extend_update'
+        ]
+        result = bulk_upsert(
+            OrderPartner, [OrderPartner(**data) for data in partners_data],
+            unique_fields=['order'], update_fields=fields_to_update, batch_size=100,
+            hash_field='sync_hash'
+        )
+        created_count = result.created
+        logger.info(f"Upserted partners: {result.created} created, {result.updated} updated, "
+                    f"{result.unchanged} unchanged")
                 
     except Exception as e:
         logger.error(f"Error bulk processing partners: {e}", exc_info=True)
         _reset_database_connection()
+        raise
     
     return created_count
 
+def _history_content(history):
+    """Nội dung của một entry lịch sử, không gồm thời gian"""
+    if isinstance(history, OrderStatusHistory):
+        return history.status, history.old_status, history.editor_fb
+    return compute_fingerprint(history.changes)
+
+def _rekey_legacy_histories(model, missing_undated: Dict[Tuple, object], current_keys: Set[Tuple]) -> Set[Tuple]:
+    """
+    Row ghi trước khi có history_key cho entry không có updated_at upstream lưu updated_at là
+    thời điểm sync, nên migration 0016 key nó theo thời điểm đó; runtime key entry như vậy theo
+    epoch 0. Gán lại key cho row cũ cùng đơn, cùng nội dung (và không khớp entry nào trong
+    response) thay vì insert bản trùng. Trả về các (order_id, key) đã gán lại.
+    """
+    wanted = {}
+    for key, history in missing_undated.items():
+        wanted.setdefault((key[0], _history_content(history)), []).append(key)
+    
+    rekeyed = set()
+    to_update = []
+    for row in model.objects.filter(order_id__in={order_id for order_id, _ in missing_undated}):
+        if (row.order_id, row.history_key) in current_keys:
+            continue
+        keys = wanted.get((row.order_id, _history_content(row)))
+        if keys:
+            key = keys.pop()
+            row.history_key = key[1]
+            to_update.append(row)
+            rekeyed.add(key)
+    
+    if to_update:
+        model.objects.bulk_update(to_update, ['history_key'], batch_size=100)
+        logger.info(f"Re-keyed {len(to_update)} legacy {model._meta.db_table} rows without upstream updated_at")
+    return rekeyed
+
 def _bulk_upsert_histories(orders_data: List[Dict], orders_map: Dict, users_map: Dict) -> int:
-    """Bulk create order status histories"""
-    status_histories_data = []
-    order_histories_data = []
+    """
+    Ghi lịch sử đơn hàng append-only: mỗi entry có history_key (hash nội dung),
+    chỉ insert entry chưa có (insert-ignore theo unique (order, history_key)), không xoá row nào.
+    
+    Returns:
+        Số entry mới
+    """
+    status_histories = {}
+    order_histories = {}
+    undated_keys = set()  # (order_id, key) của entry không có updated_at upstream
     vietnam_now = _get_vietnam_time()
     
     for order_data in orders_data:
@@ -3247,16 +3362,27 @@ def _bulk_upsert_histories(orders_data: List[Dict], orders_map: Dict, users_map:
             if editor_id:
                 editor = users_map.get(editor_id)
             
-            status_histories_data.append({
-                'order': order,
-                'editor': editor,
-                'editor_fb': status_data.get('editor_fb'),
-                'name': status_data.get('name'),
-                'avatar_url': status_data.get('avatar_url'),
-                'old_status': status_data.get('old_status'),
-                'status': status_data.get('status', 0),
-                'updated_at': _parse_datetime(status_data.get('updated_at')) or vietnam_now,
-            })
+            # Key theo giá trị upstream (thiếu updated_at -> epoch 0) để entry không có thời gian
+            # vẫn có key cố định giữa các lần sync; vietnam_now chỉ dùng cho cột updated_at
+            upstream_updated_at = _parse_datetime(status_data.get('updated_at'))
+            updated_at = upstream_updated_at or vietnam_now
+            history_key = status_history_key(
+                upstream_updated_at, status_data.get('status', 0), status_data.get('old_status'),
+                status_data.get('editor_fb')
+            )
+            if upstream_updated_at is None:
+                undated_keys.add((order.id, history_key))
+            status_histories[(order.id, history_key)] = OrderStatusHistory(
+                order=order,
+                editor=editor,
+                editor_fb=status_data.get('editor_fb'),
+                name=status_data.get('name'),
+                avatar_url=status_data.get('avatar_url'),
+                old_status=status_data.get('old_status'),
+                status=status_data.get('status', 0),
+                updated_at=updated_at,
+                history_key=history_key,
+            )
         
         # Order histories
         histories_list = order_data.get('histories_data', [])
@@ -3271,54 +3397,68 @@ def _bulk_upsert_histories(orders_data: List[Dict], orders_map: Dict, users_map:
             changes.pop('editor_id', None)
             changes.pop('updated_at', None)
             
-            order_histories_data.append({
-                'order': order,
-                'editor': editor,
-                'changes': changes,
-                'updated_at': _parse_datetime(history_data.get('updated_at')) or vietnam_now,
-            })
+            upstream_updated_at = _parse_datetime(history_data.get('updated_at'))
+            updated_at = upstream_updated_at or vietnam_now
+            history_key = order_history_key(upstream_updated_at, changes)
+            if upstream_updated_at is None:
+                undated_keys.add((order.id, history_key))
+            order_histories[(order.id, history_key)] = OrderHistory(
+                order=order,
+                editor=editor,
+                changes=changes,
+                updated_at=updated_at,
+                history_key=history_key,
+            )
     
     created_count = 0
     
     try:
-        # Create status histories
-        if status_histories_data:
-            with transaction.atomic():
-                # Delete existing status histories for these orders to avoid duplicates
-                order_ids = list(set(h['order'].id for h in status_histories_data))
-                OrderStatusHistory.objects.filter(order_id__in=order_ids).delete()
-                
-                OrderStatusHistory.objects.bulk_create(
-                    [OrderStatusHistory(**data) for data in status_histories_data],
-                    batch_size=100
-                )
-                created_count += len(status_histories_data)
-                logger.info(f"Bulk created {len(status_histories_data)} status histories")
-        
-        # Create order histories
-        if order_histories_data:
-            with transaction.atomic():
-                # Delete existing order histories for these orders to avoid duplicates
-                order_ids = list(set(h['order'].id for h in order_histories_data))
-                OrderHistory.objects.filter(order_id__in=order_ids).delete()
-                
-                OrderHistory.objects.bulk_create(
-                    [OrderHistory(**data) for data in order_histories_data],
-                    batch_size=100
-                )
-                created_count += len(order_histories_data)
-                logger.info(f"Bulk created {len(order_histories_data)} order histories")
+        for model, histories in ((OrderStatusHistory, status_histories), (OrderHistory, order_histories)):
+            if not histories:
+                continue
+            
+            existing_keys = set(
+                model.objects.filter(
+                    order_id__in={order_id for order_id, _ in histories}
+                ).values_list('order_id', 'history_key')
+            )
+            missing_undated = {
+                key: history for key, history in histories.items()
+                if key in undated_keys and key not in existing_keys
+            }
+            if missing_undated:
+                existing_keys |= _rekey_legacy_histories(model, missing_undated, set(histories))
+            new_histories = [history for key, history in histories.items() if key not in existing_keys]
+            if not new_histories:
+                continue
+            
+            # ignore_conflicts: an toàn khi hai task cùng ghi một đơn (INSERT IGNORE)
+            model.objects.bulk_create(new_histories, batch_size=100, ignore_conflicts=True)
+            created_count += len(new_histories)
+            logger.info(f"Inserted {len(new_histories)} new {model._meta.db_table} "
+                        f"({len(histories) - len(new_histories)} already stored)")
                 
     except Exception as e:
         logger.error(f"Error bulk creating histories: {e}", exc_info=True)
         _reset_database_connection()
+        raise
     
     return created_count
 
 # ===== MAIN SYNC FUNCTION FOR SINGLE SHOP =====
-def _sync_shop_orders_with_date_range(shop: Shop, start_timestamp: int, end_timestamp: int, start_date, end_date) -> OrderSyncResult:
-    """Sync orders for a single shop with date range"""
+def _sync_shop_orders_with_date_range(shop: Shop, start_timestamp: int, end_timestamp: int, start_date, end_date,
+                                      checkpoint: Optional[SyncCheckpointTracker] = None,
+                                      budget: Optional[TaskTimeBudget] = None) -> OrderSyncResult:
+    """
+    Sync orders for a single shop with date range
+    
+    Args:
+        checkpoint: Nếu có, bắt đầu từ trang sau trang đã commit và ghi checkpoint sau mỗi trang
+        budget: Nếu có và đã hết thời gian, dừng trước trang kế tiếp (result.interrupted = True)
+    """
     result = OrderSyncResult()
+    ref_cache = RefCache()
+    customer_lookup = CustomerLookupState()
     
     try:
         page = 1
@@ -3329,8 +3469,37 @@ def _sync_shop_orders_with_date_range(shop: Shop, start_timestamp: int, end_time
         logger.info(f"Starting orders sync for shop: {shop.name} (ID: {shop.pancake_id}) "
                    f"from {start_date.strftime('%Y-%m-%d')} to {end_date.strftime('%Y-%m-%d')}")
         
+        events = ShopSyncEvents('orders', shop, checkpoint.run_id if checkpoint else None)
+        
+        def _on_page_done(fetched):
+            if checkpoint:
+                # Trang chỉ được tính là đã commit khi fetch và ghi không thêm lỗi nào
+                if fetched.error is None and len(result.errors) == errors_before_page:
+                    checkpoint.page_committed(fetched.page, result.max_updated_at, len(result.errors))
+                else:
+                    checkpoint.page_failed(fetched.page, len(result.errors))
+            events.page_done(fetched, errors=len(result.errors))
+        
+        # Trang tiếp theo được fetch ở thread nền trong khi trang hiện tại đang ghi DB
+        fetched_pages = iter_prefetched_pages(
+            lambda p: _fetch_orders_page_with_date_range(
+                shop.pancake_id, start_timestamp, end_timestamp, p, 100
+            ),
+            start_page=checkpoint.start_page if checkpoint else 1,
+            on_page_done=_on_page_done,
+        )
+        
         # Continue until we've processed all pages
-        while total_pages is None or page <= total_pages:
+        for fetched in fetched_pages:
+            page = fetched.page
+            # Sắp hết thời gian: dừng trước trang này (chưa commit), task tiếp nối resume từ checkpoint
+            if budget and budget.exhausted():
+                logger.warning(f"Time budget exhausted for shop {shop.name} before page {page}, "
+                              f"handing off to continuation task")
+                result.interrupted = True
+                break
+            errors_before_page = len(result.errors)
+            
             page_start_time = _get_vietnam_time()
             
             # Show progress if we know total pages
@@ -3340,22 +3509,9 @@ def _sync_shop_orders_with_date_range(shop: Shop, start_timestamp: int, end_time
                 logger.info(f"Processing page {page} for shop {shop.name}")
             
             try:
-                # Fetch data with retry mechanism
-                max_retries = 3
-                api_response = None
-                
-                for retry in range(max_retries):
-                    try:
-                        api_response = _fetch_orders_page_with_date_range(
-                            shop.pancake_id, start_timestamp, end_timestamp, page, 100
-                        )
-                        break
-                    except requests.RequestException as e:
-                        if retry == max_retries - 1:
-                            raise
-                        logger.warning(f"API request failed (retry {retry + 1}/{max_retries}): {e}")
-                        import time
-                        time.sleep(2)  # Wait before retry
+                if fetched.error:
+                    raise fetched.error
+                api_response = fetched.data
                 
                 if not api_response.get('success', False):
                     error_msg = f"API returned success=false for shop {shop.name} page {page}"
@@ -3374,7 +3530,6 @@ def _sync_shop_orders_with_date_range(shop: Shop, start_timestamp: int, end_time
                 
                 if not orders_data:
                     logger.warning(f"No data for shop {shop.name} page {page}")
-                    page += 1
                     continue
                 
                 # Prepare mapping data with optimized queries
@@ -3413,7 +3568,7 @@ def _sync_shop_orders_with_date_range(shop: Shop, start_timestamp: int, end_time
                             if variation_id:
                                 variation_ids.add(variation_id)
                     
-                    # Create mapping dictionaries with error handling
+                    # Create mapping dictionaries with error handling (ref_cache chỉ query id chưa gặp trong run)
                     users_map = {}
                     customers_map = {}
                     pages_map = {}
@@ -3422,66 +3577,61 @@ def _sync_shop_orders_with_date_range(shop: Shop, start_timestamp: int, end_time
                     
                     if user_ids:
                         try:
-                            users_map = {
-                                u.pancake_id: u for u in User.objects.filter(pancake_id__in=user_ids)
-                            }
+                            users_map = ref_cache.resolve(User, user_ids)
                         except Exception as e:
                             logger.warning(f"Error loading users map: {e}")
                     
                     if customer_ids:
                         try:
-                            customers_map = {
-                                c.pancake_id: c for c in Customer.objects.filter(
-                                    shop=shop, pancake_id__in=customer_ids
-                                )
-                            }
+                            customers_map = ref_cache.resolve(Customer, customer_ids, Customer.objects.filter(shop=shop))
                         except Exception as e:
                             logger.warning(f"Error loading customers map: {e}")
+                        
+                        # Customer chưa sync: fetch theo lô rồi ghi luôn để order gán đúng customer
+                        customers_map = _fetch_missing_customers(shop, customer_ids, customers_map, result, ref_cache,
+                                                                 customer_lookup)
                     
                     if page_ids:
                         try:
-                            pages_map = {
-                                p.pancake_id: p for p in Page.objects.filter(
-                                    shop=shop, pancake_id__in=page_ids
-                                )
-                            }
+                            pages_map = ref_cache.resolve(Page, page_ids, Page.objects.filter(shop=shop))
                         except Exception as e:
                             logger.warning(f"Error loading pages map: {e}")
                     
                     if product_ids:
                         try:
-                            products_map = {
-                                p.pancake_id: p for p in Product.objects.filter(
-                                    shop=shop, pancake_id__in=product_ids
-                                )
-                            }
+                            products_map = ref_cache.resolve(Product, product_ids, Product.objects.filter(shop=shop))
                         except Exception as e:
                             logger.warning(f"Error loading products map: {e}")
                     
                     if variation_ids:
                         try:
-                            variations_map = {
-                                v.pancake_id: v for v in ProductVariation.objects.filter(
-                                    product__shop=shop, pancake_id__in=variation_ids
-                                )
-                            }
+                            variations_map = ref_cache.resolve(
+                                ProductVariation, variation_ids, ProductVariation.objects.filter(product__shop=shop)
+                            )
                         except Exception as e:
                             logger.warning(f"Error loading variations map: {e}")
                     
                     # Extract and transform data
-                    orders_processed = _extract_orders_data(orders_data, shop, users_map, customers_map, pages_map)
+                    orders_processed = _extract_orders_data(orders_data, shop, users_map, customers_map, pages_map,
+                                                            ref_cache)
                     
                     if not orders_processed:
                         logger.warning(f"No orders processed for shop {shop.name} page {page}")
-                        page += 1
                         continue
                     
                     # Process data with separate error handling for each operation
                     try:
                         # Bulk upsert orders
-                        orders_created, orders_updated = _safe_bulk_upsert_orders(orders_processed)
+                        orders_created, orders_updated, orders_unchanged = _safe_bulk_upsert_orders(orders_processed)
                         result.orders_created += orders_created
                         result.orders_updated += orders_updated
+                        result.orders_unchanged += orders_unchanged
+                        
+                        # Theo dõi max updated_at từ API cho watermark
+                        for order_data in orders_data:
+                            updated_at = _parse_datetime(order_data.get('updated_at'))
+                            if updated_at and (result.max_updated_at is None or updated_at > result.max_updated_at):
+                                result.max_updated_at = updated_at
                         
                         # Create orders map for related objects
                         order_pancake_ids = [o['pancake_id'] for o in orders_processed]
@@ -3503,8 +3653,11 @@ def _sync_shop_orders_with_date_range(shop: Shop, start_timestamp: int, end_time
                         # Extract and upsert order items
                         try:
                             items_data = _extract_items_data(orders_processed, products_map, variations_map)
-                            items_created, items_updated = _safe_bulk_upsert_order_items(items_data, orders_map)
+                            items_created, items_updated, items_unchanged = _safe_bulk_upsert_order_items(
+                                items_data, orders_map
+                            )
                             result.items_created += items_created
+                            result.items_unchanged += items_unchanged
                         except Exception as e:
                             logger.error(f"Error processing order items for page {page}: {e}")
                             result.errors.append(f"Order items error page {page}: {str(e)}")
@@ -3553,25 +3706,15 @@ def _sync_shop_orders_with_date_range(shop: Shop, start_timestamp: int, end_time
                 error_msg = f"Page error {page} for shop {shop.name}: {str(page_error)}"
                 logger.error(error_msg, exc_info=True)
                 result.errors.append(error_msg)
-                
-                # For critical errors, we might want to stop processing
-                if "timeout" in str(page_error).lower() or "connection" in str(page_error).lower():
-                    logger.error(f"Connection error for shop {shop.name}, will retry in 30 seconds")
-                    import time
-                    time.sleep(30)
             
             processed_pages += 1
-            page += 1
-            
-            # Add small delay between pages to avoid overwhelming the API
-            import time
-            time.sleep(0.1)
             
             # Progress update every 10 pages
             if processed_pages % 10 == 0:
                 logger.info(f"Progress update - Shop {shop.name}: {processed_pages} pages completed, "
                            f"{result.orders_created + result.orders_updated} total orders processed")
         
+        fetched_pages.close()
         completion_time = _get_vietnam_time()
         logger.info(f"COMPLETED sync for shop {shop.name}: {processed_pages}/{total_pages} pages processed")
         logger.info(f"Results - Orders: +{result.orders_created}/~{result.orders_updated}, "
@@ -3587,38 +3730,245 @@ def _sync_shop_orders_with_date_range(shop: Shop, start_timestamp: int, end_time
         logger.error(error_msg, exc_info=True)
         result.errors.append(error_msg)
     
+    result.ref_cache_hits, result.ref_cache_misses = ref_cache.hits, ref_cache.misses
+    logger.info(f"Shop {shop.name} ref cache: {ref_cache.stats()}")
+    
     return result
 
 # ===== MAIN CELERY TASK =====
+@shared_task(bind=True)
+def sync_shop_orders_subtask(self, shop_id: int, run_id: str, start_timestamp: int, end_timestamp: int,
+                             mode: str = 'incremental', carry: Optional[Dict] = None,
+                             lock_policy: Optional[str] = None):
+    """
+    Subtask của chord sync_orders_task: đồng bộ đơn hàng cho một shop
+    
+    Args:
+        shop_id (int): Shop ID
+        run_id (str): Id của lần sync (checkpoint theo run)
+        start_timestamp, end_timestamp (int): Full window 30 ngày của lần sync
+        mode (str): 'incremental' hoặc 'repair'
+        carry (dict, optional): Kết quả đã làm của task trước khi bị thay bằng task tiếp nối
+        lock_policy (str, optional): Xử lý khi shop đang được run khác sync (skip/queue/coalesce)
+    """
+    start_date = datetime.fromtimestamp(start_timestamp, VIETNAM_TZ)
+    end_date = datetime.fromtimestamp(end_timestamp, VIETNAM_TZ)
+    
+    def _sync(shop, checkpoint, budget):
+        shop_start_time = _get_vietnam_time()
+        logger.info(f"[TASK] Processing shop: {shop.name} (ID: {shop.pancake_id})")
+        
+        if checkpoint.params:
+            # Resume: giữ nguyên window của lần chạy trước trong cùng run
+            shop_start_timestamp = checkpoint.params['start_timestamp']
+            shop_end_timestamp = checkpoint.params['end_timestamp']
+            is_incremental = checkpoint.params.get('is_incremental', False)
+            shop_start_date = datetime.fromtimestamp(shop_start_timestamp, VIETNAM_TZ)
+        else:
+            # Incremental: bắt đầu từ watermark của shop; repair: full 30 ngày
+            if mode == 'repair':
+                shop_start_date, is_incremental = start_date, False
+            else:
+                shop_start_date, is_incremental = get_incremental_start(shop, 'orders', start_date)
+            shop_start_timestamp = int(shop_start_date.timestamp())
+            shop_end_timestamp = end_timestamp
+            checkpoint.save_params({
+                'start_timestamp': shop_start_timestamp,
+                'end_timestamp': shop_end_timestamp,
+                'is_incremental': is_incremental,
+            })
+        
+        logger.info(f"[TASK] Shop {shop.name}: fetching orders updated since "
+                   f"{shop_start_date.strftime('%Y-%m-%d %H:%M:%S')} "
+                   f"({'watermark' if is_incremental else 'full window'})")
+        
+        # Sync single shop with date range
+        shop_result = _sync_shop_orders_with_date_range(
+            shop, shop_start_timestamp, shop_end_timestamp, shop_start_date, end_date,
+            checkpoint=checkpoint, budget=budget
+        )
+        
+        shop_duration = (_get_vietnam_time() - shop_start_time).total_seconds()
+        logger.info(f"[TASK] Shop {shop.name} {'paused' if shop_result.interrupted else 'completed'} "
+                   f"in {shop_duration:.2f}s: "
+                   f"Orders: +{shop_result.orders_created}/~{shop_result.orders_updated}, "
+                   f"Items: +{shop_result.items_created}, "
+                   f"Addresses: +{shop_result.addresses_created}, "
+                   f"Errors: {len(shop_result.errors)}")
+        return shop_result
+    
+    def _advance_watermark(shop, checkpoint, shop_result):
+        # Chỉ tiến watermark khi cả run của shop không lỗi, để lần sau fetch lại phần bị lỗi;
+        # không thấy đơn nào (không có max updated_at) thì giữ watermark, chỉ cập nhật last_synced_at
+        if not shop_result.errors and not checkpoint.had_previous_errors:
+            advance_watermark(shop, 'orders', checkpoint.merged_watermark(shop_result.max_updated_at))
+        else:
+            logger.warning(f"[TASK] Shop {shop.name} had errors, keeping previous orders watermark")
+    
+    return run_shop_sync(self, shop_id, run_id, 'orders', _sync, _advance_watermark, carry=carry,
+                         lock_policy=lock_policy)
+
+def _orders_shop_windows(run_id: str) -> List[Dict]:
+    """Window thực tế mỗi shop đã fetch trong run (lưu ở checkpoint params): watermark hoặc full window"""
+    windows = []
+    for checkpoint in SyncCheckpoint.objects.filter(run_id=run_id, entity='orders').select_related('shop'):
+        params = checkpoint.params or {}
+        if 'start_timestamp' not in params:
+            continue
+        start = datetime.fromtimestamp(params['start_timestamp'], VIETNAM_TZ)
+        end = datetime.fromtimestamp(params['end_timestamp'], VIETNAM_TZ)
+        windows.append({
+            'shop_id': checkpoint.shop_id,
+            'shop_name': checkpoint.shop.name,
+            'start_date': start.isoformat(),
+            'end_date': end.isoformat(),
+            'is_incremental': params.get('is_incremental', False),
+            'days_covered': round((end - start).total_seconds() / 86400, 2),
+        })
+    return sorted(windows, key=lambda w: w['shop_id'])
+
+@shared_task(bind=True)
+def finalize_orders_sync(self, shop_results: List[Dict], sync_history_id: int, run_id: str, mode: str):
+    """Chord callback của sync_orders_task: gộp kết quả các shop vào SyncHistory"""
+    vietnam_end_time = _get_vietnam_time()
+    sync_history = SyncHistory.objects.get(id=sync_history_id)
+    total_duration = (vietnam_end_time - sync_history.started_at).total_seconds()
+    total_result = aggregate_shop_payloads(OrderSyncResult(), shop_results)
+    date_range = sync_history.error_details.get('date_range', {})
+    shop_windows = _orders_shop_windows(run_id)
+    
+    # Complete sync history
+    sync_history.status = 'completed' if not total_result.errors else 'completed_with_errors'
+    sync_history.created_records = total_result.orders_created
+    sync_history.updated_records = total_result.orders_updated
+    sync_history.failed_records = len(total_result.errors)
+    sync_history.total_records = total_result.orders_created + total_result.orders_updated
+    sync_history.finished_at = vietnam_end_time
+    sync_history.error_message = '; '.join(total_result.errors[:5]) if total_result.errors else None
+    
+    # Update error details with final stats
+    sync_history.error_details.update({
+        'final_stats': {
+            'orders_created': total_result.orders_created,
+            'orders_updated': total_result.orders_updated,
+            'items_created': total_result.items_created,
+            'addresses_created': total_result.addresses_created,
+            'partners_created': total_result.partners_created,
+            'warehouses_created': total_result.warehouses_created,
+            'histories_created': total_result.histories_created,
+            'customers_fetched': total_result.customers_fetched,
+            'total_errors': len(total_result.errors),
+            'duration_seconds': total_duration,
+            'duration_minutes': total_duration / 60
+        },
+        'change_detection': {
+            'orders_unchanged': total_result.orders_unchanged,
+            'items_unchanged': total_result.items_unchanged,
+        },
+        'ref_cache': {
+            'hits': total_result.ref_cache_hits,
+            'misses': total_result.ref_cache_misses,
+            'hit_rate': round(
+                total_result.ref_cache_hits / max(1, total_result.ref_cache_hits + total_result.ref_cache_misses), 4
+            ),
+        },
+        'shop_results': shop_results,
+        'shop_windows': shop_windows,
+        'errors': total_result.errors[:20] if total_result.errors else []  # Store first 20 errors
+    })
+    sync_history.save()
+    publish_sync_event('run_finished', entity='orders', run_id=run_id, sync_history_id=sync_history.id,
+                       status=sync_history.status, errors=len(total_result.errors))
+    
+    logger.info(f"[TASK] COMPLETED in {total_duration:.2f}s ({total_duration/60:.1f} minutes)")
+    logger.info(f"[TASK] FINAL RESULTS: Orders: +{total_result.orders_created}/~{total_result.orders_updated}"
+               f"/={total_result.orders_unchanged}, "
+               f"Items: +{total_result.items_created}, Addresses: +{total_result.addresses_created}, "
+               f"Partners: +{total_result.partners_created}, Warehouses: +{total_result.warehouses_created}, "
+               f"Histories: +{total_result.histories_created}, Total Errors: {len(total_result.errors)}")
+    
+    success_message = (
+        f'Đồng bộ hoàn tất: {total_result.orders_created} đơn hàng mới, '
+        f'{total_result.orders_updated} đơn hàng cập nhật, '
+        f'{total_result.items_created} sản phẩm trong {len(shop_results)} shop'
+    )
+    if total_result.errors:
+        success_message += f', {len(total_result.errors)} lỗi'
+    
+    return {
+        'success': len(total_result.errors) == 0,
+        'message': success_message,
+        'data': {
+            'orders_created': total_result.orders_created,
+            'orders_updated': total_result.orders_updated,
+            'items_created': total_result.items_created,
+            'addresses_created': total_result.addresses_created,
+            'partners_created': total_result.partners_created,
+            'warehouses_created': total_result.warehouses_created,
+            'histories_created': total_result.histories_created,
+            'customers_fetched': total_result.customers_fetched,
+            'orders_unchanged': total_result.orders_unchanged,
+            'total_shops_processed': len(shop_results),
+            'errors_count': len(total_result.errors),
+            'error_details': total_result.errors[:10],  # First 10 errors
+            'duration_seconds': total_duration,
+            'duration_minutes': total_duration / 60,
+            'mode': mode,
+            'run_id': run_id,
+            'date_range': {
+                'start_date': min((w['start_date'] for w in shop_windows), default=date_range.get('start_date', ''))[:10],
+                'end_date': date_range.get('end_date', '')[:10],
+                # Incremental: mỗi shop fetch từ watermark của nó, số ngày là window dài nhất
+                'days_covered': max((w['days_covered'] for w in shop_windows), default=0),
+                'shop_windows': shop_windows,
+            },
+            'sync_history_id': sync_history.id
+        },
+        'timestamp': vietnam_end_time.isoformat()
+    }
+
 @shared_task(bind=True, max_retries=3, default_retry_delay=300)
-def sync_orders_task(self, shop_ids=None):
+def sync_orders_task(self, shop_ids=None, mode='incremental', run_id=None, lock_policy=None):
     """
-    Celery task để đồng bộ đơn hàng từ Pancake API với date range (30 ngày gần nhất)
+    Celery task để đồng bộ đơn hàng từ Pancake API
+    
+    Mỗi shop chạy trong một subtask riêng (chord), finalize_orders_sync gộp kết quả
+    vào SyncHistory khi tất cả shop xong.
     
     Args:
         shop_ids (list, optional): Danh sách shop IDs để sync. Nếu None thì sync tất cả shops.
+        mode (str): 'incremental' - chỉ fetch đơn cập nhật từ watermark của từng shop
+                    (shop chưa có watermark thì fetch 30 ngày);
+                    'repair' - fetch lại toàn bộ 30 ngày gần nhất
+        run_id (str, optional): Id của lần sync để resume từ checkpoint (mặc định là task id,
+                    nên task bị redeliver/retry sẽ bỏ qua các shop đã xong)
+        lock_policy (str, optional): Xử lý shop đang được run khác sync: 'skip', 'queue' hoặc
+                    'coalesce' (mặc định PANCAKE_SYNC_LOCK_POLICY, xem sync_locks.py)
     
     Returns:
-        dict: Kết quả sync với thống kê chi tiết
+        dict: Thông tin dispatch (sync_history_id, callback_task_id)
     """
     vietnam_start_time = _get_vietnam_time()
+    run_id = resolve_run_id(self, run_id)
+    sync_history = None
     
     try:
-        # Get date range for last 30 days
+        # Full window 30 ngày: dùng cho repair mode và shop chưa có watermark
         start_timestamp, end_timestamp, start_date, end_date = _get_date_range_timestamps()
         
-        logger.info(f"[TASK] Starting orders sync task with date range: {start_date.strftime('%Y-%m-%d %H:%M:%S')} to {end_date.strftime('%Y-%m-%d %H:%M:%S')}")
+        logger.info(f"[TASK] Starting orders sync task ({mode}) with date range: {start_date.strftime('%Y-%m-%d %H:%M:%S')} to {end_date.strftime('%Y-%m-%d %H:%M:%S')}")
         logger.info(f"[TASK] Timestamp range: {start_timestamp} to {end_timestamp}")
         
         # Get shops to sync
         if shop_ids:
-            shops = Shop.objects.filter(id__in=shop_ids)
+            shops = Shop.objects.filter(id__in=shop_ids).order_by('id')
             logger.info(f"[TASK] Syncing specific shops: {shop_ids}")
         else:
-            shops = Shop.objects.all()
+            shops = Shop.objects.order_by('id')
             logger.info(f"[TASK] Syncing all {shops.count()} shops")
         
-        if not shops.exists():
+        target_shop_ids = list(shops.values_list('id', flat=True))
+        if not target_shop_ids:
             error_msg = "No shops found to sync"
             logger.error(f"[TASK] {error_msg}")
             return {
@@ -3628,8 +3978,6 @@ def sync_orders_task(self, shop_ids=None):
                 'timestamp': vietnam_start_time.isoformat()
             }
         
-        total_result = OrderSyncResult()
-        
         # Create sync history record
         sync_history = SyncHistory.objects.create(
             sync_type='orders',
@@ -3637,231 +3985,264 @@ def sync_orders_task(self, shop_ids=None):
             total_records=0,
             started_at=vietnam_start_time,
             error_details={
+                'mode': mode,
+                'run_id': run_id,
                 'date_range': {
                     'start_date': start_date.isoformat(),
                     'end_date': end_date.isoformat(),
                     'start_timestamp': start_timestamp,
                     'end_timestamp': end_timestamp
                 },
-                'shop_count': shops.count(),
-                'shop_ids': list(shops.values_list('id', flat=True)) if shop_ids else 'all'
+                'shop_count': len(target_shop_ids),
+                'shop_ids': target_shop_ids if shop_ids else 'all'
             }
         )
         
         logger.info(f"[TASK] Created sync history record: {sync_history.id}")
         
-        try:
-            # Process each shop
-            for shop_index, shop in enumerate(shops, 1):
-                shop_start_time = _get_vietnam_time()
-                logger.info(f"[TASK] Processing shop {shop_index}/{shops.count()}: {shop.name} (ID: {shop.pancake_id})")
-                
-                # Update task progress if bound
-                if hasattr(self, 'update_state'):
-                    self.update_state(
-                        state='PROGRESS',
-                        meta={
-                            'current_shop': shop_index,
-                            'total_shops': shops.count(),
-                            'shop_name': shop.name,
-                            'orders_processed': total_result.orders_created + total_result.orders_updated,
-                            'start_time': vietnam_start_time.isoformat()
-                        }
-                    )
-                
-                try:
-                    # Sync single shop with date range
-                    shop_result = _sync_shop_orders_with_date_range(
-                        shop, start_timestamp, end_timestamp, start_date, end_date
-                    )
-                    
-                    # Aggregate results
-                    total_result.orders_created += shop_result.orders_created
-                    total_result.orders_updated += shop_result.orders_updated
-                    total_result.items_created += shop_result.items_created
-                    total_result.addresses_created += shop_result.addresses_created
-                    total_result.partners_created += shop_result.partners_created
-                    total_result.warehouses_created += shop_result.warehouses_created
-                    total_result.histories_created += shop_result.histories_created
-                    total_result.errors.extend(shop_result.errors)
-                    
-                    shop_end_time = _get_vietnam_time()
-                    shop_duration = (shop_end_time - shop_start_time).total_seconds()
-                    
-                    logger.info(f"[TASK] Shop {shop_index}/{shops.count()} - {shop.name} completed in {shop_duration:.2f}s: "
-                               f"Orders: +{shop_result.orders_created}/~{shop_result.orders_updated}, "
-                               f"Items: +{shop_result.items_created}, "
-                               f"Addresses: +{shop_result.addresses_created}, "
-                               f"Errors: {len(shop_result.errors)}")
-                    
-                except Exception as shop_error:
-                    error_msg = f"Error processing shop {shop.name}: {str(shop_error)}"
-                    logger.error(f"[TASK] {error_msg}", exc_info=True)
-                    total_result.errors.append(error_msg)
-                    
-                    # Continue with next shop instead of failing entire task
-                    continue
-                
-                # Update sync progress periodically
-                if shop_index % 5 == 0 or shop_index == shops.count():
-                    sync_history.total_records = total_result.orders_created + total_result.orders_updated
-                    sync_history.created_records = total_result.orders_created
-                    sync_history.updated_records = total_result.orders_updated
-                    sync_history.failed_records = len(total_result.errors)
-                    sync_history.save()
-                    
-                    logger.info(f"[TASK] Progress update: {shop_index}/{shops.count()} shops completed, "
-                               f"{total_result.orders_created + total_result.orders_updated} orders processed")
-            
-            # Complete sync history
-            vietnam_end_time = _get_vietnam_time()
-            total_duration = (vietnam_end_time - vietnam_start_time).total_seconds()
-            
-            sync_history.status = 'completed' if not total_result.errors else 'completed_with_errors'
-            sync_history.created_records = total_result.orders_created
-            sync_history.updated_records = total_result.orders_updated
-            sync_history.failed_records = len(total_result.errors)
-            sync_history.total_records = total_result.orders_created + total_result.orders_updated
-            sync_history.finished_at = vietnam_end_time
-            sync_history.error_message = '; '.join(total_result.errors[:5]) if total_result.errors else None
-            
-            # Update error details with final stats
-            sync_history.error_details.update({
-                'final_stats': {
-                    'orders_created': total_result.orders_created,
-                    'orders_updated': total_result.orders_updated,
-                    'items_created': total_result.items_created,
-                    'addresses_created': total_result.addresses_created,
-                    'partners_created': total_result.partners_created,
-                    'warehouses_created': total_result.warehouses_created,
-                    'histories_created': total_result.histories_created,
-                    'total_errors': len(total_result.errors),
-                    'duration_seconds': total_duration,
-                    'duration_minutes': total_duration / 60
-                },
-                'errors': total_result.errors[:20] if total_result.errors else []  # Store first 20 errors
-            })
-            sync_history.save()
-            
-            logger.info(f"[TASK] COMPLETED in {total_duration:.2f}s ({total_duration/60:.1f} minutes)")
-            logger.info(f"[TASK] FINAL RESULTS: Orders: +{total_result.orders_created}/~{total_result.orders_updated}, "
-                       f"Items: +{total_result.items_created}, Addresses: +{total_result.addresses_created}, "
-                       f"Partners: +{total_result.partners_created}, Warehouses: +{total_result.warehouses_created}, "
-                       f"Histories: +{total_result.histories_created}, Total Errors: {len(total_result.errors)}")
-            
-            # Prepare success response
-            success_message = (
-                f'Đồng bộ hoàn tất: {total_result.orders_created} đơn hàng mới, '
-                f'{total_result.orders_updated} đơn hàng cập nhật, '
-                f'{total_result.items_created} sản phẩm trong {shops.count()} shop'
-            )
-            
-            if total_result.errors:
-                success_message += f', {len(total_result.errors)} lỗi'
-            
+        stage = shop_chord(
+            sync_shop_orders_subtask, finalize_orders_sync, target_shop_ids,
+            callback_kwargs={'sync_history_id': sync_history.id, 'run_id': run_id, 'mode': mode},
+            run_id=run_id,
+            start_timestamp=start_timestamp,
+            end_timestamp=end_timestamp,
+            mode=mode,
+            lock_policy=lock_policy
+        )
+        
+        if not is_pipeline_stage(self):
+            chord_result = stage.apply_async()
             return {
-                'success': len(total_result.errors) == 0,
-                'message': success_message,
+                'success': True,
+                'message': f'Đã bắt đầu đồng bộ đơn hàng cho {len(target_shop_ids)} shop',
                 'data': {
-                    'orders_created': total_result.orders_created,
-                    'orders_updated': total_result.orders_updated,
-                    'items_created': total_result.items_created,
-                    'addresses_created': total_result.addresses_created,
-                    'partners_created': total_result.partners_created,
-                    'warehouses_created': total_result.warehouses_created,
-                    'histories_created': total_result.histories_created,
-                    'total_shops_processed': shops.count(),
-                    'errors_count': len(total_result.errors),
-                    'error_details': total_result.errors[:10],  # First 10 errors
-                    'duration_seconds': total_duration,
-                    'duration_minutes': total_duration / 60,
+                    'total_shops': len(target_shop_ids),
+                    'mode': mode,
+                    'run_id': run_id,
+                    'callback_task_id': chord_result.id,
                     'date_range': {
                         'start_date': start_date.strftime('%Y-%m-%d'),
                         'end_date': end_date.strftime('%Y-%m-%d'),
-                        'days_covered': 30
+                        # Incremental: window mỗi shop tính từ watermark lúc subtask chạy,
+                        # kết quả finalize_orders_sync có shop_windows thực tế
+                        'days_covered': (end_date - start_date).days if mode == 'repair' else None,
+                        'per_shop_window': mode != 'repair',
                     },
                     'sync_history_id': sync_history.id
                 },
-                'timestamp': vietnam_end_time.isoformat()
+                'timestamp': vietnam_start_time.isoformat()
             }
-            
-        except Exception as e:
-            # Handle task-level errors
-            vietnam_error_time = _get_vietnam_time()
-            error_duration = (vietnam_error_time - vietnam_start_time).total_seconds()
-            
+        
+    except Exception as e:
+        # Handle dispatch errors (broker/database không truy cập được)
+        vietnam_error_time = _get_vietnam_time()
+        error_duration = (vietnam_error_time - vietnam_start_time).total_seconds()
+        
+        if sync_history is not None:
             sync_history.status = 'failed'
             sync_history.error_message = str(e)
             sync_history.finished_at = vietnam_error_time
-            sync_history.error_details.update({
-                'task_error': str(e),
-                'partial_results': {
-                    'orders_created': total_result.orders_created,
-                    'orders_updated': total_result.orders_updated,
-                    'items_created': total_result.items_created,
-                    'addresses_created': total_result.addresses_created,
-                },
-                'duration_seconds': error_duration
-            })
+            sync_history.error_details.update({'task_error': str(e), 'duration_seconds': error_duration})
             sync_history.save()
-            
-            logger.error(f"[TASK] FAILED after {error_duration:.2f}s: {str(e)}", exc_info=True)
-            
-            # Retry logic for certain errors
-            if self.request.retries < self.max_retries:
-                if "timeout" in str(e).lower() or "connection" in str(e).lower():
-                    logger.info(f"[TASK] Retrying due to connection error (attempt {self.request.retries + 1}/{self.max_retries})")
-                    raise self.retry(countdown=300, exc=e)  # Retry after 5 minutes
-            
-            return {
-                'success': False,
-                'message': f'Lỗi đồng bộ đơn hàng: {str(e)}',
-                'data': {
-                    'partial_results': {
-                        'orders_created': total_result.orders_created,
-                        'orders_updated': total_result.orders_updated,
-                        'items_created': total_result.items_created,
-                        'addresses_created': total_result.addresses_created,
-                    },
-                    'error': str(e),
-                    'retry_count': self.request.retries,
-                    'max_retries': self.max_retries,
-                    'sync_history_id': sync_history.id,
-                    'duration_seconds': error_duration
+        
+        logger.error(f"[TASK] FAILED after {error_duration:.2f}s: {str(e)}", exc_info=True)
+        
+        # Retry logic for certain errors
+        if self.request.retries < self.max_retries:
+            if "timeout" in str(e).lower() or "connection" in str(e).lower():
+                logger.info(f"[TASK] Retrying due to connection error (attempt {self.request.retries + 1}/{self.max_retries})")
+                raise self.retry(countdown=300, exc=e)  # Retry after 5 minutes
+        
+        return {
+            'success': False,
+            'message': f'Lỗi đồng bộ đơn hàng: {str(e)}',
+            'data': {
+                'error': str(e),
+                'retry_count': self.request.retries,
+                'max_retries': self.max_retries,
+                'sync_history_id': sync_history.id if sync_history else None,
+                'duration_seconds': error_duration
+            },
+            'timestamp': vietnam_error_time.isoformat()
+        }
+    
+    # Stage của sync pipeline: stage sau chỉ chạy khi finalize_orders_sync xong
+    # (nằm ngoài try: replace() raise Ignore)
+    return self.replace(stage)
+
+# ===== BACKFILL THEO WINDOW THỜI GIAN =====
+
+@shared_task(bind=True)
+def sync_orders_window_subtask(self, shop_id: int, run_id: str, start_timestamp: int, end_timestamp: int,
+                               carry: Optional[Dict] = None):
+    """
+    Subtask của sync_orders_backfill: đồng bộ đơn hàng của một shop trong một window thời gian
+    
+    Mỗi window có checkpoint riêng (run_id của window = "<run_id>:<start>-<end>").
+    Backfill không tiến watermark vì các window xong không theo thứ tự.
+    """
+    window_run_id = f"{run_id}:{start_timestamp}-{end_timestamp}"
+    start_date = datetime.fromtimestamp(start_timestamp, VIETNAM_TZ)
+    end_date = datetime.fromtimestamp(end_timestamp, VIETNAM_TZ)
+    
+    def _sync(shop, checkpoint, budget):
+        logger.info(f"[BACKFILL] Shop {shop.name}: window {start_date.strftime('%Y-%m-%d %H:%M:%S')} "
+                   f"to {end_date.strftime('%Y-%m-%d %H:%M:%S')}")
+        return _sync_shop_orders_with_date_range(
+            shop, start_timestamp, end_timestamp, start_date, end_date,
+            checkpoint=checkpoint, budget=budget
+        )
+    
+    # Các window của cùng backfill cùng giữ lock (shop, 'orders') nên vẫn chạy song song,
+    # còn incremental/repair của shop đó phải chờ (hoặc skip/coalesce) tới khi backfill xong
+    payload = run_shop_sync(self, shop_id, window_run_id, 'orders', _sync, carry=carry,
+                            lock_owner=run_id)
+    payload['window'] = {'start': start_date.isoformat(), 'end': end_date.isoformat()}
+    return payload
+
+def _plan_backfill_windows(shop: Shop, start_date: datetime, end_date: datetime,
+                           target_pages: Optional[int] = None) -> List[Tuple[int, int]]:
+    """Các window backfill của một shop: theo tháng, hoặc adaptive ~target_pages trang mỗi window"""
+    windows = month_windows(start_date, end_date)
+    if not target_pages:
+        return windows
+    
+    try:
+        probe = probe_total_pages(_fetch_orders_page_with_date_range, shop.pancake_id)
+        return adaptive_windows(windows, target_pages, probe)
+    except Exception as e:
+        # Không probe được thì vẫn backfill theo tháng
+        logger.warning(f"[BACKFILL] Shop {shop.name}: adaptive planning failed, using monthly windows: {e}")
+        return windows
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=300)
+def sync_orders_backfill(self, shop_ids=None, start_date=None, end_date=None, target_pages=None, run_id=None):
+    """
+    Backfill đơn hàng: chia lịch sử của từng shop thành các window thời gian,
+    mỗi window là một subtask độc lập (chạy song song trên nhiều worker).
+    
+    Args:
+        shop_ids (list, optional): Danh sách shop IDs. Nếu None thì backfill tất cả shops.
+        start_date (str, optional): Ngày bắt đầu 'YYYY-MM-DD' (mặc định DEFAULT_BACKFILL_DAYS ngày trước)
+        end_date (str, optional): Ngày kết thúc 'YYYY-MM-DD' (mặc định hôm nay)
+        target_pages (int, optional): Nếu có, chia window adaptive khoảng target_pages trang mỗi window;
+                    mặc định chia theo tháng
+        run_id (str, optional): Id của lần backfill để resume các window đã xong
+    """
+    vietnam_start_time = _get_vietnam_time()
+    run_id = resolve_run_id(self, run_id)
+    sync_history = None
+    
+    try:
+        if end_date:
+            backfill_end = VIETNAM_TZ.localize(datetime.strptime(end_date, '%Y-%m-%d'))
+        else:
+            backfill_end = vietnam_start_time
+        backfill_end = backfill_end.replace(hour=23, minute=59, second=59, microsecond=0)
+        if start_date:
+            backfill_start = VIETNAM_TZ.localize(datetime.strptime(start_date, '%Y-%m-%d'))
+        else:
+            backfill_start = (backfill_end - timedelta(days=DEFAULT_BACKFILL_DAYS)).replace(hour=0, minute=0, second=0)
+        
+        shops = Shop.objects.filter(id__in=shop_ids) if shop_ids else Shop.objects.all()
+        shops = shops.order_by('id')
+        
+        subtasks = []
+        windows_per_shop = {}
+        for shop in shops:
+            windows = _plan_backfill_windows(shop, backfill_start, backfill_end, target_pages)
+            windows_per_shop[shop.id] = len(windows)
+            subtasks.extend(
+                sync_orders_window_subtask.s(shop_id=shop.id, run_id=run_id,
+                                             start_timestamp=start_ts, end_timestamp=end_ts)
+                for start_ts, end_ts in windows
+            )
+        
+        logger.info(f"[BACKFILL] {backfill_start.strftime('%Y-%m-%d')} to {backfill_end.strftime('%Y-%m-%d')}: "
+                   f"{len(subtasks)} windows for {len(windows_per_shop)} shops")
+        
+        sync_history = SyncHistory.objects.create(
+            sync_type='orders',
+            status='running',
+            total_records=0,
+            started_at=vietnam_start_time,
+            error_details={
+                'mode': 'backfill',
+                'run_id': run_id,
+                'date_range': {
+                    'start_date': backfill_start.isoformat(),
+                    'end_date': backfill_end.isoformat(),
                 },
-                'timestamp': vietnam_error_time.isoformat()
+                'target_pages': target_pages,
+                'windows_per_shop': windows_per_shop
             }
-            
-    except Exception as critical_error:
-        # Handle critical errors that prevent task initialization
-        vietnam_critical_time = _get_vietnam_time()
-        critical_duration = (vietnam_critical_time - vietnam_start_time).total_seconds()
+        )
+        
+        if not subtasks:
+            sync_history.status = 'completed'
+            sync_history.finished_at = _get_vietnam_time()
+            sync_history.save()
+            return {'success': True, 'message': 'Không có window nào cần backfill', 'data': {}}
         
-        logger.error(f"[TASK] CRITICAL ERROR after {critical_duration:.2f}s: {str(critical_error)}", exc_info=True)
+        chord_result = dispatch_chord(
+            subtasks, finalize_orders_sync,
+            callback_kwargs={'sync_history_id': sync_history.id, 'run_id': run_id, 'mode': 'backfill'}
+        )
         
         return {
-            'success': False,
-            'message': f'Lỗi nghiêm trọng: {str(critical_error)}',
+            'success': True,
+            'message': f'Đã bắt đầu backfill {len(subtasks)} window cho {len(windows_per_shop)} shop',
             'data': {
-                'error': str(critical_error),
-                'error_type': 'critical',
-                'duration_seconds': critical_duration
+                'windows': len(subtasks),
+                'windows_per_shop': windows_per_shop,
+                'run_id': run_id,
+                'callback_task_id': chord_result.id,
+                'sync_history_id': sync_history.id
             },
-            'timestamp': vietnam_critical_time.isoformat()
+            'timestamp': vietnam_start_time.isoformat()
+        }
+        
+    except Exception as e:
+        logger.error(f"[BACKFILL] FAILED: {str(e)}", exc_info=True)
+        
+        if sync_history is not None:
+            sync_history.status = 'failed'
+            sync_history.error_message = str(e)
+            sync_history.finished_at = _get_vietnam_time()
+            sync_history.save()
+        
+        if self.request.retries < self.max_retries:
+            if "timeout" in str(e).lower() or "connection" in str(e).lower():
+                raise self.retry(countdown=300, exc=e)
+        
+        return {
+            'success': False,
+            'message': f'Lỗi backfill đơn hàng: {str(e)}',
+            'data': {'error': str(e)},
+            'timestamp': _get_vietnam_time().isoformat()
         }
 
 # ===== CONVENIENCE TASKS FOR SPECIFIC USE CASES =====
 
 @shared_task(bind=True)
 def sync_single_shop_orders(self, shop_id):
-    """Task để đồng bộ đơn hàng cho 1 shop cụ thể"""
-    return sync_orders_task.apply_async(args=[[shop_id]], task_id=f"sync_shop_{shop_id}")
+    """Task để đồng bộ đơn hàng cho 1 shop cụ thể; shop đang được run khác sync thì chờ run đó xong"""
+    return sync_orders_task.apply_async(args=[[shop_id]], kwargs={'lock_policy': LOCK_QUEUE}).id
 
 @shared_task(bind=True)
 def sync_orders_daily(self):
-    """Task đồng bộ hàng ngày - có thể schedule với celery beat"""
-    logger.info("[DAILY_SYNC] Starting daily orders sync")
-    return sync_orders_task.apply_async(task_id="daily_orders_sync")
+    """
+    Task đồng bộ định kỳ (incremental theo watermark) - schedule với celery beat.
+    Shop mà run giờ trước vẫn đang sync thì gộp vào run đó thay vì fetch lại.
+    """
+    logger.info("[DAILY_SYNC] Starting incremental orders sync")
+    return sync_orders_task.apply_async(kwargs={'lock_policy': LOCK_COALESCE}).id
+
+@shared_task(bind=True)
+def sync_orders_repair(self):
+    """Task repair: fetch lại toàn bộ đơn hàng 30 ngày gần nhất, bỏ qua watermark"""
+    logger.info("[REPAIR_SYNC] Starting 30-day orders repair sync")
+    return sync_orders_task.apply_async(kwargs={'mode': 'repair', 'lock_policy': LOCK_QUEUE}).id
 
 @shared_task
 def sync_orders_status_check(task_id):
@@ -3887,29 +4268,26 @@ def sync_orders_status_check(task_id):
 
 # ===== UTILITY FUNCTIONS FOR TASK MANAGEMENT =====
 
-def get_running_sync_tasks():
-    """Get list of currently running sync tasks"""
+def get_running_sync_tasks(entity: Optional[str] = 'orders'):
+    """
+    Các shop đang được sync theo lock (shop, entity) trong Redis: run/task đang giữ lock,
+    worker và heartbeat gần nhất. entity=None trả về lock của mọi entity.
+    """
     try:
-        from celery import current_app
-        inspect = current_app.control.inspect()
-        
-        active_tasks = inspect.active()
-        sync_tasks = []
-        
-        if active_tasks:
-            for worker, tasks in active_tasks.items():
-                for task in tasks:
-                    if 'sync_orders' in task.get('name', ''):
-                        sync_tasks.append({
-                            'worker': worker,
-                            'task_id': task.get('id'),
-                            'name': task.get('name'),
-                            'args': task.get('args'),
-                            'started': task.get('time_start'),
-                            'hostname': task.get('hostname')
-                        })
-        
-        return sync_tasks
+        return [
+            {
+                'task_id': holder['task_id'],
+                'run_id': holder['run_id'],
+                'hostname': holder['hostname'],
+                'shop_id': holder['shop_id'],
+                'shop_name': holder['shop_name'],
+                'entity': holder['scope'],
+                'started': holder['acquired_at'],
+                'heartbeat': holder['heartbeat_at'],
+                'expires_in': holder['expires_in']
+            }
+            for holder in list_sync_locks(entity)
+        ]
     except Exception as e:
         logger.error(f"Error getting running sync tasks: {e}")
         return []
@@ -1,3 +1,1071 @@
-from django.test import TestCase
+import copy
+import importlib
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
 
-# Create your tests here.
+import pytz
+import redis
+import requests
+from celery.contrib.testing.worker import start_worker
+from django.apps import apps as django_apps
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from NhaLuaWebApp.celery import app as celery_app
+from shops.models import (Category, Customer, Order, OrderHistory, OrderStatusHistory, Page, Product,
+                          ProductVariation, Shop, SyncCheckpoint, SyncHistory, SyncWatermark, Tag, User)
+
+from api_integration import sync_events, tasks
+from api_integration.bulk_upsert import bulk_upsert
+from api_integration.fingerprints import order_history_key, status_history_key
+from api_integration.m2m_sync import sync_m2m
+from api_integration.order_windows import MIN_WINDOW_SECONDS, adaptive_windows, month_windows
+from api_integration.page_pipeline import iter_prefetched_pages
+from api_integration.pancake_client import DEFAULT_TIMEOUT, ENDPOINT_TIMEOUTS, PancakeClient, get_pancake_client
+from api_integration.rate_limiter import PancakeRateLimiter
+from api_integration.ref_cache import RefCache
+from api_integration.shop_fanout import aggregate_shop_payloads, merge_payload, run_shop_sync
+from api_integration.sync_checkpoints import SyncCheckpointTracker
+from api_integration.sync_events import event_matches
+from api_integration.sync_locks import ShopSyncLock, _client as lock_client
+from api_integration.sync_progress import get_sync_progress
+from api_integration.sync_watermarks import WATERMARK_OVERLAP, advance_watermark, get_incremental_start
+from api_integration.task_budget import TaskTimeBudget, replace_with_continuation
+from api_integration.task_routing import (BACKGROUND_PRIORITY, BULK_PRIORITY, BULK_QUEUE, HOT_PRIORITY, HOT_QUEUE,
+                                          sync_task_route)
+
+
+class PancakeClientTests(SimpleTestCase):
+    def setUp(self):
+        self.client = PancakeClient(base_url='https://pancake.test/api/v1', api_key='k', pool_size=4, max_retries=2)
+        self.client.rate_limiter = mock.Mock()
+        self.response = mock.Mock(status_code=200, headers={})
+
+    def test_timeout_per_endpoint(self):
+        with mock.patch.object(self.client.session, 'get', return_value=self.response) as get:
+            self.client.get('shops/1/orders', endpoint='orders')
+            self.client.get('shops/1/other')
+        self.assertEqual(get.call_args_list[0].kwargs['timeout'], ENDPOINT_TIMEOUTS['orders'])
+        self.assertEqual(get.call_args_list[1].kwargs['timeout'], DEFAULT_TIMEOUT)
+        self.assertEqual(get.call_args_list[0].kwargs['params'], {'api_key': 'k'})
+
+    def test_pooled_session_does_not_retry_read_timeouts(self):
+        adapter = self.client.session.get_adapter('https://pancake.test/')
+        self.assertEqual(adapter._pool_maxsize, 4)
+        self.assertEqual(adapter.max_retries.connect, 2)
+        self.assertEqual(adapter.max_retries.read, 0)
+
+    def test_retries_throttled_responses(self):
+        throttled = mock.Mock(status_code=429, headers={'Retry-After': '3'})
+        with mock.patch.object(self.client.session, 'get', side_effect=[throttled, self.response]) as get:
+            self.assertIs(self.client.get('shops'), self.response)
+        self.assertEqual(get.call_count, 2)
+        self.client.rate_limiter.penalize.assert_called_once_with(3.0)
+        self.client.rate_limiter.reward.assert_called_once_with()
+
+    def test_client_shared_per_process(self):
+        with mock.patch('api_integration.pancake_client.PancakeRateLimiter'), \
+                mock.patch('api_integration.pancake_client._client', None):
+            client = get_pancake_client()
+            self.assertIs(get_pancake_client(), client)
+            with mock.patch('api_integration.pancake_client.os.getpid', return_value=-1):
+                self.assertIsNot(get_pancake_client(), client)
+
+
+def _variation_page(category_ids):
+    return {
+        'success': True,
+        'total_pages': 1,
+        'data': [{
+            'id': 'v1', 'product_id': 'p1', 'display_id': 'dv1', 'retail_price': 100, 'remain_quantity': 1,
+            'inserted_at': '2024-01-01T00:00:00',
+            'fields': [{'id': 'f1', 'name': 'Size', 'keyValue': 's', 'value': 'M'}],
+            'product': {'name': 'P', 'display_id': 'P1', 'inserted_at': '2024-01-01T00:00:00',
+                        'categories': [{'id': c} for c in category_ids]},
+        }],
+    }
+
+
+class ProductSyncHashTests(TestCase):
+    def setUp(self):
+        self.shop = Shop.objects.create(pancake_id=1, name='S')
+        self.category_ids = [7]
+
+    def _sync(self):
+        fetch = lambda shop_id, page, size: copy.deepcopy(_variation_page(self.category_ids))
+        with mock.patch.object(tasks, '_fetch_product_variations_page', fetch):
+            return tasks._sync_shop_products(self.shop)
+
+    def _linked_categories(self):
+        return sorted(Product.objects.get().categories.values_list('pancake_id', flat=True))
+
+    def test_product_linked_once_category_is_synced(self):
+        self.assertEqual(self._sync().products_created, 1)
+        self.assertEqual(self._linked_categories(), [])
+        self.assertEqual(self._sync().products_unchanged, 1)
+
+        Category.objects.create(shop=self.shop, pancake_id=7, name='c7')
+        self.assertEqual(self._sync().products_updated, 1)
+        self.assertEqual(self._linked_categories(), [7])
+        self.assertEqual(list(ProductVariation.objects.get().fields.values_list('pancake_id', flat=True)), ['f1'])
+
+    def test_failed_m2m_write_does_not_store_hash(self):
+        Category.objects.create(shop=self.shop, pancake_id=7, name='c7')
+        with mock.patch.object(tasks, 'sync_m2m', side_effect=RuntimeError('m2m down')):
+            result = self._sync()
+        self.assertFalse(Product.objects.exists())
+        # Shop có lỗi nên watermark/checkpoint không tiến qua trang này
+        self.assertEqual(len(result.errors), 1)
+        self.assertIn('m2m down', result.errors[0])
+
+        self.assertEqual(self._sync().products_created, 1)
+        self.assertEqual(self._linked_categories(), [7])
+
+
+class BulkUpsertTests(TestCase):
+    def setUp(self):
+        self.shop = Shop.objects.create(pancake_id=1, name='S')
+
+    def _pages(self, *rows):
+        return [Page(shop=self.shop, pancake_id=pid, name=name, platform='facebook') for pid, name in rows]
+
+    def test_counts_created_and_updated_on_composite_key(self):
+        result = bulk_upsert(Page, self._pages(('p1', 'a'), ('p2', 'b')),
+                             unique_fields=['shop', 'pancake_id'], update_fields=['name'])
+        self.assertEqual((result.created, result.updated), (2, 0))
+
+        # Trùng key trong cùng batch: giữ row cuối
+        result = bulk_upsert(Page, self._pages(('p2', 'x'), ('p2', 'b2'), ('p3', 'c')),
+                             unique_fields=['shop', 'pancake_id'], update_fields=['name'])
+        self.assertEqual((result.created, result.updated), (1, 1))
+        self.assertEqual(dict(Page.objects.values_list('pancake_id', 'name')), {'p1': 'a', 'p2': 'b2', 'p3': 'c'})
+
+    def test_hash_field_skips_unchanged_rows(self):
+        def users(name, last_sync):
+            return [User(pancake_id='u1', name=name, last_sync=last_sync), User(pancake_id='u2', name='b')]
+
+        def upsert(objs):
+            return bulk_upsert(User, objs, unique_fields=['pancake_id'], update_fields=['name', 'last_sync'],
+                               hash_field='sync_hash')
+
+        now = timezone.now()
+        self.assertEqual(upsert(users('a', now)).created, 2)
+        # last_sync đổi mỗi lần sync, không tính là thay đổi
+        result = upsert(users('a', now + timedelta(hours=1)))
+        self.assertEqual((result.created, result.updated, result.unchanged), (0, 0, 2))
+
+        result = upsert(users('a2', now))
+        self.assertEqual((result.created, result.updated, result.unchanged), (0, 1, 1))
+        self.assertEqual(User.objects.get(pancake_id='u1').name, 'a2')
+
+
+class SyncM2MTests(TestCase):
+    def setUp(self):
+        shop = Shop.objects.create(pancake_id=1, name='S')
+        now = timezone.now()
+        self.products = [Product.objects.create(shop=shop, pancake_id=f'p{i}', display_id=f'p{i}', name=f'p{i}',
+                                                inserted_at=now) for i in range(3)]
+        self.c1, self.c2, self.c3 = [Category.objects.create(shop=shop, pancake_id=i, name=f'c{i}') for i in range(3)]
+        self.field = Product._meta.get_field('categories')
+
+    def _links(self, product):
+        return set(product.categories.values_list('pk', flat=True))
+
+    def test_adds_and_removes_only_the_diff(self):
+        p0, p1, p2 = self.products
+        p0.categories.set([self.c1, self.c2])
+        p2.categories.set([self.c3])
+
+        result = sync_m2m(self.field, {p0.pk: [self.c2.pk, self.c3.pk], p1.pk: [self.c1.pk]})
+        self.assertEqual((result.added, result.removed), (2, 1))
+        self.assertEqual(self._links(p0), {self.c2.pk, self.c3.pk})
+        self.assertEqual(self._links(p1), {self.c1.pk})
+        # Source không có trong desired không bị động tới
+        self.assertEqual(self._links(p2), {self.c3.pk})
+
+        result = sync_m2m(self.field, {p0.pk: [self.c2.pk, self.c3.pk], p1.pk: []})
+        self.assertEqual((result.added, result.removed), (0, 1))
+        self.assertEqual(self._links(p1), set())
+
+
+class PagePipelineTests(SimpleTestCase):
+    def _fetcher(self, total_pages, fail=()):
+        fetched = []
+
+        def fetch_page(page):
+            fetched.append(page)
+            if page in fail:
+                raise requests.ConnectionError(f'page {page}')
+            return {'success': True, 'total_pages': total_pages, 'data': [page]}
+        return fetch_page, fetched
+
+    def test_yields_pages_in_order_and_reports_done(self):
+        fetch_page, _ = self._fetcher(3)
+        done = []
+        pages = [fetched.page for fetched in iter_prefetched_pages(fetch_page, workers=1,
+                                                                   on_page_done=lambda f: done.append(f.page))]
+        self.assertEqual(pages, [1, 2, 3])
+        self.assertEqual(done, [1, 2, 3])
+
+    def test_page_errors_are_yielded_and_first_page_error_stops(self):
+        fetch_page, _ = self._fetcher(3, fail={2})
+        results = [(f.page, f.error is not None) for f in iter_prefetched_pages(fetch_page, workers=1)]
+        self.assertEqual(results, [(1, False), (2, True), (3, False)])
+
+        fetch_page, fetched = self._fetcher(3, fail={1})
+        self.assertEqual([f.page for f in iter_prefetched_pages(fetch_page, workers=1)], [1])
+        self.assertEqual(fetched, [1])
+
+    def test_break_stops_prefetch(self):
+        fetch_page, fetched = self._fetcher(100)
+        for fetched_page in iter_prefetched_pages(fetch_page, start_page=5, prefetch=2, workers=1):
+            self.assertEqual(fetched_page.page, 5)
+            break
+        time.sleep(0.1)
+        # Trang đang yield + tối đa prefetch trang trong queue + một trang đang chờ put
+        self.assertLessEqual(len(fetched), 4)
+        self.assertEqual(fetched[0], 5)
+
+
+    def _tracking_fetcher(self, total_pages, delays):
+        state = {'active': 0, 'peak': 0, 'threads': set()}
+        lock = threading.Lock()
+
+        def fetch_page(page):
+            with lock:
+                state['active'] += 1
+                state['peak'] = max(state['peak'], state['active'])
+                state['threads'].add(threading.current_thread().name)
+            time.sleep(delays.get(page, 0.01))
+            with lock:
+                state['active'] -= 1
+            return {'success': True, 'total_pages': total_pages, 'data': [page]}
+        return fetch_page, state
+
+    def test_concurrent_fetch_after_first_page_keeps_order(self):
+        # Trang 2 chậm nhất: các trang sau về trước nhưng vẫn phải yield theo thứ tự
+        fetch_page, state = self._tracking_fetcher(6, {2: 0.2})
+        pages = [f.page for f in iter_prefetched_pages(fetch_page, workers=3)]
+        self.assertEqual(pages, [1, 2, 3, 4, 5, 6])
+        self.assertGreater(state['peak'], 1)
+        self.assertTrue(any(name.startswith('pancake-page-fetch') for name in state['threads']))
+
+    def test_single_worker_stays_sequential(self):
+        fetch_page, state = self._tracking_fetcher(4, {})
+        self.assertEqual([f.page for f in iter_prefetched_pages(fetch_page, workers=1)], [1, 2, 3, 4])
+        self.assertEqual(state['peak'], 1)
+        self.assertEqual(state['threads'], {'pancake-page-prefetch'})
+
+
+class ShopPayloadTests(SimpleTestCase):
+    def test_merge_payload_adds_carry_from_previous_runs(self):
+        payload = {'shop_id': 1, 'shop_name': 'S', 'orders_created': 2, 'errors': ['late']}
+        carry = {'shop_id': 1, 'shop_name': 'S', 'orders_created': 3, 'orders_updated': 1, 'errors': ['early']}
+        merged = merge_payload(payload, carry)
+        self.assertEqual((merged['orders_created'], merged['orders_updated']), (5, 1))
+        self.assertEqual(merged['shop_id'], 1)
+        self.assertEqual(merged['errors'], ['early', 'late'])
+        self.assertIs(merge_payload(payload, None), payload)
+
+    def test_aggregate_sums_counts_and_errors(self):
+        result = tasks.OrderSyncResult(interrupted=True)
+        payloads = [
+            {'shop_id': 1, 'orders_created': 2, 'items_created': 5, 'errors': []},
+            None,  # Subtask không trả về kết quả
+            {'shop_id': 2, 'orders_created': 1, 'interrupted': 1, 'errors': ['Shop 2: timeout']},
+        ]
+        aggregate_shop_payloads(result, payloads)
+        self.assertEqual((result.orders_created, result.items_created, result.orders_updated), (3, 5, 0))
+        self.assertEqual(result.errors, ['Shop 2: timeout'])
+        # Field bool/None không phải số đếm
+        self.assertIs(result.interrupted, True)
+        self.assertIsNone(result.max_updated_at)
+
+
+class ShopsBulkSyncTests(TestCase):
+    def _shop(self, shop_id, pages):
+        return {'id': shop_id, 'name': f'Shop {shop_id}', 'pages': [
+            {'id': page_id, 'name': f'Page {page_id}',
+             'tags': [{'id': tag_id, 'text': f't{tag_id}'} for tag_id in tags]}
+            for page_id, tags in pages.items()
+        ]}
+
+    def _tags(self):
+        return sorted(Tag.objects.values_list('page__pancake_id', 'pancake_id'))
+
+    def test_upserts_and_deletes_stale_pages_and_tags(self):
+        result = tasks.ShopSyncResult()
+        tasks._sync_shops_bulk([self._shop(1, {'p1': [1, 2], 'p2': [3]}), self._shop(2, {'p9': [9]})], result)
+        self.assertEqual((result.shops_created, result.pages_created, result.tags_created), (2, 3, 4))
+
+        # Shop 1: bỏ page p2 (tag đi theo cascade) và tag 2; shop 2 không có trong response
+        result = tasks.ShopSyncResult()
+        shop = self._shop(1, {'p1': [1, 4]})
+        shop['name'] = 'Renamed'
+        tasks._sync_shops_bulk([shop], result)
+        self.assertEqual((result.shops_created, result.shops_updated), (0, 1))
+        self.assertEqual((result.pages_created, result.tags_created), (0, 1))
+        self.assertEqual(Shop.objects.get(pancake_id=1).name, 'Renamed')
+        self.assertEqual(sorted(Page.objects.values_list('pancake_id', flat=True)), ['p1', 'p9'])
+        self.assertEqual(self._tags(), [('p1', 1), ('p1', 4), ('p9', 9)])
+
+    def test_page_without_tags_clears_its_tags(self):
+        tasks._sync_shops_bulk([self._shop(1, {'p1': [1, 2]})], tasks.ShopSyncResult())
+        tasks._sync_shops_bulk([self._shop(1, {'p1': []})], tasks.ShopSyncResult())
+        self.assertEqual(self._tags(), [])
+        self.assertEqual(Page.objects.count(), 1)
+
+
+class CategoryTreeSyncTests(TestCase):
+    def setUp(self):
+        self.shop = Shop.objects.create(pancake_id=1, name='S')
+
+    def _sync(self, tree):
+        with mock.patch.object(tasks, '_fetch_categories_for_shop', return_value=tree):
+            return tasks._sync_categories_for_shop(self.shop)
+
+    def _parents(self):
+        return dict(Category.objects.filter(shop=self.shop).values_list('pancake_id', 'parent__pancake_id'))
+
+    def test_flatten_keeps_parent_ids(self):
+        tree = [{'id': 1, 'nodes': [{'id': 2, 'nodes': [{'id': 3}]}, {'text': 'no id'}]}, {'id': 4, 'nodes': None}]
+        flat = tasks._flatten_category_tree(tree)
+        self.assertEqual({pancake_id: parent for pancake_id, (_, parent) in flat.items()},
+                         {1: None, 2: 1, 3: 2, 4: None})
+
+    def test_tree_is_reparented_and_stale_nodes_deleted(self):
+        self.assertEqual(self._sync([{'id': 1, 'text': 'a', 'nodes': [{'id': 2, 'nodes': [{'id': 3}]}]},
+                                     {'id': 4}]), (4, 0))
+        self.assertEqual(self._parents(), {1: None, 2: 1, 3: 2, 4: None})
+
+        # 3 chuyển sang dưới 4 trước khi xoá 2, nên không bị xoá theo cascade
+        self.assertEqual(self._sync([{'id': 1, 'text': 'b'}, {'id': 4, 'nodes': [{'id': 3, 'nodes': [{'id': 5}]}]}]),
+                         (1, 3))
+        self.assertEqual(self._parents(), {1: None, 3: 4, 4: None, 5: 3})
+        self.assertEqual(Category.objects.get(shop=self.shop, pancake_id=1).name, 'b')
+
+
+class CheckpointResumeTests(TestCase):
+    def setUp(self):
+        self.shop = Shop.objects.create(pancake_id=1, name='S')
+        self.fetched = []
+
+    def _fetch(self, failing_page=None):
+        def fetch(shop_id, page, size):
+            self.fetched.append(page)
+            if page == failing_page:
+                raise requests.ConnectionError('reset by peer')
+            data = _variation_page([])
+            data['data'][0].update(id=f'v{page}', product_id=f'p{page}')
+            return dict(data, total_pages=3)
+        return fetch
+
+    def _sync(self, failing_page=None):
+        checkpoint = SyncCheckpointTracker('run-1', self.shop, 'products')
+        with mock.patch.object(tasks, '_fetch_product_variations_page', self._fetch(failing_page)):
+            return checkpoint, tasks._sync_shop_products(self.shop, checkpoint)
+
+    def test_resume_retries_failed_page(self):
+        checkpoint, result = self._sync(failing_page=2)
+        self.assertEqual(len(result.errors), 1)
+        # Trang 3 đã ghi nhưng checkpoint không vượt qua trang 2 bị lỗi
+        self.assertEqual(checkpoint.start_page, 2)
+
+        self.fetched.clear()
+        checkpoint, result = self._sync()
+        self.assertEqual(sorted(self.fetched), [2, 3])
+        self.assertEqual(result.errors, [])
+        self.assertEqual(checkpoint.start_page, 4)
+        self.assertEqual(Product.objects.count(), 3)
+
+
+class HistoryKeyTests(SimpleTestCase):
+    def test_missing_updated_at_gives_stable_key(self):
+        self.assertEqual(status_history_key(None, 2, 1, 'fb'), status_history_key(None, 2, 1, 'fb'))
+        self.assertEqual(order_history_key(None, {'status': 2}), order_history_key(None, {'status': 2}))
+        self.assertNotEqual(order_history_key(None, {'status': 2}), order_history_key(None, {'status': 3}))
+
+    def test_migration_copy_matches_runtime_keys(self):
+        migration = importlib.import_module('shops.migrations.0016_order_history_keys')
+        updated_at = datetime(2024, 1, 1, 1, 0, tzinfo=pytz.UTC)
+        for value in (updated_at, None):
+            self.assertEqual(migration.status_history_key(value, 2, 1, 'fb'), status_history_key(value, 2, 1, 'fb'))
+            self.assertEqual(migration.order_history_key(value, {'a': [1]}), order_history_key(value, {'a': [1]}))
+
+    def test_key_independent_of_timezone(self):
+        utc = datetime(2024, 1, 1, 1, 0, tzinfo=pytz.UTC)
+        local = utc.astimezone(pytz.timezone('Asia/Ho_Chi_Minh'))
+        self.assertEqual(status_history_key(utc, 2), status_history_key(local, 2))
+
+
+class MissingCustomerTagMigrationTests(TestCase):
+    def test_only_tag_and_separator_are_removed(self):
+        migration = importlib.import_module('shops.migrations.0017_order_pending_customer')
+        shop = Shop.objects.create(pancake_id=1, name='S')
+        now = timezone.now()
+        customer = Customer.objects.create(shop=shop, pancake_id='c1', customer_id='c1',
+                                           inserted_at=now, updated_at_api=now)
+        notes = {
+            'o1': ('  giao giờ hành chính \n\n[MISSING_CUSTOMER_ID:c9]', '  giao giờ hành chính \n'),
+            'o2': ('[MISSING_CUSTOMER_ID:c8]', ''),
+        }
+        for index, (pancake_id, (note, _)) in enumerate(notes.items()):
+            Order.objects.create(shop=shop, customer=customer, pancake_id=pancake_id, system_id=index,
+                                 order_sources_name='web', inserted_at=now, updated_at_api=now, note=note)
+        migration.move_missing_customer_tags(django_apps, None)
+        for pancake_id, (_, expected) in notes.items():
+            self.assertEqual(Order.objects.get(pancake_id=pancake_id).note, expected)
+        self.assertEqual(Order.objects.get(pancake_id='o1').pending_customer_pancake_id, 'c9')
+
+
+class OrderHistoryUpsertTests(TestCase):
+    def setUp(self):
+        shop = Shop.objects.create(pancake_id=1, name='S')
+        now = timezone.now()
+        customer = Customer.objects.create(shop=shop, pancake_id='c1', customer_id='c1',
+                                           inserted_at=now, updated_at_api=now)
+        self.order = Order.objects.create(shop=shop, customer=customer, pancake_id='o1', system_id=1,
+                                          order_sources_name='web', inserted_at=now, updated_at_api=now)
+
+    def test_entries_without_updated_at_are_not_reinserted(self):
+        orders_data = [{
+            'pancake_id': 'o1',
+            'status_history_data': [{'status': 1, 'old_status': 0}],
+            'histories_data': [{'status': {'old': 0, 'new': 1}}],
+        }]
+        orders_map = {'o1': self.order}
+        now = timezone.now()
+        # Hai lần sync ở hai thời điểm khác nhau
+        for sync_time, expected in ((now, 2), (now + timedelta(hours=1), 0)):
+            with mock.patch.object(tasks, '_get_vietnam_time', return_value=sync_time):
+                self.assertEqual(tasks._bulk_upsert_histories(orders_data, orders_map, {}), expected)
+        self.assertEqual(OrderStatusHistory.objects.count(), 1)
+        self.assertEqual(OrderHistory.objects.count(), 1)
+
+    def test_legacy_rows_without_updated_at_are_rekeyed(self):
+        # Row ghi trước migration 0016: updated_at là thời điểm sync, key theo giá trị đó
+        synced_at = timezone.now() - timedelta(days=1)
+        OrderStatusHistory.objects.create(order=self.order, status=1, old_status=0, updated_at=synced_at,
+                                          history_key=status_history_key(synced_at, 1, 0))
+        OrderHistory.objects.create(order=self.order, changes={'status': {'old': 0, 'new': 1}},
+                                    updated_at=synced_at,
+                                    history_key=order_history_key(synced_at, {'status': {'old': 0, 'new': 1}}))
+        orders_data = [{
+            'pancake_id': 'o1',
+            'status_history_data': [{'status': 1, 'old_status': 0}, {'status': 2, 'old_status': 1,
+                                                                      'updated_at': '2024-01-02T00:00:00'}],
+            'histories_data': [{'status': {'old': 0, 'new': 1}}],
+        }]
+        self.assertEqual(tasks._bulk_upsert_histories(orders_data, {'o1': self.order}, {}), 1)
+        self.assertEqual(OrderStatusHistory.objects.count(), 2)
+        self.assertEqual(OrderHistory.objects.count(), 1)
+        self.assertTrue(OrderStatusHistory.objects.filter(history_key=status_history_key(None, 1, 0)).exists())
+        self.assertEqual(tasks._bulk_upsert_histories(orders_data, {'o1': self.order}, {}), 0)
+
+
+def _customers_response(*customer_ids):
+    return {'success': True, 'data': [
+        {'id': c, 'customer_id': c, 'name': c, 'inserted_at': '2024-01-01T00:00:00',
+         'updated_at': '2024-01-01T00:00:00'}
+        for c in customer_ids
+    ]}
+
+
+class MissingCustomerFetchTests(TestCase):
+    def setUp(self):
+        self.shop = Shop.objects.create(pancake_id=1, name='S')
+        self.result = tasks.OrderSyncResult()
+        self.lookup = tasks.CustomerLookupState()
+        self.client = mock.Mock()
+        patcher = mock.patch.object(tasks, 'get_pancake_client', return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _fetch(self, customer_ids):
+        return tasks._fetch_missing_customers(self.shop, set(customer_ids), {}, self.result, RefCache(), self.lookup)
+
+    def test_ids_not_returned_are_not_requested_again(self):
+        self.client.get_json.return_value = _customers_response('c1')
+        self.assertEqual(set(self._fetch(['c1', 'gone'])), {'c1'})
+        self.assertEqual(self.lookup.not_found, {'gone'})
+
+        self._fetch(['gone'])
+        self.assertEqual(self.client.get_json.call_count, 1)
+
+    def test_ignored_filter_disables_fetch_by_id(self):
+        # API trả về trang customers bình thường, không lọc theo customer_ids
+        self.client.get_json.return_value = _customers_response('other', 'c1')
+        self.assertEqual(set(self._fetch(['c1', 'c2'])), {'c1'})
+        self.assertFalse(self.lookup.by_id_supported)
+        self.assertEqual(self.lookup.not_found, set())
+
+        self._fetch(['c3'])
+        self.assertEqual(self.client.get_json.call_count, 1)
+        self.assertEqual(self.result.customers_fetched, 1)
+
+
+class RefCacheTests(TestCase):
+    def setUp(self):
+        self.users = {pancake_id: User.objects.create(pancake_id=pancake_id, name=pancake_id).pk
+                      for pancake_id in ('u1', 'u2', 'u3')}
+
+    def test_hits_skip_queries_and_unknown_ids_are_not_cached(self):
+        cache = RefCache()
+        with self.assertNumQueries(1):
+            resolved = cache.resolve(User, ['u1', 'u2', 'missing'])
+        self.assertEqual({pancake_id: user.pk for pancake_id, user in resolved.items()},
+                         {'u1': self.users['u1'], 'u2': self.users['u2']})
+        with self.assertNumQueries(0):
+            self.assertEqual(set(cache.resolve(User, ['u1', 'u2'])), {'u1', 'u2'})
+        # Id không tìm thấy vẫn được query lại (có thể đã được tạo sau đó)
+        with self.assertNumQueries(1):
+            cache.resolve(User, ['missing'])
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 4, 'hit_rate': 0.3333, 'size': 2, 'evictions': 0})
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = RefCache(max_size=2)
+        cache.resolve(User, ['u1'])
+        cache.resolve(User, ['u2'])
+        cache.resolve(User, ['u1'])
+        cache.resolve(User, ['u3'])
+        self.assertEqual(cache.evictions, 1)
+        with self.assertNumQueries(0):
+            cache.resolve(User, ['u1', 'u3'])
+        with self.assertNumQueries(1):
+            cache.resolve(User, ['u2'])
+
+    def test_queryset_scopes_lookup(self):
+        cache = RefCache()
+        self.assertEqual(cache.resolve(User, ['u1', 'u2'], User.objects.filter(name='u1')).keys(), {'u1'})
+
+    def test_rows_created_during_sync_are_remembered(self):
+        shop = Shop.objects.create(pancake_id=1, name='S')
+        client = mock.Mock()
+        client.get_json.return_value = _customers_response('c1')
+        cache = RefCache()
+        with mock.patch.object(tasks, 'get_pancake_client', return_value=client):
+            created = tasks._fetch_missing_customers(shop, {'c1'}, {}, tasks.OrderSyncResult(), cache,
+                                                     tasks.CustomerLookupState())
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.resolve(Customer, ['c1'])['c1'].pk, created['c1'].pk)
+
+
+class AnonymousCustomerTests(TestCase):
+    def test_memo_is_per_run(self):
+        shop = Shop.objects.create(pancake_id=1, name='S')
+        ref_cache = RefCache()
+        first = tasks._get_or_create_anonymous_customer(shop, ref_cache)
+        self.assertEqual(tasks._get_or_create_anonymous_customer(shop, ref_cache).pk, first.pk)
+
+        # Row bị xoá giữa hai run: run sau tạo lại thay vì dùng instance cũ
+        Customer.objects.filter(pk=first.pk).delete()
+        recreated = tasks._get_or_create_anonymous_customer(shop, RefCache())
+        self.assertNotEqual(recreated.pk, first.pk)
+        self.assertTrue(Customer.objects.filter(pk=recreated.pk, pancake_id='anonymous').exists())
+
+
+class SyncProgressTests(TestCase):
+    def _progress(self, state, info=None):
+        async_result = mock.Mock(state=state, info=info, result=info)
+        with mock.patch('api_integration.sync_progress.AsyncResult', return_value=async_result):
+            return get_sync_progress('task-1')
+
+    def test_worker_states(self):
+        self.assertEqual(self._progress('PENDING')['status'], 'queued')
+        progress = self._progress('PROGRESS', {'current': 3, 'total': 4, 'message': 'Shop 3/4'})
+        self.assertEqual((progress['status'], progress['percent'], progress['message']), ('running', 75, 'Shop 3/4'))
+        self.assertEqual(self._progress('RETRY')['status'], 'running')
+        failed = self._progress('FAILURE', RuntimeError('boom'))
+        self.assertEqual((failed['status'], failed['finished'], failed['message']), ('failed', True, 'boom'))
+
+    def test_inline_task_result(self):
+        progress = self._progress('SUCCESS', {'success': False, 'message': '2 shops failed'})
+        self.assertEqual((progress['status'], progress['finished'], progress['percent']),
+                         ('completed_with_errors', True, 100))
+        self.assertEqual(progress['message'], '2 shops failed')
+
+    def test_fan_out_run_reads_history_and_checkpoints(self):
+        shop = Shop.objects.create(pancake_id=1, name='S')
+        history = SyncHistory.objects.create(sync_type='orders', status='running')
+        SyncCheckpoint.objects.create(run_id='run-1:1-2', shop=shop, entity='orders', last_page=7, completed=True)
+        SyncCheckpoint.objects.create(run_id='run-1:3-4', shop=shop, entity='orders', last_page=2)
+        SyncCheckpoint.objects.create(run_id='run-10', shop=shop, entity='orders', last_page=50, completed=True)
+        dispatched = {'success': True, 'data': {'sync_history_id': history.id, 'run_id': 'run-1', 'windows': 4}}
+
+        progress = self._progress('SUCCESS', dispatched)
+        self.assertEqual((progress['status'], progress['finished']), ('running', False))
+        self.assertEqual((progress['current'], progress['total'], progress['percent']), (1, 4, 25))
+        self.assertEqual(progress['pages_committed'], 9)
+
+        SyncHistory.objects.filter(id=history.id).update(status='failed', error_message='Shop S: timeout')
+        progress = self._progress('SUCCESS', dispatched)
+        self.assertEqual((progress['status'], progress['finished'], progress['percent']), ('failed', True, 100))
+        self.assertEqual(progress['message'], 'Shop S: timeout')
+
+
+class SyncEventFilterTests(SimpleTestCase):
+    event = {'run_id': 'run-1', 'entity': 'orders', 'shop_id': 5}
+
+    def test_matches_run_and_backfill_windows(self):
+        self.assertTrue(event_matches(self.event))
+        self.assertTrue(event_matches(self.event, run_id='run-1', entity='orders', shop_id='5'))
+        self.assertTrue(event_matches(dict(self.event, run_id='run-1:2024-01-01-2024-02-01'), run_id='run-1'))
+        self.assertFalse(event_matches(dict(self.event, run_id='run-10'), run_id='run-1'))
+        self.assertFalse(event_matches({'entity': 'orders'}, run_id='run-1'))
+
+    def test_filters_entity_and_shop(self):
+        self.assertFalse(event_matches(self.event, entity='customers'))
+        self.assertFalse(event_matches(self.event, shop_id='6'))
+
+
+class SyncEventsViewTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('staff', password='x')
+        self.url = reverse('api_integration:sync_events')
+
+    def test_wsgi_request_gets_503_instead_of_hanging(self):
+        self.client.force_login(self.user)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['error_code'], 'EVENTS_REQUIRE_ASGI')
+
+    async def test_redis_down_gets_503_before_streaming(self):
+        await self.async_client.aforce_login(self.user)
+        with mock.patch.object(sync_events, '_redis_url', return_value='redis://127.0.0.1:1/0'):
+            response = await self.async_client.get(self.url)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['error_code'], 'EVENTS_UNAVAILABLE')
+
+    async def test_stream_ends_when_redis_drops(self):
+        client = mock.AsyncMock()
+        pubsub = mock.AsyncMock()
+        pubsub.get_message.side_effect = redis.ConnectionError('gone')
+        chunks = [chunk async for chunk in sync_events.iter_sse_events(client, pubsub, heartbeat=1)]
+        self.assertEqual(chunks[0], 'retry: 5000\n\n')
+        self.assertTrue(chunks[-1].startswith('event: stream_error\n'))
+        pubsub.aclose.assert_awaited_once()
+        client.aclose.assert_awaited_once()
+
+
+class OrderWindowTests(SimpleTestCase):
+    def _assert_contiguous(self, windows, start, end):
+        self.assertEqual(windows[0][0], int(start.timestamp()))
+        self.assertEqual(windows[-1][1], int(end.timestamp()))
+        for (_, previous_end), (next_start, _) in zip(windows, windows[1:]):
+            self.assertEqual(next_start, previous_end + 1)
+
+    def test_month_windows_cut_at_local_month_start(self):
+        tz = pytz.timezone('Asia/Ho_Chi_Minh')
+        start = tz.localize(datetime(2024, 1, 15, 10, 30))
+        end = tz.localize(datetime(2024, 3, 10, 12, 0))
+        windows = month_windows(start, end)
+        self.assertEqual(len(windows), 3)
+        self._assert_contiguous(windows, start, end)
+        self.assertEqual([datetime.fromtimestamp(s, tz) for s, _ in windows[1:]],
+                         [tz.localize(datetime(2024, 2, 1)), tz.localize(datetime(2024, 3, 1))])
+
+    def test_month_windows_across_dst_start_at_local_midnight(self):
+        tz = pytz.timezone('Europe/Berlin')
+        start = tz.localize(datetime(2024, 2, 15))
+        end = tz.localize(datetime(2024, 11, 10))
+        windows = month_windows(start, end)
+        self.assertEqual(len(windows), 10)
+        self._assert_contiguous(windows, start, end)
+        for window_start, _ in windows[1:]:
+            local = datetime.fromtimestamp(window_start, tz)
+            self.assertEqual((local.day, local.hour, local.minute), (1, 0, 0))
+
+    def test_month_windows_single_and_empty_range(self):
+        moment = datetime(2024, 5, 5, tzinfo=pytz.UTC)
+        self.assertEqual(month_windows(moment, moment), [(int(moment.timestamp()), int(moment.timestamp()))])
+        self.assertEqual(month_windows(moment, moment - timedelta(seconds=1)), [])
+
+    def test_adaptive_splits_large_windows_down_to_min_size(self):
+        day = MIN_WINDOW_SECONDS
+        # 4 trang mỗi ngày: window 8 ngày chia đôi tới 2 ngày (8 trang) rồi 1 ngày (4 trang)
+        probe = mock.Mock(side_effect=lambda s, e: 4 * ((e - s + 1) // day))
+        windows = adaptive_windows([(0, 8 * day - 1)], target_pages=5, probe_pages=probe)
+        self.assertEqual(windows, [(i * day, (i + 1) * day - 1) for i in range(8)])
+
+        # Một ngày vẫn vượt target: không chia nhỏ hơn min_window_seconds
+        probe = mock.Mock(return_value=50)
+        self.assertEqual(adaptive_windows([(0, day - 1)], target_pages=5, probe_pages=probe), [(0, day - 1)])
+        probe.assert_called_once_with(0, day - 1)
+
+    def test_adaptive_merges_adjacent_small_windows_and_drops_empty(self):
+        windows = [(0, 9), (10, 19), (20, 29), (30, 39), (40, 49), (50, 59)]
+        pages = {0: 1, 10: 2, 20: 3, 30: 0, 40: 1, 50: 1}
+        merged = adaptive_windows(windows, target_pages=4, probe_pages=lambda s, e: pages[s])
+        # (20, 29) vượt target nếu gộp; (30, 39) không có đơn nên (40, 49) không liền kề (20, 29)
+        self.assertEqual(merged, [(0, 19), (20, 29), (40, 59)])
+
+
+class OrdersWatermarkTests(TestCase):
+    def setUp(self):
+        self.shop = Shop.objects.create(pancake_id=1, name='S')
+        self.start, self.end = int(time.time()) - 30 * 86400, int(time.time())
+
+    def _run(self, shop_result, run_id='run-1'):
+        with mock.patch.object(tasks, '_sync_shop_orders_with_date_range', return_value=shop_result):
+            return tasks.sync_shop_orders_subtask.apply(kwargs={
+                'shop_id': self.shop.id, 'run_id': run_id, 'start_timestamp': self.start,
+                'end_timestamp': self.end, 'lock_policy': 'skip',
+            }).get()
+
+    def _watermark(self):
+        return SyncWatermark.objects.filter(shop=self.shop, entity='orders').values_list('watermark', flat=True).first()
+
+    def test_no_observed_updated_at_keeps_watermark(self):
+        self._run(tasks.OrderSyncResult())
+        self.assertIsNone(self._watermark())
+
+        observed = timezone.now() - timedelta(hours=1)
+        self._run(tasks.OrderSyncResult(max_updated_at=observed), run_id='run-2')
+        self.assertEqual(self._watermark(), observed)
+        self._run(tasks.OrderSyncResult(), run_id='run-3')
+        self.assertEqual(self._watermark(), observed)
+
+    def test_shop_errors_keep_watermark(self):
+        self._run(tasks.OrderSyncResult(max_updated_at=timezone.now(), errors=['Histories error page 1']))
+        self.assertIsNone(self._watermark())
+
+    def test_history_write_errors_are_raised(self):
+        order = Order(id=1)
+        orders_data = [{'pancake_id': 'o1', 'status_history_data': [{'status': 1}]}]
+        with mock.patch.object(OrderStatusHistory.objects, 'filter', side_effect=RuntimeError('db down')):
+            with self.assertRaises(RuntimeError):
+                tasks._bulk_upsert_histories(orders_data, {'o1': order}, {})
+
+    def test_shop_windows_reported_per_shop(self):
+        watermark = timezone.now() - timedelta(hours=2)
+        SyncWatermark.objects.create(shop=self.shop, entity='orders', watermark=watermark)
+        self._run(tasks.OrderSyncResult())
+        windows = tasks._orders_shop_windows('run-1')
+        self.assertEqual(len(windows), 1)
+        self.assertTrue(windows[0]['is_incremental'])
+        self.assertLess(windows[0]['days_covered'], 1)
+
+
+class WatermarkTests(TestCase):
+    def setUp(self):
+        self.shop = Shop.objects.create(pancake_id=1, name='S')
+        self.t0 = timezone.now()
+
+    def _watermark(self):
+        return SyncWatermark.objects.get(shop=self.shop, entity='orders').watermark
+
+    def test_watermark_only_moves_forward(self):
+        advance_watermark(self.shop, 'orders', self.t0)
+        advance_watermark(self.shop, 'orders', self.t0 + timedelta(hours=1))
+        # Run chồng nhau xong sau với watermark cũ hơn
+        advance_watermark(self.shop, 'orders', self.t0 + timedelta(minutes=30))
+        advance_watermark(self.shop, 'orders', None)
+        self.assertEqual(self._watermark(), self.t0 + timedelta(hours=1))
+
+    def test_null_watermark_is_advanced(self):
+        advance_watermark(self.shop, 'orders', None)
+        advance_watermark(self.shop, 'orders', self.t0)
+        self.assertEqual(self._watermark(), self.t0)
+
+
+    def test_incremental_start_overlaps_watermark(self):
+        fallback = self.t0 - timedelta(days=30)
+        self.assertEqual(get_incremental_start(self.shop, 'orders', fallback), (fallback, False))
+
+        advance_watermark(self.shop, 'orders', self.t0)
+        self.assertEqual(get_incremental_start(self.shop, 'orders', fallback),
+                         (self.t0 - WATERMARK_OVERLAP, True))
+        # Watermark theo entity: customers vẫn full window
+        self.assertEqual(get_incremental_start(self.shop, 'customers', fallback), (fallback, False))
+
+    def test_null_watermark_falls_back_to_full_window(self):
+        advance_watermark(self.shop, 'orders', None)
+        fallback = self.t0 - timedelta(days=30)
+        self.assertEqual(get_incremental_start(self.shop, 'orders', fallback), (fallback, False))
+
+
+class CustomerSyncModeTests(TestCase):
+    def setUp(self):
+        self.shop = Shop.objects.create(pancake_id=1, name='S')
+        self.end = timezone.now().replace(microsecond=0)
+        self.window_start = self.end - timedelta(days=30)
+        self.watermark = self.end - timedelta(hours=2)
+        SyncWatermark.objects.create(shop=self.shop, entity='customers', watermark=self.watermark)
+
+    def _run(self, mode, run_id='run-1', shop_result=None):
+        shop_result = shop_result or tasks.CustomerSyncResult(max_updated_at=self.end - timedelta(minutes=5))
+        with mock.patch.object(tasks, '_sync_shop_customers', return_value=shop_result) as sync_shop, \
+                mock.patch.object(tasks, '_reassign_pending_orders', return_value=0):
+            tasks.sync_shop_customers_subtask.apply(kwargs={
+                'shop_id': self.shop.id, 'run_id': run_id, 'mode': mode,
+                'start_time_updated_at': self.window_start.isoformat(),
+                'end_time_updated_at': self.end.isoformat(),
+            }).get()
+        return sync_shop.call_args.kwargs
+
+    def _watermark(self):
+        return SyncWatermark.objects.get(shop=self.shop, entity='customers').watermark
+
+    def test_incremental_starts_from_watermark(self):
+        kwargs = self._run('incremental')
+        self.assertEqual(kwargs['start_time_updated_at'], self.watermark - WATERMARK_OVERLAP)
+        self.assertEqual(kwargs['end_time_updated_at'], self.end)
+        self.assertEqual(self._watermark(), self.end - timedelta(minutes=5))
+
+    def test_reconcile_scans_full_window(self):
+        kwargs = self._run('reconcile')
+        self.assertEqual(kwargs['start_time_updated_at'], self.window_start)
+        self.assertEqual(self._watermark(), self.end - timedelta(minutes=5))
+
+    def test_incremental_without_watermark_uses_window(self):
+        SyncWatermark.objects.all().delete()
+        self.assertEqual(self._run('incremental')['start_time_updated_at'], self.window_start)
+
+    def test_errors_keep_watermark(self):
+        self._run('incremental', shop_result=tasks.CustomerSyncResult(max_updated_at=self.end, errors=['page 2']))
+        self.assertEqual(self._watermark(), self.watermark)
+
+
+class RateLimiterRedisErrorTests(SimpleTestCase):
+    def setUp(self):
+        # Port 1: kết nối bị từ chối ngay
+        self.limiter = PancakeRateLimiter('key', redis_url='redis://127.0.0.1:1/0')
+
+    def test_single_error_keeps_limiter_enabled(self):
+        self.limiter.acquire()
+        self.assertIsNotNone(self.limiter._client())
+
+    def test_repeated_errors_bypass_limiter(self):
+        for _ in range(PancakeRateLimiter.FAILURE_THRESHOLD):
+            self.limiter.acquire()
+        self.assertIsNone(self.limiter._client())
+
+        with mock.patch('api_integration.rate_limiter.time.time',
+                        return_value=time.time() + PancakeRateLimiter.BYPASS_SECONDS + 1):
+            self.assertIsNotNone(self.limiter._client())
+
+
+class ContinuationTests(TestCase):
+    def setUp(self):
+        self.shop = Shop.objects.create(pancake_id=1, name='S')
+        self.task = mock.Mock()
+        self.task.request = mock.Mock(id='task-1', hostname='w1', retries=0, args=(),
+                                      kwargs={'shop_id': self.shop.id, 'run_id': 'run-1'})
+        self.task.replace.return_value = 'continued'
+        self.lock = mock.Mock(lost=False)
+        self.lock.acquire.return_value = True
+        patcher = mock.patch('api_integration.shop_fanout.ShopSyncLock', return_value=self.lock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_budget_exhausts_at_deadline_or_stop_condition(self):
+        with mock.patch('api_integration.task_budget.time.monotonic', return_value=1000.0):
+            budget = TaskTimeBudget(soft_limit=600, margin=120)
+        self.assertEqual(budget.deadline, 1480.0)
+        with mock.patch('api_integration.task_budget.time.monotonic', return_value=1479.0):
+            self.assertFalse(budget.exhausted())
+            budget.stop_when = lambda: True
+            self.assertTrue(budget.exhausted())
+        budget.stop_when = None
+        with mock.patch('api_integration.task_budget.time.monotonic', return_value=1480.0):
+            self.assertTrue(budget.exhausted())
+
+    def test_replacement_keeps_kwargs_with_overrides(self):
+        replace_with_continuation(self.task, carry={'orders_created': 1})
+        self.task.s.assert_called_once_with(shop_id=self.shop.id, run_id='run-1', carry={'orders_created': 1})
+        self.task.replace.assert_called_once_with(self.task.s.return_value)
+
+    def test_interrupted_shop_continues_with_carry(self):
+        def interrupted(shop, checkpoint, budget):
+            return tasks.OrderSyncResult(orders_created=2, interrupted=True, errors=['page 3'])
+
+        on_completed = mock.Mock()
+        self.assertEqual(run_shop_sync(self.task, self.shop.id, 'run-1', 'orders', interrupted, on_completed),
+                         'continued')
+        on_completed.assert_not_called()
+        self.lock.suspend.assert_called_once()
+        carry = self.task.s.call_args.kwargs['carry']
+        self.assertEqual((carry['orders_created'], carry['errors']), (2, ['page 3']))
+
+        # Task tiếp nối: cộng kết quả của lần trước, xong thì mới chạy on_completed
+        def finished(shop, checkpoint, budget):
+            return tasks.OrderSyncResult(orders_created=3)
+
+        payload = run_shop_sync(self.task, self.shop.id, 'run-1', 'orders', finished, on_completed, carry=carry)
+        self.assertEqual((payload['orders_created'], payload['errors']), (5, ['page 3']))
+        on_completed.assert_called_once()
+        self.lock.release.assert_called_once()
+        self.assertTrue(SyncCheckpointTracker('run-1', self.shop, 'orders').completed)
+
+
+class LostLockTests(TestCase):
+    def setUp(self):
+        self.shop = Shop.objects.create(pancake_id=1, name='S')
+        self.task = mock.Mock()
+        self.task.request = mock.Mock(id='task-1', hostname='w1', retries=0, kwargs={'shop_id': self.shop.id},
+                                      args=())
+        self.task.replace.return_value = 'continued'
+        self.lock = mock.Mock(lost=False)
+        self.lock.acquire.return_value = True
+        patcher = mock.patch('api_integration.shop_fanout.ShopSyncLock', return_value=self.lock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_run_stops_without_watermark_after_losing_lock(self):
+        pages = []
+
+        def sync_shop(shop, checkpoint, budget):
+            result = tasks.OrderSyncResult()
+            for page in (1, 2, 3):
+                if budget.exhausted():
+                    result.interrupted = True
+                    break
+                pages.append(page)
+                # Heartbeat phát hiện run khác đã lấy lock trong lúc ghi trang 1
+                self.lock.lost = True
+            return result
+
+        on_completed = mock.Mock()
+        self.assertEqual(run_shop_sync(self.task, self.shop.id, 'run-1', 'orders', sync_shop, on_completed),
+                         'continued')
+        self.assertEqual(pages, [1])
+        on_completed.assert_not_called()
+        self.assertFalse(SyncCheckpointTracker('run-1', self.shop, 'orders').completed)
+        self.lock.release.assert_not_called()
+
+    def test_lost_after_last_page_is_not_completed(self):
+        def sync_shop(shop, checkpoint, budget):
+            self.lock.lost = True
+            return tasks.OrderSyncResult()
+
+        on_completed = mock.Mock()
+        run_shop_sync(self.task, self.shop.id, 'run-1', 'orders', sync_shop, on_completed)
+        on_completed.assert_not_called()
+        self.task.replace.assert_called_once()
+
+
+class TaskRoutingTests(SimpleTestCase):
+    def _route(self, short_name, **kwargs):
+        route = sync_task_route(f'api_integration.tasks.{short_name}', (), kwargs, {})
+        return route['queue'], route['priority']
+
+    def test_mode_routed_tasks_follow_mode(self):
+        for name in ('sync_orders_task', 'sync_shop_customers_subtask', 'finalize_orders_sync'):
+            self.assertEqual(self._route(name), (HOT_QUEUE, HOT_PRIORITY))
+            self.assertEqual(self._route(name, mode='incremental'), (HOT_QUEUE, HOT_PRIORITY))
+            self.assertEqual(self._route(name, mode='reconcile'), (BULK_QUEUE, BULK_PRIORITY))
+        self.assertEqual(self._route('sync_orders_task', mode='repair'), (BULK_QUEUE, BULK_PRIORITY))
+        self.assertEqual(self._route('finalize_orders_sync', mode='backfill'), (BULK_QUEUE, BACKGROUND_PRIORITY))
+
+    def test_named_tasks(self):
+        self.assertEqual(self._route('sync_single_shop_orders'), (HOT_QUEUE, HOT_PRIORITY))
+        self.assertEqual(self._route('sync_all_products'), (BULK_QUEUE, BULK_PRIORITY))
+        self.assertEqual(self._route('sync_orders_window_subtask'), (BULK_QUEUE, BACKGROUND_PRIORITY))
+        self.assertEqual(self._route('cleanup_old_checkpoints_task'), (BULK_QUEUE, BACKGROUND_PRIORITY))
+        self.assertIsNone(sync_task_route('celery.chord_unlock', (), {}, {}))
+
+    def test_router_is_installed_in_celery_app(self):
+        route = celery_app.amqp.router.route({}, 'api_integration.tasks.sync_orders_task', (), {'mode': 'repair'})
+        self.assertEqual((route['queue'].name, route['priority']), (BULK_QUEUE, BULK_PRIORITY))
+
+
+def _redis_available() -> bool:
+    try:
+        return lock_client().ping()
+    except redis.RedisError:
+        return False
+
+
+@unittest.skipUnless(_redis_available(), 'Redis (CELERY_BROKER_URL) không kết nối được')
+class ShopSyncLockTests(SimpleTestCase):
+    def setUp(self):
+        self.shop = Shop(id=987654, name='S')
+        self.locks = []
+
+    def tearDown(self):
+        for lock in self.locks:
+            lock.release()
+        lock_client().delete(ShopSyncLock(self.shop, 'orders', owner='x').key)
+
+    def _lock(self, owner, holder=None):
+        lock = ShopSyncLock(self.shop, 'orders', owner=owner, holder=holder, ttl=30)
+        self.locks.append(lock)
+        return lock
+
+    def test_other_run_blocked_and_same_run_reenters(self):
+        self.assertTrue(self._lock('run-a').acquire())
+        self.assertFalse(self._lock('run-b').acquire())
+        self.assertTrue(self._lock('run-a').acquire())
+
+    def test_backfill_windows_share_lock_until_last_release(self):
+        window_1, window_2 = self._lock('bf', 'bf:1-2'), self._lock('bf', 'bf:3-4')
+        incremental = self._lock('inc')
+        self.assertTrue(window_1.acquire())
+        self.assertTrue(window_2.acquire())
+        self.assertFalse(incremental.acquire())
+        window_1.release()
+        self.assertFalse(incremental.acquire())
+        window_2.release()
+        self.assertTrue(incremental.acquire())
+
+    def test_heartbeat_marks_lock_lost_after_takeover(self):
+        lock = ShopSyncLock(self.shop, 'orders', owner='run-a', ttl=3)
+        self.locks.append(lock)
+        self.assertTrue(lock.acquire())
+        # Lease hết hạn (worker treo), run khác lấy lock
+        lock_client().delete(lock.key)
+        self.assertTrue(self._lock('run-b').acquire())
+        for _ in range(30):
+            if lock.lost:
+                break
+            time.sleep(0.1)
+        self.assertTrue(lock.lost)
+
+
+@unittest.skipUnless(_redis_available(), 'Redis (CELERY_BROKER_URL) không kết nối được')
+class SyncPipelineTests(TransactionTestCase):
+    """Chạy pipeline thật trên một worker trong thread, các hàm gọi Pancake API được thay bằng stub"""
+
+    def setUp(self):
+        for i in range(2):
+            Shop.objects.create(pancake_id=100 + i, name=f'S{i}')
+        self.calls = []
+
+        def stub(name, result_class, **counts):
+            def run(*args, **kwargs):
+                shop = args[0] if args else None
+                self.calls.append(f"{name}:{shop.name}" if shop else name)
+                return result_class(**counts)
+            return run
+
+        stubs = {
+            '_sync_all_shops': stub('shops', tasks.ShopSyncResult),
+            '_sync_all_categories': stub('categories', tasks.CategorySyncResult),
+            '_sync_shop_products': stub('products', tasks.ProductSyncResult, products_created=1),
+            '_sync_shop_customers': stub('customers', tasks.CustomerSyncResult, customers_created=1),
+            '_sync_shop_orders_with_date_range': stub('orders', tasks.OrderSyncResult, orders_created=1),
+        }
+        for name, func in stubs.items():
+            patcher = mock.patch.object(tasks, name, side_effect=func)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_orders_stage_runs_after_fan_out_stages(self):
+        with start_worker(celery_app, pool='solo', perform_ping_check=False, shutdown_timeout=30,
+                          queues=[HOT_QUEUE, BULK_QUEUE, celery_app.conf.task_default_queue]):
+            result = tasks._build_sync_pipeline(timezone.now().isoformat()).apply_async()
+            final = result.get(timeout=60)
+
+        self.assertTrue(final['success'])
+        self.assertEqual(final['orders_result']['data']['orders_created'], 2)
+        stages = [call.split(':')[0] for call in self.calls]
+        first_order = stages.index('orders')
+        self.assertEqual(stages.count('products'), 2)
+        self.assertEqual(stages.count('customers'), 2)
+        self.assertNotIn('products', stages[first_order:])
+        self.assertNotIn('customers', stages[first_order:])
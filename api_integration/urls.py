@@ -9,5 +9,7 @@ urlpatterns = [
     path('sync-categories/', views.sync_categories, name='sync_categories'),
     path('sync/products/', views.sync_products, name='sync_products'),
     path('sync/customers/', views.sync_customers, name='sync_customers'),
-    path('sync/orders/', views.sync_orders, name='sync_orders')
+    path('sync/orders/', views.sync_orders, name='sync_orders'),
+    path('sync/progress/<str:task_id>/', views.sync_progress, name='sync_progress'),
+    path('sync/events/', views.sync_events, name='sync_events'),
 ]
\ No newline at end of file
@@ -312,6 +312,24 @@ class SyncHistoryAdmin(admin.ModelAdmin):
             'fields': ('started_at', 'finished_at')
         }),
     )
+
+
+# ---------- SyncWatermark ----------
+@admin.register(SyncWatermark)
+class SyncWatermarkAdmin(admin.ModelAdmin):
+    list_display = ('shop', 'entity', 'watermark', 'last_synced_at', 'updated_at')
+    list_filter = ('entity', 'shop')
+    search_fields = ('shop__name',)
+    readonly_fields = ('updated_at',)
+
+
+# ---------- SyncCheckpoint ----------
+@admin.register(SyncCheckpoint)
+class SyncCheckpointAdmin(admin.ModelAdmin):
+    list_display = ('run_id', 'shop', 'entity', 'last_page', 'error_count', 'completed', 'updated_at')
+    list_filter = ('entity', 'completed', 'shop')
+    search_fields = ('run_id', 'shop__name')
+    readonly_fields = ('created_at', 'updated_at')
 class CustomerAddressInline(admin.TabularInline):
     model = CustomerAddress
     extra = 0
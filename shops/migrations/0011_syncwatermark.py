@@ -0,0 +1,31 @@
+# Generated by Django 5.2.6 on 2026-10-17 00:51
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shops', '0010_alter_order_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entity', models.CharField(choices=[('orders', 'Orders'), ('customers', 'Customers')], max_length=20)),
+                ('watermark', models.DateTimeField(blank=True, null=True)),
+                ('last_synced_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('shop', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sync_watermarks', to='shops.shop')),
+            ],
+            options={
+                'verbose_name': 'Mốc đồng bộ',
+                'verbose_name_plural': 'Mốc đồng bộ',
+                'db_table': 'sync_watermarks',
+                'unique_together': {('shop', 'entity')},
+            },
+        ),
+    ]
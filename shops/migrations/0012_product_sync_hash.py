@@ -0,0 +1,23 @@
+# Generated by Django 5.2.6 on 2026-10-17 00:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shops', '0011_syncwatermark'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='sync_hash',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='productvariation',
+            name='sync_hash',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.6 on 2026-10-17 00:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shops', '0012_product_sync_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run_id', models.CharField(max_length=255)),
+                ('entity', models.CharField(choices=[('orders', 'Orders'), ('products', 'Products'), ('customers', 'Customers')], max_length=20)),
+                ('last_page', models.IntegerField(default=0)),
+                ('watermark', models.DateTimeField(blank=True, null=True)),
+                ('error_count', models.IntegerField(default=0)),
+                ('params', models.JSONField(blank=True, default=dict)),
+                ('completed', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('shop', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sync_checkpoints', to='shops.shop')),
+            ],
+            options={
+                'verbose_name': 'Checkpoint đồng bộ',
+                'verbose_name_plural': 'Checkpoint đồng bộ',
+                'db_table': 'sync_checkpoints',
+                'indexes': [models.Index(fields=['updated_at'], name='sync_checkp_updated_060f84_idx')],
+                'unique_together': {('run_id', 'shop', 'entity')},
+            },
+        ),
+    ]
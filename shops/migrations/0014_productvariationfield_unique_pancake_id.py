@@ -0,0 +1,50 @@
+# Generated by Django 5.2.6 on 2026-10-17 01:05
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def merge_duplicate_fields(apps, schema_editor):
+    """Gộp các ProductVariationField trùng pancake_id trước khi thêm unique (giữ id nhỏ nhất)"""
+    ProductVariationField = apps.get_model('shops', 'ProductVariationField')
+    ProductVariation = apps.get_model('shops', 'ProductVariation')
+    Through = ProductVariation.fields.through
+
+    duplicates = (
+        ProductVariationField.objects.values('pancake_id')
+        .annotate(keep_id=Min('id'), total=Count('id'))
+        .filter(total__gt=1)
+    )
+    for duplicate in duplicates:
+        keep_id = duplicate['keep_id']
+        drop_ids = list(
+            ProductVariationField.objects.filter(pancake_id=duplicate['pancake_id'])
+            .exclude(id=keep_id).values_list('id', flat=True)
+        )
+        linked_variation_ids = set(
+            Through.objects.filter(productvariationfield_id=keep_id).values_list('productvariation_id', flat=True)
+        )
+        for link in Through.objects.filter(productvariationfield_id__in=drop_ids):
+            if link.productvariation_id in linked_variation_ids:
+                link.delete()
+            else:
+                link.productvariationfield_id = keep_id
+                link.save(update_fields=['productvariationfield'])
+                linked_variation_ids.add(link.productvariation_id)
+        ProductVariationField.objects.filter(id__in=drop_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shops', '0013_synccheckpoint'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_fields, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='productvariationfield',
+            name='pancake_id',
+            field=models.CharField(max_length=100, unique=True),
+        ),
+    ]
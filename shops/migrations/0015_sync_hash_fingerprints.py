@@ -0,0 +1,58 @@
+# Generated by Django 5.2.6 on 2026-10-17 01:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shops', '0014_productvariationfield_unique_pancake_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='sync_hash',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='customeraddress',
+            name='sync_hash',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='sync_hash',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='sync_hash',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='orderpartner',
+            name='sync_hash',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='ordershippingaddress',
+            name='sync_hash',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='orderwarehouse',
+            name='sync_hash',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='productvariationfield',
+            name='sync_hash',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='sync_hash',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+    ]
@@ -0,0 +1,98 @@
+# Generated by Django 5.2.6 on 2026-10-17 01:10
+
+import hashlib
+import json
+
+from django.db import migrations, models
+
+BATCH_SIZE = 2000
+
+
+# Bản sao cố định của api_integration.fingerprints tại thời điểm migration: migration không
+# import code của app để kết quả không đổi khi code thay đổi về sau
+def _fingerprint(data):
+    serialized = json.dumps(data, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+
+
+def _epoch(dt):
+    return int(dt.timestamp()) if dt else 0
+
+
+def status_history_key(updated_at, status, old_status=None, editor_fb=None):
+    return _fingerprint({
+        'updated_at': _epoch(updated_at),
+        'status': status,
+        'old_status': old_status,
+        'editor_fb': editor_fb,
+    })
+
+
+def order_history_key(updated_at, changes):
+    return _fingerprint({'updated_at': _epoch(updated_at), 'changes': changes})
+
+
+def _backfill(model, key_for_row):
+    """Tính history_key cho các row cũ, xoá row trùng (order, key) do sync delete/insert trước đây"""
+    seen_order_id = None
+    seen_keys = set()
+    to_update, duplicate_ids = [], []
+    for row in model.objects.order_by('order_id', 'id').iterator(chunk_size=BATCH_SIZE):
+        if row.order_id != seen_order_id:
+            seen_order_id, seen_keys = row.order_id, set()
+        row.history_key = key_for_row(row)
+        if row.history_key in seen_keys:
+            duplicate_ids.append(row.id)
+            continue
+        seen_keys.add(row.history_key)
+        to_update.append(row)
+        if len(to_update) >= BATCH_SIZE:
+            model.objects.bulk_update(to_update, ['history_key'])
+            to_update = []
+    if to_update:
+        model.objects.bulk_update(to_update, ['history_key'])
+    for start in range(0, len(duplicate_ids), BATCH_SIZE):
+        model.objects.filter(id__in=duplicate_ids[start:start + BATCH_SIZE]).delete()
+
+
+def backfill_history_keys(apps, schema_editor):
+    # Row cũ không phân biệt được updated_at upstream với thời điểm sync (fallback khi API thiếu
+    # updated_at) nên được key theo giá trị đã lưu; lần sync đầu tiên sau migration gán lại key
+    # epoch 0 cho các row đó (_rekey_legacy_histories) thay vì insert bản trùng
+    _backfill(
+        apps.get_model('shops', 'OrderStatusHistory'),
+        lambda row: status_history_key(row.updated_at, row.status, row.old_status, row.editor_fb),
+    )
+    _backfill(
+        apps.get_model('shops', 'OrderHistory'),
+        lambda row: order_history_key(row.updated_at, row.changes),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shops', '0015_sync_hash_fingerprints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderhistory',
+            name='history_key',
+            field=models.CharField(default='', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='orderstatushistory',
+            name='history_key',
+            field=models.CharField(default='', max_length=40),
+        ),
+        migrations.RunPython(backfill_history_keys, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='orderhistory',
+            unique_together={('order', 'history_key')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='orderstatushistory',
+            unique_together={('order', 'history_key')},
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.6 on 2026-10-17 01:13
+
+import re
+
+from django.db import migrations, models
+
+# Sync cũ ghép tag vào cuối note bằng '\n' (hoặc ghi tag trần nếu note rỗng) - chỉ bỏ đúng tag và dấu xuống dòng đó
+MISSING_CUSTOMER_TAG = re.compile(r'\n?\[MISSING_CUSTOMER_ID:([^\]]+)\]')
+
+
+def move_missing_customer_tags(apps, schema_editor):
+    """Chuyển tag [MISSING_CUSTOMER_ID:...] trong note sang cột pending_customer_pancake_id và trả lại note gốc"""
+    Order = apps.get_model('shops', 'Order')
+    orders = Order.objects.filter(note__contains='[MISSING_CUSTOMER_ID:').only('id', 'note')
+    to_update = []
+    for order in orders.iterator(chunk_size=1000):
+        match = MISSING_CUSTOMER_TAG.search(order.note)
+        if not match:
+            continue
+        order.pending_customer_pancake_id = match.group(1)
+        order.note = MISSING_CUSTOMER_TAG.sub('', order.note)
+        to_update.append(order)
+    Order.objects.bulk_update(to_update, ['pending_customer_pancake_id', 'note'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shops', '0016_order_history_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='pending_customer_pancake_id',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+        migrations.RunPython(move_missing_customer_tags, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['shop', 'pending_customer_pancake_id'], name='orders_shop_id_a072ba_idx'),
+        ),
+    ]
@@ -146,6 +146,7 @@ class Product(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     last_sync = models.DateTimeField(default=timezone.now)
+    sync_hash = models.CharField(max_length=40, blank=True, default='')  # Fingerprint dữ liệu API lần sync gần nhất
     
     class Meta:
         db_table = 'products'
@@ -159,10 +160,11 @@ class Product(models.Model):
 class ProductVariationField(models.Model):
     """Lưu thông tin các trường variation như màu sắc, size"""
     # ID từ Pancake API
-    pancake_id = models.CharField(max_length=100)
+    pancake_id = models.CharField(max_length=100, unique=True)
     name = models.CharField(max_length=100)  
     key_value = models.CharField(max_length=50)  
     value = models.CharField(max_length=100)  
+    sync_hash = models.CharField(max_length=40, blank=True, default='')  # Fingerprint dữ liệu API lần sync gần nhất
     
     class Meta:
         db_table = 'product_variation_fields'
@@ -221,6 +223,7 @@ class ProductVariation(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     last_sync = models.DateTimeField(default=timezone.now)
+    sync_hash = models.CharField(max_length=40, blank=True, default='')  # Fingerprint (không gồm tồn kho)
     
     class Meta:
         db_table = 'product_variations'
@@ -286,6 +289,65 @@ class SyncHistory(models.Model):
     
     def __str__(self):
         return f"Sync {self.sync_type} - {self.status} ({self.started_at})"
+
+
+class SyncWatermark(models.Model):
+    """Mốc đồng bộ incremental: max updated_at đã sync thành công theo shop + loại dữ liệu"""
+    ENTITY_CHOICES = [
+        ('orders', 'Orders'),
+        ('customers', 'Customers'),
+    ]
+    
+    shop = models.ForeignKey(Shop, on_delete=models.CASCADE, related_name='sync_watermarks')
+    entity = models.CharField(max_length=20, choices=ENTITY_CHOICES)
+    watermark = models.DateTimeField(null=True, blank=True)
+    
+    last_synced_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        db_table = 'sync_watermarks'
+        unique_together = ['shop', 'entity']
+        verbose_name = 'Mốc đồng bộ'
+        verbose_name_plural = 'Mốc đồng bộ'
+    
+    def __str__(self):
+        return f"{self.shop.name} - {self.entity}: {self.watermark}"
+
+
+class SyncCheckpoint(models.Model):
+    """Checkpoint của một lần sync (run) theo shop + entity, ghi sau mỗi trang đã commit để resume"""
+    ENTITY_CHOICES = [
+        ('orders', 'Orders'),
+        ('products', 'Products'),
+        ('customers', 'Customers'),
+    ]
+    
+    run_id = models.CharField(max_length=255)  # Celery task id của lần sync
+    shop = models.ForeignKey(Shop, on_delete=models.CASCADE, related_name='sync_checkpoints')
+    entity = models.CharField(max_length=20, choices=ENTITY_CHOICES)
+    
+    # Tiến độ
+    last_page = models.IntegerField(default=0)  # Trang cuối cùng đã commit
+    watermark = models.DateTimeField(null=True, blank=True)  # Max updated_at đã thấy trong run
+    error_count = models.IntegerField(default=0)
+    params = models.JSONField(default=dict, blank=True)  # Tham số của run (date range...) để resume đúng window
+    completed = models.BooleanField(default=False)
+    
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        db_table = 'sync_checkpoints'
+        unique_together = ['run_id', 'shop', 'entity']
+        verbose_name = 'Checkpoint đồng bộ'
+        verbose_name_plural = 'Checkpoint đồng bộ'
+        indexes = [
+            models.Index(fields=['updated_at']),
+        ]
+    
+    def __str__(self):
+        return f"{self.run_id} - {self.shop.name} - {self.entity}: page {self.last_page}"
     
 
 class User(models.Model):
@@ -303,6 +365,7 @@ class User(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     last_sync = models.DateTimeField(default=timezone.now)
+    sync_hash = models.CharField(max_length=40, blank=True, default='')  # Fingerprint dữ liệu API lần sync gần nhất
     
     class Meta:
         db_table = 'users'
@@ -386,6 +449,7 @@ class Customer(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     last_sync = models.DateTimeField(default=timezone.now)
+    sync_hash = models.CharField(max_length=40, blank=True, default='')  # Fingerprint dữ liệu API lần sync gần nhất
     
     class Meta:
         db_table = 'customers'
@@ -438,6 +502,7 @@ class CustomerAddress(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     last_sync = models.DateTimeField(default=timezone.now)
+    sync_hash = models.CharField(max_length=40, blank=True, default='')  # Fingerprint dữ liệu API lần sync gần nhất
     
     class Meta:
         db_table = 'customer_addresses'
@@ -615,6 +680,10 @@ class Order(models.Model):
     
     # Currency
     order_currency = models.CharField(max_length=10, default='VND')
+    sync_hash = models.CharField(max_length=40, blank=True, default='')  # Fingerprint dữ liệu API lần sync gần nhất
+    
+    # Customer pancake_id từ API khi customer chưa có trong DB (order tạm gán anonymous customer)
+    pending_customer_pancake_id = models.CharField(max_length=100, blank=True, null=True)
     
     class Meta:
         db_table = 'orders'
@@ -627,6 +696,7 @@ class Order(models.Model):
             models.Index(fields=['system_id']),
             models.Index(fields=['order_sources']),
             models.Index(fields=['inserted_at']),
+            models.Index(fields=['shop', 'pending_customer_pancake_id']),
         ]
     
     def __str__(self):
@@ -664,6 +734,7 @@ class OrderShippingAddress(models.Model):
     
     # Sicepat integration
     commune_code_sicepat = models.CharField(max_length=20, blank=True, null=True)
+    sync_hash = models.CharField(max_length=40, blank=True, default='')  # Fingerprint dữ liệu API lần sync gần nhất
     
     class Meta:
         db_table = 'order_shipping_addresses'
@@ -694,6 +765,7 @@ class OrderWarehouse(models.Model):
     custom_id = models.CharField(max_length=100, blank=True, null=True)
     affiliate_id = models.CharField(max_length=100, blank=True, null=True)
     ffm_id = models.CharField(max_length=100, blank=True, null=True)
+    sync_hash = models.CharField(max_length=40, blank=True, default='')  # Fingerprint dữ liệu API lần sync gần nhất
     
     class Meta:
         db_table = 'order_warehouses'
@@ -744,6 +816,7 @@ class OrderPartner(models.Model):
     # Service details (JSON)
     service_partner = models.JSONField(default=dict, blank=True,null=True)
     extend_update = models.JSONField(default=list, blank=True)
+    sync_hash = models.CharField(max_length=40, blank=True, default='')  # Fingerprint dữ liệu API lần sync gần nhất
     
     class Meta:
         db_table = 'order_partners'
@@ -795,6 +868,7 @@ class OrderItem(models.Model):
     
     # Variation info snapshot (JSON) - để lưu trữ thông tin tại thời điểm đặt hàng
     variation_info = models.JSONField(default=dict, blank=True)
+    sync_hash = models.CharField(max_length=40, blank=True, default='')  # Fingerprint dữ liệu API lần sync gần nhất
     
     class Meta:
         db_table = 'order_items'
@@ -823,11 +897,15 @@ class OrderStatusHistory(models.Model):
     # Timestamp
     updated_at = models.DateTimeField()
     
+    # Natural key (hash nội dung) để sync append-only
+    history_key = models.CharField(max_length=40, default='')
+    
     class Meta:
         db_table = 'order_status_histories'
         verbose_name = 'Lịch sử trạng thái đơn hàng'
         verbose_name_plural = 'Lịch sử trạng thái đơn hàng'
         ordering = ['-updated_at']
+        unique_together = ['order', 'history_key']
 
 class OrderHistory(models.Model):
     """Lịch sử thay đổi đơn hàng"""
@@ -842,8 +920,12 @@ class OrderHistory(models.Model):
     # Timestamp
     updated_at = models.DateTimeField()
     
+    # Natural key (hash nội dung) để sync append-only
+    history_key = models.CharField(max_length=40, default='')
+    
     class Meta:
         db_table = 'order_histories'
         verbose_name = 'Lịch sử đơn hàng'
         verbose_name_plural = 'Lịch sử đơn hàng'
-        ordering = ['-updated_at']
\ No newline at end of file
+        ordering = ['-updated_at']
+        unique_together = ['order', 'history_key']
\ No newline at end of file